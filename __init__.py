@@ -1,6 +1,8 @@
 __version__='0.1'
 
-__all__ = ['initialize','definitions']
+# library modules only: the scripts (processevent_from_arg, batchprocess, eventdaemon,
+# ingestnetworks, fakeorcampaign, benchmark) are run, not imported with *
+__all__ = ['initialize','definitions','atomicfile','scampindex','manifest','staging','metrics','synthetic','stations','darkflight','topography','atmosphere','catacache','headfile','metstore','spicekernels','geodesy','centroid','radiant','errors','checkpoint']
 
 prog__init__='(fripipe.__init__) '
 
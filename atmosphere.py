@@ -0,0 +1,523 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Local store of the atmospheric soundings of UWyoming_data_path and
+  MeteoFrance_data_path, indexed by station and time
+ -wind, density and temperature profiles on the dark flight altitude grid
+
+The sounding files are parsed once: the profiles of each station are saved
+in a columnar NumPy .npz file of the store directory (weather_data_path/store/,
+or the user cache directory if it is not writable), one row per level, with
+the offsets of the profiles; a file is parsed again only when it is modified.
+ -UWyoming files are the text lists of the University of Wyoming sounding
+  site (PRES HGHT TEMP DWPT RELH MIXR DRCT SKNT ... columns, then the
+  station information block); the stations are located with snstns.tbl.
+ -MeteoFrance files are CSV files with a header; the columns are station,
+  time (ISO 8601), altitude [m], pressure [hPa], temperature [C], wind speed
+  [m/s] and wind direction [deg], and optionally latitude and longitude.
+A profile is interpolated onto the dark flight grid, from 0 to
+constants.max_alt_DF by |constants.dh|, and kept in memory for the rest of
+the process. Above the top of the sounding, the temperature and the wind
+are constant and the density decreases with the isothermal scale height.
+
+"""
+import os
+import re
+import sys
+import glob
+import json
+import datetime
+import numpy as np
+from fripipe.initialize import path_and_file,constants
+from fripipe import atomicfile
+
+prog="(atmosphere.py) "
+
+# fallback directory of the store, if weather_data_path is not writable
+user_store_dir=os.path.expanduser('~/.fripipe/weather/')
+# name of the list of the ingested files
+ingested_name='ingested.json'
+# origin of the times of the store
+epoch=datetime.datetime(2000,1,1)
+# maximum time between the event and the profile [h]
+max_hours=24.0
+# specific gas constant of dry air [J/kg/K], and of the acceleration of gravity [m/s^2]
+R_air=287.05
+g0=9.80665
+knot=0.514444
+# columns of a profile in the store
+level_columns=['alt','pressure','temperature','rho','wind_e','wind_n']
+
+# accepted names of the columns of the MeteoFrance CSV files
+csv_aliases={'station':['station','station_id','stid','id'],
+             'time':['time','date','datetime'],
+             'alt':['altitude','alt','height','hght','geopotential_height'],
+             'pressure':['pressure','pres','p'],
+             'temperature':['temperature','temp','t'],
+             'wind_speed':['wind_speed','ff','speed'],
+             'wind_direction':['wind_direction','dd','direction','drct'],
+             'latitude':['latitude','lat'],
+             'longitude':['longitude','lon']}
+
+def seconds(time):
+    """Seconds since epoch of a datetime."""
+    return (time-epoch).total_seconds()
+
+def store_dir():
+    """Directory of the profile store."""
+    weatherdir=os.path.abspath(path_and_file.weather_data_path)
+    if os.access(weatherdir,os.W_OK):
+        return weatherdir+'/store/'
+    return user_store_dir
+
+def _density(pressure,temperature,mixing=None):
+    """Density [kg/m^3] from pressure [hPa], temperature [K] and mixing ratio [g/kg]."""
+    tv=temperature if mixing is None else temperature*(1.0+0.61e-3*np.nan_to_num(mixing))
+    return 100.0*pressure/(R_air*tv)
+
+def _wind(speed,direction):
+    """East and North wind from the speed and the direction it blows from."""
+    rad=np.radians(direction)
+    return -speed*np.sin(rad),-speed*np.cos(rad)
+
+class sounding (object):
+    """Profile of a sounding, sorted by altitude.
+
+    Parameters
+    ----------
+    station : string
+        Identifier of the station.
+    time : float
+        Time of the sounding, in seconds since epoch.
+    levels : dict
+        Arrays of level_columns.
+
+    """
+    def __init__(self,station,time,levels):
+        self.station=station
+        self.time=time
+        good=np.isfinite(levels['alt'])&np.isfinite(levels['temperature'])&np.isfinite(levels['rho'])
+        order=np.argsort(levels['alt'][good])
+        self.levels=dict((key,np.asarray(levels[key],dtype=float)[good][order]) for key in level_columns)
+
+def read_uwyoming(filename):
+    """Read the soundings of a UWyoming text list.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the file.
+
+    Returns
+    -------
+    soundings : list of sounding
+        Soundings of the file, with the station number as identifier.
+
+    """
+    soundings=[]
+    rows=[]
+    meta={}
+    intable=False
+    def flush():
+        if rows and 'number' in meta and 'time' in meta:
+            data=np.array(rows,dtype=float)
+            pres,hght,temp,dwpt,relh,mixr,drct,sknt=[data[:,i] for i in range(8)]
+            wind_e,wind_n=_wind(sknt*knot,drct)
+            temperature=temp+273.15
+            soundings.append(sounding(meta['number'],meta['time'],
+                                      {'alt':hght,'pressure':pres,'temperature':temperature,
+                                       'rho':_density(pres,temperature,mixr),
+                                       'wind_e':np.nan_to_num(wind_e),'wind_n':np.nan_to_num(wind_n)}))
+        del rows[:]
+        meta.clear()
+    with open(filename) as f:
+        for line in f:
+            line=re.sub('<[^>]*>','',line.rstrip('\n'))
+            words=line.split()
+            if words[:2]==['PRES','HGHT']:
+                flush()
+                intable=True
+                continue
+            if intable:
+                if line.startswith('---') or words[:2]==['hPa','m']:
+                    continue
+                if not words or not re.match(r'^\s*[\d.]',line):
+                    intable=False
+                else:
+                    rows.append([_fixed(line,i) for i in range(8)])
+                    continue
+            if ':' in line:
+                key,value=[part.strip() for part in line.split(':',1)]
+                if key=='Station number':
+                    meta['number']=value
+                elif key=='Observation time':
+                    meta['time']=seconds(datetime.datetime.strptime(value,'%y%m%d/%H%M'))
+    flush()
+    return soundings
+
+def _fixed(line,i,width=7):
+    """Value of the i-th fixed width column of a line, NaN if empty."""
+    value=line[i*width:(i+1)*width].strip()
+    return float(value) if value else np.nan
+
+def read_meteofrance(filename):
+    """Read the soundings of a MeteoFrance CSV file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the file.
+
+    Returns
+    -------
+    soundings : list of sounding
+        Soundings of the file.
+    locations : dict
+        Station identifier -> (latitude, longitude) [deg], if in the file.
+
+    """
+    with open(filename) as f:
+        lines=[line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not lines:
+        return [],{}
+    sep=';' if ';' in lines[0] else ','
+    columns=[column.strip().lower() for column in lines[0].split(sep)]
+    index={}
+    for key,aliases in csv_aliases.items():
+        for alias in aliases:
+            if alias in columns:
+                index[key]=columns.index(alias)
+                break
+    missing=[key for key in ('station','time','alt','pressure','temperature','wind_speed','wind_direction')
+             if key not in index]
+    if missing:
+        print prog+'*** WARNING: no '+' '.join(missing)+' columns in '+filename+', file skipped'
+        return [],{}
+    groups={}
+    locations={}
+    for line in lines[1:]:
+        values=[value.strip() for value in line.split(sep)]
+        station=values[index['station']]
+        time=seconds(datetime.datetime.strptime(values[index['time']][:19].replace('T',' '),'%Y-%m-%d %H:%M:%S'))
+        groups.setdefault((station,time),[]).append(
+            [_float(values[index[key]]) for key in ('alt','pressure','temperature','wind_speed','wind_direction')])
+        if 'latitude' in index and 'longitude' in index:
+            locations[station]=(_float(values[index['latitude']]),_float(values[index['longitude']]))
+    soundings=[]
+    for (station,time),rows in sorted(groups.items()):
+        alt,pres,temp,speed,direction=np.array(rows,dtype=float).T
+        wind_e,wind_n=_wind(speed,direction)
+        temperature=temp+273.15
+        soundings.append(sounding(station,time,{'alt':alt,'pressure':pres,'temperature':temperature,
+                                                'rho':_density(pres,temperature),
+                                                'wind_e':wind_e,'wind_n':wind_n}))
+    return soundings,locations
+
+def _float(value):
+    """Convert a value to float, NaN if it is missing or invalid."""
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return np.nan
+
+def read_station_table(filename=None):
+    """Read the UWyoming station table snstns.tbl.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the table (default: path_and_file.UWyoming_station_file).
+
+    Returns
+    -------
+    table : dict
+        Station number or identifier -> (latitude, longitude) [deg].
+
+    """
+    if filename is None:
+        filename=path_and_file.UWyoming_station_file
+    table={}
+    if not os.path.isfile(filename):
+        print prog+'*** WARNING: UWyoming station file '+filename+' does not exist'
+        return table
+    # STID STNM NAME [ST CO] LAT LON ELEV [PRI], LAT and LON in 1/100 deg
+    pattern=re.compile(r'^(\S+)\s+(\d+)\s+.*?\s(-?\d+)\s+(-?\d+)\s+(-?\d+)(\s+\d+)?\s*$')
+    with open(filename) as f:
+        for line in f:
+            match=pattern.match(line)
+            if match is None or line.startswith('!'):
+                continue
+            location=(int(match.group(3))/100.0,int(match.group(4))/100.0)
+            table[match.group(1)]=location
+            table[match.group(2)]=location
+    return table
+
+class store (object):
+    """Profile store of the weather data.
+
+    Parameters
+    ----------
+    directory : string
+        Directory of the store (default: store_dir()).
+
+    """
+    def __init__(self,directory=None):
+        self.directory=directory or store_dir()
+        self.stations={}
+        self.locations={}
+
+    def ingested(self):
+        """Files already ingested: file name -> [mtime, station identifiers]."""
+        try:
+            with open(self.directory+ingested_name) as f:
+                return json.load(f)
+        except (IOError,ValueError):
+            return {}
+
+    def ingest(self,uwyoming_dir=None,meteofrance_dir=None):
+        """Parse the new or modified sounding files into the store.
+
+        Parameters
+        ----------
+        uwyoming_dir : string
+            UWyoming directory (default: path_and_file.UWyoming_data_path).
+        meteofrance_dir : string
+            MeteoFrance directory (default: path_and_file.MeteoFrance_data_path).
+
+        Returns
+        -------
+        nfiles : integer
+            Number of files parsed, the malformed ones being skipped.
+
+        """
+        if uwyoming_dir is None:
+            uwyoming_dir=path_and_file.UWyoming_data_path
+        if meteofrance_dir is None:
+            meteofrance_dir=path_and_file.MeteoFrance_data_path
+        ingested=self.ingested()
+        files=[(name,'uwyoming') for name in sorted(glob.glob(os.path.join(uwyoming_dir,'*')))]+\
+              [(name,'meteofrance') for name in sorted(glob.glob(os.path.join(meteofrance_dir,'*.csv')))]
+        new={}
+        locations={}
+        nfiles=0
+        for filename,source in files:
+            if not os.path.isfile(filename):
+                continue
+            mtime=os.path.getmtime(filename)
+            if filename in ingested and ingested[filename][0]==mtime:
+                continue
+            # a malformed file is skipped, and parsed again at the next ingestion
+            try:
+                if source=='uwyoming':
+                    soundings=read_uwyoming(filename)
+                else:
+                    soundings,found=read_meteofrance(filename)
+                    locations.update(found)
+            except Exception as e:
+                print prog+'*** WARNING: unable to parse '+filename+', skipped: '+type(e).__name__+': '+str(e)
+                continue
+            for snd in soundings:
+                new.setdefault(snd.station,[]).append(snd)
+            ingested[filename]=[mtime,sorted(set(snd.station for snd in soundings))]
+            nfiles+=1
+        for station,soundings in new.items():
+            self.save(station,soundings,locations.get(station))
+        if (nfiles>0):
+            self.locations={}
+            atomicfile.save_cache(self.directory+ingested_name,lambda out:json.dump(ingested,out,indent=1),prog)
+            print prog+str(nfiles)+' sounding files ingested in '+self.directory
+        return nfiles
+
+    def station_file(self,station):
+        """Store file of a station."""
+        return self.directory+re.sub('[^A-Za-z0-9_.-]','_',station)+'.npz'
+
+    def load(self,station):
+        """Profiles of a station, see save; None if the station has none."""
+        filename=self.station_file(station)
+        if not os.path.isfile(filename):
+            return None
+        mtime=os.path.getmtime(filename)
+        cached=self.stations.get(station)
+        if cached is not None and cached[0]==mtime:
+            return cached[1]
+        with np.load(filename) as npz:
+            data=dict((key,npz[key]) for key in npz.files)
+        self.stations[station]=(mtime,data)
+        return data
+
+    def save(self,station,soundings,location=None):
+        """Merge soundings into the store file of a station.
+
+        The file holds 'time' (one per profile, sorted), 'offset' (first
+        level of each profile, plus the total number of levels), the
+        level_columns (one row per level) and 'location' (latitude and
+        longitude, NaN if unknown).
+
+        """
+        profiles={}
+        data=self.load(station)
+        if data is not None:
+            for i,time in enumerate(data['time']):
+                start,stop=data['offset'][i],data['offset'][i+1]
+                profiles[float(time)]=dict((key,data[key][start:stop]) for key in level_columns)
+            if location is None:
+                location=tuple(data['location'])
+        for snd in soundings:
+            profiles[snd.time]=snd.levels
+        times=sorted(profiles)
+        sizes=[len(profiles[time]['alt']) for time in times]
+        merged={'time':np.array(times),'offset':np.concatenate([[0],np.cumsum(sizes)]).astype(np.int64),
+                'location':np.array(location if location is not None else (np.nan,np.nan),dtype=float)}
+        for key in level_columns:
+            merged[key]=np.concatenate([profiles[time][key] for time in times]) if times else np.zeros(0)
+        atomicfile.save_cache(self.station_file(station),lambda out:np.savez(out,**merged),prog)
+        self.stations.pop(station,None)
+
+    def station_locations(self):
+        """Locations of the stations of the store: identifier -> (lat, lon)."""
+        table=read_station_table()
+        locations={}
+        for filename in glob.glob(self.directory+'*.npz'):
+            station=os.path.basename(filename)[:-4]
+            data=self.load(station)
+            location=tuple(data['location'])
+            if np.isnan(location[0]):
+                location=table.get(station,location)
+            if not np.isnan(location[0]):
+                locations[station]=location
+        return locations
+
+    def nearest_station(self,lat,lon):
+        """Nearest station of the store to a location [deg], None if none."""
+        if not self.locations:
+            self.locations=self.station_locations()
+        if not self.locations:
+            return None
+        names=sorted(self.locations)
+        slat,slon=np.radians(np.array([self.locations[name] for name in names])).T
+        lat,lon=np.radians(lat),np.radians(lon)
+        # haversine distance
+        h=np.sin((slat-lat)/2)**2+np.cos(lat)*np.cos(slat)*np.sin((slon-lon)/2)**2
+        return names[int(np.argmin(h))]
+
+    def sounding(self,station,time):
+        """Sounding of a station closest in time.
+
+        Parameters
+        ----------
+        station : string
+            Identifier of the station.
+        time : datetime.datetime
+            Time of the event (UT).
+
+        Returns
+        -------
+        snd : sounding
+            Closest sounding, None if the station has no profile.
+
+        """
+        data=self.load(station)
+        if data is None or len(data['time'])==0:
+            return None
+        t=seconds(time)
+        i=int(np.argmin(np.abs(data['time']-t)))
+        if (abs(data['time'][i]-t)>max_hours*3600.0):
+            print prog+'*** WARNING: closest sounding of '+station+' is '+str(abs(data['time'][i]-t)/3600.0)+' h from '+str(time)
+        start,stop=data['offset'][i],data['offset'][i+1]
+        return sounding(station,float(data['time'][i]),dict((key,data[key][start:stop]) for key in level_columns))
+
+class profile (object):
+    """Atmospheric profile on the dark flight altitude grid.
+
+    Calling a profile with an array of altitudes [m] returns density
+    [kg/m^3], temperature [K] and East and North wind [m/s], as the
+    atmosphere of darkflight.integrate.
+
+    Parameters
+    ----------
+    snd : sounding
+        Sounding the profile is interpolated from.
+    top : float
+        Top of the grid [m] (default: constants.max_alt_DF).
+    step : float
+        Step of the grid [m] (default: |constants.dh|).
+
+    """
+    def __init__(self,snd,top=None,step=None):
+        import astropy.units as u
+        if top is None:
+            top=constants.max_alt_DF.to(u.m).value
+        if step is None:
+            step=abs(constants.dh.to(u.m).value)
+        self.station=snd.station
+        self.time=snd.time
+        self.step=float(step)
+        self.alt=np.arange(0.0,top+step,step)
+        levels=snd.levels
+        if (len(levels['alt'])==0):
+            sys.exit(prog+"*** FATAL ERROR: empty sounding of station "+snd.station)
+        self.temperature=np.interp(self.alt,levels['alt'],levels['temperature'])
+        self.wind_e=np.interp(self.alt,levels['alt'],levels['wind_e'])
+        self.wind_n=np.interp(self.alt,levels['alt'],levels['wind_n'])
+        self.rho=np.exp(np.interp(self.alt,levels['alt'],np.log(levels['rho'])))
+        # isothermal atmosphere above the top of the sounding
+        above=self.alt>levels['alt'][-1]
+        scale_height=R_air*levels['temperature'][-1]/g0
+        self.rho[above]=levels['rho'][-1]*np.exp(-(self.alt[above]-levels['alt'][-1])/scale_height)
+
+    def __call__(self,alt):
+        """Density, temperature and wind at altitudes [m]."""
+        # linear interpolation on the regular grid
+        x=np.clip(np.asarray(alt,dtype=float)/self.step,0.0,len(self.alt)-1.0)
+        i=np.minimum(x.astype(int),len(self.alt)-2)
+        f=x-i
+        g=1.0-f
+        return (self.rho[i]*g+self.rho[i+1]*f,self.temperature[i]*g+self.temperature[i+1]*f,
+                self.wind_e[i]*g+self.wind_e[i+1]*f,self.wind_n[i]*g+self.wind_n[i+1]*f)
+
+# store of the process, and profiles already interpolated: (station, time) -> profile
+_store=None
+_profiles={}
+
+def get_store():
+    """Get the profile store, with the new sounding files ingested once per process."""
+    global _store
+    if _store is None:
+        _store=store()
+        _store.ingest()
+    return _store
+
+def get_profile(lat,lon,time,station=None):
+    """Atmospheric profile of the nearest station, closest in time.
+
+    Parameters
+    ----------
+    lat, lon : float
+        Location of the fall [deg].
+    time : datetime.datetime
+        Time of the event (UT).
+    station : string
+        Identifier of the station (default: nearest station of the store).
+
+    Returns
+    -------
+    prof : profile
+        Profile on the dark flight grid.
+
+    """
+    st=get_store()
+    if station is None:
+        station=st.nearest_station(lat,lon)
+        if station is None:
+            sys.exit(prog+"*** FATAL ERROR: no sounding in the weather store "+st.directory)
+    snd=st.sounding(station,time)
+    if snd is None:
+        sys.exit(prog+"*** FATAL ERROR: no sounding of station "+station)
+    key=(station,snd.time)
+    if key not in _profiles:
+        _profiles[key]=profile(snd)
+    return _profiles[key]
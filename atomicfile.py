@@ -0,0 +1,107 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Write or copy a file atomically: to a temporary file renamed at the end
+
+The temporary file is in the directory of the destination, named after it
+with the process and thread identifiers, so that processes and threads
+writing the same file at the same time do not mix their data: the readers
+see either the previous file or the complete new one. The temporary file is
+removed if the writing fails.
+
+"""
+import os
+import shutil
+import threading
+import contextlib
+
+prog="(atomicfile.py) "
+
+def tmp_name(filename):
+    """Name of the temporary file of a destination, for this process and thread."""
+    return '%s.%d.%d.tmp'%(filename,os.getpid(),threading.current_thread().ident or 0)
+
+@contextlib.contextmanager
+def open_atomic(filename,mode='w'):
+    """Open a temporary file, renamed to filename when it is closed without error.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the destination.
+    mode : string
+        Mode of the file, 'w' or 'wb'.
+
+    Returns
+    -------
+    out : file
+        Temporary file, whose name is out.name.
+
+    """
+    tmpfile=tmp_name(filename)
+    try:
+        with open(tmpfile,mode) as out:
+            yield out
+        os.rename(tmpfile,filename)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+def copy_atomic(src,dst,copy=shutil.copyfile):
+    """Copy a file through a temporary file renamed at the end.
+
+    Parameters
+    ----------
+    src, dst : string
+        Full path of the source and of the destination.
+    copy : callable
+        Copy function, e.g. shutil.copy2 to keep the times of the source.
+
+    Returns
+    -------
+    None.
+
+    """
+    tmpfile=tmp_name(dst)
+    try:
+        copy(src,tmpfile)
+        os.rename(tmpfile,dst)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+def save_cache(filename,save,caller=prog):
+    """Save a cache file atomically, only warning if it can not be written.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the file; its directory is created if needed.
+    save : callable
+        save(out) writes the data to the binary file out.
+    caller : string
+        prog of the caller, for the warning.
+
+    Returns
+    -------
+    saved : boolean
+        True if the file was saved.
+
+    """
+    try:
+        directory=os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with open_atomic(filename,'wb') as out:
+            save(out)
+        return True
+    except (IOError,OSError) as e:
+        print caller+'*** WARNING: unable to save '+filename+': '+str(e)
+        return False
@@ -0,0 +1,376 @@
+"""Process all the multiple detection events of months or of a date range.
+
+The events are discovered once in the path_and_file.work_mult_dir/<yyyymm>/
+directories. Every station of every event is a work unit of one shared pool
+of processes: while the trajectory of an event is computed, the stations of
+the next events keep the workers busy. An event is checked and staged only
+when the workers need more stations, and the trajectory of an event is
+computed as soon as all its stations are processed. With --scratch, the
+frames copied for an event are removed once it is done, its catalogs,
+*.met files and outputs being kept: the copied frames of only a few events
+exist at a time.
+
+Parameters
+----------
+months : list of string, optional
+    yyyymm of the months to process.
+start : string, optional
+    first date to process, yyyymmdd or yyyymmddTHHMMSS.
+end : string, optional
+    last date to process, yyyymmdd (included) or yyyymmddTHHMMSS.
+nworkers : integer, optional
+    number of stations processed in parallel (default: number of CPUs).
+force-stage : string, optional
+    stage to run again even if it is up to date. May be repeated.
+scratch : string, optional
+    local directory where the data are copied and processed.
+report : string, optional
+    JSON file of the status of each event (default:
+    detections/multiple/batch_<date>.json of the user data tree).
+
+Returns
+-------
+None :
+    The events are processed, and the status of each event is saved in
+    the report.
+
+Notes
+-----
+syntax is: python batchprocess.py [-m yyyymm ...] [--start date] [--end date] [-n nworkers] [--force-stage stage] [--scratch dir] [-o report]
+Each event gets the same log, metrics and summary files as with
+processevent_from_arg.py, and its checkpoint: a failed station is recorded
+and the event goes on (status 'partial') if enough stations succeeded; the
+other events are processed anyway, and the next batch retries the failed
+stations and trajectories.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import datetime
+import traceback
+import multiprocessing
+import Queue
+from fripipe.initialize import path_and_file
+from fripipe.initialize import load_spice
+from fripipe import manifest
+from fripipe import metrics
+from fripipe import staging
+from fripipe import processevent_from_arg
+from fripipe import spicekernels
+from fripipe import errors
+from fripipe import checkpoint
+from fripipe import atomicfile
+
+prog="(batchprocess.py) "
+syntax="python batchprocess.py [-m yyyymm ...] [--start date] [--end date] [-n nworkers] [--force-stage stage] [--scratch dir] [-o report]"
+
+# number of stations waiting for a worker, per worker, below which the next event is staged
+lookahead=2
+# time between two checks of the stations that failed in the pool [s]
+poll_interval=1.0
+
+def parse_date(date,end=False):
+    """Parse a yyyymmdd or yyyymmddTHHMMSS date; a yyyymmdd end date is the end of the day."""
+    if len(date)==8:
+        day=datetime.datetime.strptime(date,'%Y%m%d')
+        return day+datetime.timedelta(days=1,microseconds=-1) if end else day
+    return datetime.datetime.strptime(date[:15],'%Y%m%dT%H%M%S')
+
+def months_between(start,end):
+    """yyyymm of the months from start to end."""
+    months=[]
+    month=start.replace(day=1,hour=0,minute=0,second=0,microsecond=0)
+    while month<=end:
+        months.append(month.strftime('%Y%m'))
+        month=(month+datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+def discover_events(months=None,start=None,end=None):
+    """List the event directories of months and/or of a date range.
+
+    Parameters
+    ----------
+    months : list of string
+        yyyymm of the months.
+    start, end : datetime.datetime
+        Date range of the events, None for no bound.
+
+    Returns
+    -------
+    events : list of string
+        Full path of the event directories, sorted by date.
+
+    """
+    months=set(months or [])
+    if start is not None or end is not None:
+        months.update(months_between(start or end,end or start))
+    events=[]
+    for yyyymm in sorted(months):
+        for my_event in glob.glob("/".join([path_and_file.work_mult_dir,yyyymm,"*_UT"])):
+            name=os.path.basename(my_event)
+            try:
+                date=parse_date(name)
+            except ValueError:
+                print prog+'*** WARNING: '+my_event+' is not an event directory'
+                continue
+            if start is not None and date<start or end is not None and date>end:
+                continue
+            if os.path.isdir(my_event):
+                events.append(my_event)
+    return sorted(events,key=os.path.basename)
+
+def _batch_worker(args):
+    """Process one station of one event in a worker of the shared pool.
+
+    process_station_worker returns the failure of the station as a typed
+    error, whatever the exception.
+
+    """
+    ievent,job=args
+    return ievent,processevent_from_arg.process_station_worker(job)
+
+class batchevent (object):
+    """State of an event of the batch.
+
+    Parameters
+    ----------
+    my_event : string
+        Full path of the event directory.
+
+    """
+    def __init__(self,my_event):
+        self.my_event=my_event
+        self.log=None
+        self.output_dir=None
+        self.jobs=[]
+        self.ckpt=None
+        self.results=[]
+        self.status=None
+        self.error=None
+        self.start=time.time()
+        self.duration=None
+
+    def close(self,status,error=None):
+        """Save the summary of the event and close its recorder."""
+        self.status=status
+        self.error=error
+        self.duration=time.time()-self.start
+        if self.log is not None:
+            if error is not None:
+                self.log.info(error,echo=False)
+            processevent_from_arg.close_event(self.log,status,self.output_dir)
+            self.log.close()
+        print prog+'event '+self.my_event+': '+status+(' ('+error.strip()+')' if error else '')
+
+    def report(self):
+        """Status of the event, for the report."""
+        nfailed=0
+        if self.ckpt is not None:
+            nfailed=len([unit for unit in self.ckpt.failed() if unit!=checkpoint.trajectory_unit])
+        return {'event':os.path.basename(self.my_event),'directory':self.my_event,
+                'status':self.status,'error':self.error,'nstations':len(self.jobs),
+                'nfailed':nfailed,'duration':round(self.duration or 0.0,3)}
+
+def run_batch(events,datadir,userfri,nworkers,force=(),stage_mode=staging.link):
+    """Process events, their stations sharing one pool of processes.
+
+    Parameters
+    ----------
+    events : list of string
+        Full path of the event directories.
+    datadir, userfri, force, stage_mode :
+        See processevent_from_arg.process_event.
+    nworkers : integer
+        Number of stations processed in parallel.
+
+    Returns
+    -------
+    report : list of dict
+        Status of each event: event, directory, status, error, nstations,
+        nfailed, duration.
+
+    """
+    batch=[batchevent(my_event) for my_event in events]
+    nworkers=max(1,nworkers)
+    print prog+str(len(batch))+' events to process with '+str(nworkers)+' workers'
+    # results of the stations, put by the pool as they come
+    done=Queue.Queue()
+    # stations in the pool: (ievent, station) -> multiprocessing AsyncResult
+    tasks={}
+    nprepared=0
+    pool=multiprocessing.Pool(nworkers,initializer=load_spice)
+    try:
+        while True:
+            # check and stage the next events while the workers lack stations
+            while nprepared<len(batch) and len(tasks)<lookahead*nworkers:
+                ievent=nprepared
+                event=batch[ievent]
+                nprepared+=1
+                if not _prepare(event,datadir,userfri,force,stage_mode):
+                    continue
+                for job in event.jobs:
+                    tasks[(ievent,job[0])]=pool.apply_async(_batch_worker,[(ievent,job)],
+                                                            callback=done.put)
+            if not tasks:
+                break
+            # process each event as soon as all its stations are done
+            try:
+                ievent,result=done.get(timeout=poll_interval)
+            except Queue.Empty:
+                # a task that failed in the pool (e.g. its result could not be
+                # pickled) never calls back: its station fails
+                for (ievent,station),task in tasks.items():
+                    if task.ready() and not task.successful():
+                        done.put((ievent,_pool_failure(station,batch[ievent],task)))
+                continue
+            if tasks.pop((ievent,result[0]),None) is None:
+                continue
+            event=batch[ievent]
+            event.results.append(result)
+            if len(event.results)<len(event.jobs):
+                continue
+            # stations in the order of the jobs, as in process_event
+            order=dict((job[0],i) for i,job in enumerate(event.jobs))
+            event.results.sort(key=lambda result:order[result[0]])
+            _finish(event,force,datadir,stage_mode)
+    finally:
+        pool.close()
+        pool.join()
+    return [event.report() for event in batch]
+
+def _prepare(event,datadir,userfri,force,stage_mode):
+    """Check and stage the data of an event.
+
+    Returns
+    -------
+    ready : boolean
+        True if stations of the event are to be processed; otherwise the
+        event is already closed.
+
+    """
+    event.start=time.time()
+    try:
+        event.log,event.output_dir=processevent_from_arg.open_event(event.my_event,datadir)
+        event.jobs,event.ckpt=processevent_from_arg.prepare_event(event.log,event.my_event,datadir,
+                                                                  userfri,force,stage_mode,
+                                                                  event.output_dir)
+    except errors.pipeline_error as e:
+        event.close(metrics.error,str(e))
+        _unstage(event,datadir,stage_mode)
+        return False
+    except SystemExit as e:
+        event.close(metrics.error,str(e.code))
+        _unstage(event,datadir,stage_mode)
+        return False
+    except Exception:
+        event.close(metrics.error,traceback.format_exc())
+        _unstage(event,datadir,stage_mode)
+        return False
+    # every station failed its checks
+    if not event.jobs:
+        _finish(event,force,datadir,stage_mode)
+        return False
+    return True
+
+def _pool_failure(station,event,task):
+    """Result of a station whose task failed in the pool, see process_station_worker."""
+    try:
+        task.get(0)
+        msg='no result'
+    except Exception as e:
+        msg=repr(e)
+    name=station.split('/')[-1].split('_')[0]
+    msg=prog+"*** FATAL ERROR: station "+name+" failed in the pool: "+msg
+    log=metrics.recorder(os.path.basename(event.my_event),name)
+    log.info(msg,echo=False)
+    return station,None,log,errors.stage_error(msg,None,name)
+
+def _finish(event,force,datadir,stage_mode):
+    """Compute the trajectory of an event once all its stations are done, and close it.
+
+    With the copy staging mode, the copied frames of the event are removed.
+
+    """
+    try:
+        failed=processevent_from_arg.finish_event(event.log,event.my_event,event.results,
+                                                  force,event.output_dir,event.ckpt)
+        event.close(metrics.partial if failed else metrics.ok)
+    except errors.pipeline_error as e:
+        event.close(metrics.error,str(e))
+    except SystemExit as e:
+        event.close(metrics.error,str(e.code))
+    except Exception:
+        event.close(metrics.error,traceback.format_exc())
+    finally:
+        _unstage(event,datadir,stage_mode)
+
+def _unstage(event,datadir,stage_mode):
+    """Remove the frames copied for an event, with the copy staging mode."""
+    if (stage_mode!=staging.copy):
+        return
+    my_event=event.my_event.replace(path_and_file.data_dir,datadir)
+    nremoved=0
+    for station in glob.glob(event.my_event+'/*_UT'):
+        fits2Ddir=station+'/'+processevent_from_arg.fits2D_dir
+        try:
+            nremoved+=staging.unstage_directory(fits2Ddir,fits2Ddir.replace(event.my_event,my_event))
+        except OSError as e:
+            print prog+'*** WARNING: unable to remove the frames copied in '+my_event+': '+str(e)
+    if nremoved:
+        print prog+str(nremoved)+' frames copied in '+my_event+' removed'
+
+def save_report(report,filename):
+    """Save the report of a batch as JSON, and print its summary."""
+    with atomicfile.open_atomic(filename) as out:
+        json.dump({'date':datetime.datetime.utcnow().isoformat()+'Z','events':report},
+                  out,indent=1,sort_keys=True)
+    nok=sum(1 for event in report if event['status']==metrics.ok)
+    npartial=sum(1 for event in report if event['status']==metrics.partial)
+    print ''.join([prog,str(nok),' events processed, ',str(npartial),' without some stations, ',
+                   str(len(report)-nok-npartial),' failed; report saved in ',filename])
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('-m','--months',nargs='+',default=[],help='yyyymm of the months to process')
+    parser.add_argument('--start',default=None,help='first date, yyyymmdd or yyyymmddTHHMMSS')
+    parser.add_argument('--end',default=None,help='last date, yyyymmdd or yyyymmddTHHMMSS')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of stations processed in parallel')
+    parser.add_argument('--force-stage',dest='force',action='append',default=[],
+                        choices=processevent_from_arg.stage_names+[manifest.all_stages],
+                        help='stage to run again even if it is up to date (may be repeated)')
+    parser.add_argument('--scratch',default=None,
+                        help='local directory where the data are copied and processed')
+    parser.add_argument('-o','--report',default=None,help='JSON file of the status of each event')
+    args=parser.parse_args()
+    if not (args.months or args.start or args.end):
+        sys.exit(prog+"*** FATAL ERROR: please give months or a date range. syntax is: "+syntax)
+    start=parse_date(args.start) if args.start else None
+    end=parse_date(args.end,end=True) if args.end else None
+    datadir,userfri=processevent_from_arg.user_datadir()
+    stage_mode=staging.link
+    if args.scratch is not None:
+        datadir=args.scratch.rstrip('/')+'/'
+        userfri=0
+        stage_mode=staging.copy
+    fripon_detectdir=datadir+"/detections/multiple"
+    if not os.path.isdir(fripon_detectdir):
+        os.makedirs(fripon_detectdir)
+    events=discover_events(args.months,start,end)
+    if (len(events)==0):
+        sys.exit(prog+"*** FATAL ERROR: there is no event to process")
+    print prog+str(len(events))+' events to process'
+    # kernels of the stations, built once for all the events and furnished in this process
+    spicekernels.build()
+    load_spice()
+    report=run_batch(events,datadir,userfri,args.nworkers,args.force,stage_mode)
+    reportfile=args.report
+    if reportfile is None:
+        reportfile=fripon_detectdir+'/batch_'+datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')+'.json'
+    save_report(report,reportfile)
@@ -0,0 +1,184 @@
+"""Benchmark the event pipeline on synthetic data.
+
+A synthetic data tree is built (see synthetic.py) and the main stages of
+the pipeline are timed as the size of the data grows:
+ -gethead: gethead4event versus the number of scamp calibrations, with a
+  cold index (scamp.xml parsed), a disk index and an in-memory index
+ -staging: staging of a fits2D directory versus the number of frames,
+  by symbolic links and by copy
+ -event: the full per-event driver versus the number of stations, first
+  run and rerun, with the duration of each stage (headcopy, sexmet, ...)
+
+Parameters
+----------
+root : string, optional
+    directory where the synthetic tree is built (default: a temporary
+    directory, removed at the end).
+quick : flag, optional
+    run the smallest sizes only.
+output : string, optional
+    JSON file where the results are saved.
+nworkers : integer, optional
+    number of stations processed in parallel (default: number of CPUs).
+
+Returns
+-------
+None :
+    The results are printed, and saved in output.
+
+Notes
+-----
+syntax is: python -m fripipe.benchmark [-r root] [--quick] [-o output] [-n nworkers]
+The benchmark runs offline: SExtractor, SPICE, the station file and the
+modules missing from this tree (name2code, position2met, compute_traj)
+are replaced by synthetic stand-ins. SEX_STUB_DELAY (in seconds) makes the
+SExtractor stand-in sleep for each frame.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import datetime
+import multiprocessing
+
+prog="(benchmark.py) "
+syntax="python -m fripipe.benchmark [-r root] [--quick] [-o output] [-n nworkers]"
+
+# sizes of the benchmarks
+sizes={'gethead':[100,1000,10000,100000],
+       'staging':[100,1000,10000],
+       'event':[2,8,15]}
+quick_sizes={'gethead':[100,1000],
+             'staging':[100],
+             'event':[2]}
+
+def timed(func,*args,**kwargs):
+    """Call a function and time it.
+
+    Returns
+    -------
+    duration : float
+        Duration of the call, in seconds.
+    result : object
+        Result of the call.
+
+    """
+    start=time.time()
+    result=func(*args,**kwargs)
+    return time.time()-start,result
+
+def report(name,row):
+    """Print a result row."""
+    print prog+name+': '+', '.join('%s=%s'%(key,('%.4f'%value if isinstance(value,float) else value))
+                                    for key,value in sorted(row.items()))
+
+def bench_gethead(root,ncalibs):
+    """Time gethead4event versus the number of scamp calibrations."""
+    from fripipe import synthetic
+    from fripipe import scampindex
+    from fripipe import processevent_from_arg
+    eventname='20160806T220747_UT'
+    eventtime=datetime.datetime.strptime(eventname[:15],'%Y%m%dT%H%M%S')
+    rows=[]
+    for ncalib in ncalibs:
+        scampxml=synthetic.make_station_calibration(root,synthetic.station_code(0),eventtime,
+                                                    ncalib,nheads=min(ncalib,50))
+        indexfile=scampindex.index_file(scampxml)
+        if os.path.isfile(indexfile):
+            os.remove(indexfile)
+        scampindex._indexes.clear()
+        station=synthetic.station_name(0)
+        cold,head_file=timed(processevent_from_arg.gethead4event,eventname,station)
+        scampindex._indexes.clear()
+        disk,head_file=timed(processevent_from_arg.gethead4event,eventname,station)
+        memory,head_file=timed(processevent_from_arg.gethead4event,eventname,station)
+        row={'ncalib':ncalib,'cold':cold,'disk':disk,'memory':memory}
+        report('gethead',row)
+        rows.append(row)
+    return rows
+
+def bench_staging(root,nframes_list):
+    """Time the staging of a fits2D directory versus the number of frames."""
+    from fripipe import synthetic
+    from fripipe import staging
+    rows=[]
+    for nframes in nframes_list:
+        eventname='20160807T000000_UT'
+        my_event=synthetic.make_tree(root,eventname,nstations=1,nframes=nframes,ncalib=10)
+        fits2Ddir=os.path.join(my_event,synthetic.station_name(0)+'_UT','fits2D')
+        row={'nframes':nframes}
+        for mode in (staging.link,staging.copy):
+            dstdir=os.path.join(root,'staged',mode,str(nframes))
+            row[mode],summary=timed(staging.stage_directory,fits2Ddir,dstdir,mode=mode)
+            row[mode+'_again'],summary=timed(staging.stage_directory,fits2Ddir,dstdir,mode=mode)
+        shutil.rmtree(os.path.join(root,'staged'))
+        shutil.rmtree(my_event)
+        report('staging',row)
+        rows.append(row)
+    return rows
+
+def bench_event(root,nstations_list,nworkers,nframes=100):
+    """Time the full per-event driver versus the number of stations."""
+    from fripipe import synthetic
+    from fripipe import stations
+    from fripipe import processevent_from_arg
+    rows=[]
+    for nstations in nstations_list:
+        eventname='20160808T000000_UT'
+        my_event=synthetic.make_tree(root,eventname,nstations=nstations,nframes=nframes,ncalib=100)
+        # the station file was just rewritten
+        stations._registries.clear()
+        row={'nstations':nstations,'nframes':nframes}
+        for run in ('first','rerun'):
+            duration,log=timed(processevent_from_arg.process_event,my_event,
+                               processevent_from_arg.path_and_file.data_dir,1,nworkers)
+            log.close()
+            with open(os.path.join(my_event,'Trajectory','processmultidetect.json')) as f:
+                summary=json.load(f)
+            row[run]=duration
+            for stage,total in summary['stages'].items():
+                row[run+'_'+stage]=total['duration']
+        shutil.rmtree(my_event)
+        report('event',row)
+        rows.append(row)
+    return rows
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('-r','--root',default=None,
+                        help='directory where the synthetic tree is built')
+    parser.add_argument('--quick',action='store_true',help='run the smallest sizes only')
+    parser.add_argument('-o','--output',default=None,help='JSON file of the results')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of stations processed in parallel')
+    args=parser.parse_args()
+    root=args.root
+    if root is None:
+        root=tempfile.mkdtemp(prefix='fripipe_bench_')
+    root=os.path.abspath(root)
+    # the synthetic tree has to exist before path_and_file is first used
+    from fripipe import synthetic
+    synthetic.make_tree(root,nstations=1,nframes=1,ncalib=10)
+    os.environ.update(synthetic.environ(root))
+    installed=synthetic.install_standins(root)
+    print prog+'synthetic tree in '+root+', stand-ins for: '+' '.join(installed)
+    bench_sizes=quick_sizes if args.quick else sizes
+    results={'root':root,'nworkers':args.nworkers,'standins':installed,
+             'date':datetime.datetime.utcnow().isoformat()+'Z'}
+    try:
+        results['gethead']=bench_gethead(root,bench_sizes['gethead'])
+        results['staging']=bench_staging(root,bench_sizes['staging'])
+        results['event']=bench_event(root,bench_sizes['event'],args.nworkers)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1,sort_keys=True)
+    print prog+'done'
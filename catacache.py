@@ -0,0 +1,216 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Shared cache of the SExtractor catalogs (*.cata) of the fits2D frames
+ -content-addressed, bounded in size
+
+The catalog of a frame is stored under the SHA-1 of the content of the
+frame, of the head.head file and of the SExtractor configuration (the
+sexmet_auto_detect.sh script, the SExtractor executable and the files of
+path_and_file.sex_conf_dir). Any user processing the same frames with the
+same head file and configuration gets the same key, so the cache directory
+(path_and_file.cata_cache_dir) is shared by all the users and the reruns.
+The files are written through a temporary file renamed at the end, so that
+several processes can use the cache at the same time. The modification time
+of a catalog is updated when it is used; when the cache is larger than
+path_and_file.cata_cache_size, the least recently used catalogs are removed.
+The catalogs of a station are fetched, and stored, only if every frame has
+one: the catalogs of a SExtractor run that failed, or that wrote no catalog
+for some frame, are never shared. Such a run is a failure of the sexmet
+stage (see processevent_from_arg.py), so a station whose frames do not all
+get a catalog never uses the cache.
+
+"""
+import os
+import json
+import hashlib
+from fripipe.initialize import path_and_file
+from fripipe import manifest
+from fripipe import atomicfile
+
+prog="(catacache.py) "
+
+# suffix of the catalogs
+cata_suffix='.cata'
+# after an eviction, the cache is at most this fraction of its maximum size
+evict_fraction=0.9
+
+# configuration key of the process, computed once
+_config_key=None
+
+def config_key():
+    """Key of the SExtractor configuration: sexmet script, executable and config files."""
+    global _config_key
+    if _config_key is None:
+        sha1=hashlib.sha1()
+        sha1.update(manifest.tool_version(path_and_file.fripipe_shell_path+"/sexmet_auto_detect.sh"))
+        sha1.update(manifest.tool_version(path_and_file.sex_exe))
+        confdir=path_and_file.sex_conf_dir
+        if os.path.isdir(confdir):
+            for name in sorted(os.listdir(confdir)):
+                if os.path.isfile(os.path.join(confdir,name)):
+                    sha1.update(name)
+                    sha1.update(manifest.filehash(os.path.join(confdir,name)))
+        _config_key=sha1.hexdigest()
+    return _config_key
+
+def catalog_name(frame):
+    """Name of the catalog of a frame, as written by sexmet_auto_detect.sh."""
+    return os.path.splitext(frame)[0]+cata_suffix
+
+class catacache (object):
+    """Shared cache of the SExtractor catalogs.
+
+    Parameters
+    ----------
+    directory : string
+        Directory of the cache (default: path_and_file.cata_cache_dir).
+    maxsize : integer
+        Maximum size of the cache, in bytes (default:
+        path_and_file.cata_cache_size).
+
+    """
+    def __init__(self,directory=None,maxsize=None):
+        if directory is None:
+            directory=path_and_file.cata_cache_dir
+        if maxsize is None:
+            maxsize=path_and_file.cata_cache_size
+        self.directory=directory
+        self.maxsize=int(maxsize)
+
+    def keys(self,frames,headhash,config=None):
+        """Keys of the catalogs of frames.
+
+        Parameters
+        ----------
+        frames : list
+            [path, size, mtime, sha1] of each frame, see manifest.signature.
+        headhash : string
+            SHA-1 of the head.head file.
+        config : string
+            Key of the SExtractor configuration (default: config_key()).
+
+        Returns
+        -------
+        keys : dict
+            Full path of each frame -> key of its catalog.
+
+        """
+        if config is None:
+            config=config_key()
+        return dict((path,hashlib.sha1(json.dumps([sha1,headhash,config])).hexdigest())
+                    for path,size,mtime,sha1 in frames)
+
+    def path(self,key):
+        """Full path of a catalog in the cache."""
+        return os.path.join(self.directory,key[:2],key+cata_suffix)
+
+    def fetch(self,keys):
+        """Copy the catalogs of frames from the cache, if all are there.
+
+        Parameters
+        ----------
+        keys : dict
+            Full path of each frame -> key of its catalog, see keys.
+
+        Returns
+        -------
+        hit : boolean
+            True if the catalogs of all the frames were in the cache and
+            were copied next to the frames.
+
+        """
+        if not keys or not all(os.path.isfile(self.path(key)) for key in keys.values()):
+            return False
+        try:
+            for frame,key in keys.items():
+                atomicfile.copy_atomic(self.path(key),catalog_name(frame))
+                os.utime(self.path(key),None)
+        except (IOError,OSError) as e:
+            # evicted meanwhile by another process
+            print prog+'*** WARNING: cache miss while fetching '+str(e)
+            return False
+        return True
+
+    def store(self,keys):
+        """Store the catalogs of frames in the cache, if all are there, then evict if needed.
+
+        Parameters
+        ----------
+        keys : dict
+            Full path of each frame -> key of its catalog, see keys.
+
+        Returns
+        -------
+        nstored : integer
+            Number of catalogs stored.
+
+        """
+        nstored=0
+        if not all(os.path.isfile(catalog_name(frame)) for frame in keys):
+            print prog+'*** WARNING: some frames have no catalog, none stored in the cache'
+            return nstored
+        for frame,key in keys.items():
+            catalog=catalog_name(frame)
+            if os.path.isfile(self.path(key)):
+                continue
+            try:
+                _makedirs(os.path.dirname(self.path(key)))
+                atomicfile.copy_atomic(catalog,self.path(key))
+                nstored+=1
+            except (IOError,OSError) as e:
+                print prog+'*** WARNING: unable to store '+catalog+' in the cache: '+str(e)
+                break
+        if nstored:
+            self.evict()
+        return nstored
+
+    def evict(self):
+        """Remove the least recently used catalogs if the cache is too large."""
+        entries=[]
+        total=0
+        for dirpath,dirnames,filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith(cata_suffix):
+                    continue
+                path=os.path.join(dirpath,name)
+                try:
+                    stat=os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,path))
+                total+=stat.st_size
+        if (total<=self.maxsize):
+            return
+        entries.sort()
+        target=evict_fraction*self.maxsize
+        nremoved=0
+        for mtime,size,path in entries:
+            if (total<=target):
+                break
+            try:
+                os.remove(path)
+                nremoved+=1
+            except OSError:
+                pass
+            total-=size
+        print prog+str(nremoved)+' catalogs evicted from '+self.directory
+
+def _makedirs(directory):
+    """Create a directory of the shared cache, writable by the group."""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+            os.chmod(directory,0o2775)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+def get_cache():
+    """Get the catalog cache, None if it is disabled (cata_cache_size is 0)."""
+    if int(path_and_file.cata_cache_size)<=0:
+        return None
+    return catacache()
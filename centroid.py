@@ -0,0 +1,368 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Measure the meteor on the fits2D frames of a station in-process, instead
+  of launching SExtractor on every frame (sexmet_auto_detect.sh)
+ -write one *.cata catalog per frame, with the columns read by position2met
+
+The frames of the fits2D directory are memory-mapped as one stack: only
+the header of each frame is read, and the pixels are read only inside the
+windows around the meteor. The windows are predicted from the track of
+positions.txt (see read_track for its assumed format), interpolated on
+every frame between its first and last frames. The windows of all the
+frames are extracted into one 3D array, and measured together: background
+and noise from the border of each window, centroid and flux of the pixels
+above threshold times the noise, the centroid being measured again in a
+window centered on the first measurement. The pixel coordinates are FITS ones (the
+first pixel is 1), as X_IMAGE and Y_IMAGE of SExtractor.
+
+The celestial coordinates are computed with the WCS of the header of each
+frame, completed and overridden by the head.head file (the scamp solution
+without CRVAL), as SExtractor does. The catalogs have the columns X_IMAGE,
+Y_IMAGE, ALPHA_J2000, DELTA_J2000 and MAG_AUTO in the SExtractor ASCII_HEAD
+format; a frame without meteor gets an empty catalog.
+
+This engine is used only if path_and_file.centroid_engine is 'numpy': the
+default remains SExtractor until it is validated on real events. Any
+failure of the engine (unsupported frames, missing header card, invalid
+WCS...) is raised as a centroid_error, so that the caller falls back to
+SExtractor.
+
+"""
+import os
+import sys
+import glob
+import numpy as np
+from fripipe.catacache import catalog_name
+from fripipe import atomicfile
+
+prog="(centroid.py) "
+
+# names of the engines, see path_and_file.centroid_engine
+engine_numpy='numpy'
+engine_sextractor='sextractor'
+# half size of the measurement windows [pixel]
+half_window=8
+# detection threshold, in units of the background noise
+threshold=1.5
+# number of measurements, each one in a window centered on the previous one
+niter=2
+# zero point of the magnitudes, as the default MAG_ZEROPOINT of SExtractor
+mag_zeropoint=0.0
+# columns of the catalogs
+cata_columns=['X_IMAGE','Y_IMAGE','ALPHA_J2000','DELTA_J2000','MAG_AUTO']
+# data type of the pixels versus BITPIX
+bitpix_dtypes={8:'u1',16:'>i2',32:'>i4',-32:'>f4',-64:'>f8'}
+# keywords of the frames not used for their WCS
+structural_keywords=['SIMPLE','BITPIX','EXTEND','BZERO','BSCALE','BLANK']
+# size of a FITS block and of a card
+block_size=2880
+card_size=80
+
+class centroid_error (Exception):
+    """The frames or the track can not be measured by the engine."""
+    pass
+
+def read_header(filename):
+    """Read the primary header of a FITS file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the FITS file.
+
+    Returns
+    -------
+    cards : list of (string, string)
+        Keyword and raw value of each card, in the order of the header.
+    offset : integer
+        Offset of the data in the file [bytes].
+
+    """
+    cards=[]
+    offset=0
+    with open(filename,'rb') as f:
+        while True:
+            block=f.read(block_size)
+            if len(block)<block_size:
+                raise centroid_error(prog+'no END card in '+filename)
+            offset+=block_size
+            for i in range(0,block_size,card_size):
+                card=block[i:i+card_size]
+                keyword=card[:8].strip()
+                if keyword=='END':
+                    return cards,offset
+                if card[8:10]=='= ':
+                    cards.append((keyword,card[10:]))
+
+def card_value(raw):
+    """Value of a raw card value: string, boolean, integer or float."""
+    raw=raw.strip()
+    if raw.startswith("'"):
+        end=raw.find("'",1)
+        while end>0 and raw[end+1:end+2]=="'":
+            end=raw.find("'",end+2)
+        return raw[1:end].replace("''","'").rstrip()
+    value=raw.split('/')[0].strip()
+    if value in ('T','F'):
+        return value=='T'
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace('D','E'))
+
+def read_head(head_file):
+    """Cards of a scamp .head file (one card per line)."""
+    cards=[]
+    with open(head_file) as f:
+        for line in f:
+            if line[8:10]=='= ':
+                cards.append((line[:8].strip(),line[10:].rstrip('\n')))
+    return cards
+
+class stack (object):
+    """Memory-mapped stack of the frames of a fits2D directory.
+
+    Parameters
+    ----------
+    frames : list of string
+        Full path of the frames, in time order.
+
+    Attributes are frames, headers (dict of the cards of each frame),
+    shape (nframes, ny, nx) and the memory maps of the frames, created on
+    first use.
+
+    """
+    def __init__(self,frames):
+        self.frames=list(frames)
+        self.headers=[]
+        self.offsets=[]
+        for frame in self.frames:
+            cards,offset=read_header(frame)
+            self.headers.append(dict((key,card_value(value)) for key,value in cards))
+            self.offsets.append(offset)
+        if (len(self.frames)==0):
+            raise centroid_error(prog+'no frame to measure')
+        first=self.headers[0]
+        if (first.get('NAXIS')!=2 or first.get('BITPIX') not in bitpix_dtypes or
+            'NAXIS1' not in first or 'NAXIS2' not in first):
+            raise centroid_error(prog+'unsupported image in '+self.frames[0])
+        geometry=(first['BITPIX'],first['NAXIS1'],first['NAXIS2'])
+        for frame,header in zip(self.frames,self.headers):
+            if (header.get('BITPIX'),header.get('NAXIS1'),header.get('NAXIS2'))!=geometry:
+                raise centroid_error(prog+'the frames do not have the same size: '+frame)
+        self.dtype=np.dtype(bitpix_dtypes[geometry[0]])
+        self.shape=(len(self.frames),geometry[2],geometry[1])
+        self.maps=[None]*len(self.frames)
+
+    def frame(self,i):
+        """Memory map of the i-th frame."""
+        if self.maps[i] is None:
+            self.maps[i]=np.memmap(self.frames[i],dtype=self.dtype,mode='r',
+                                   offset=self.offsets[i],shape=self.shape[1:])
+        return self.maps[i]
+
+    def windows(self,iframe,x,y,half=half_window):
+        """Extract square windows around positions of some frames.
+
+        Parameters
+        ----------
+        iframe : numpy.ndarray of integer
+            Index of the frame of each window.
+        x, y : numpy.ndarray
+            FITS pixel coordinates of the centers of the windows.
+        half : integer
+            Half size of the windows: they are 2*half+1 pixels wide.
+
+        Returns
+        -------
+        cube : numpy.ndarray
+            Pixel values of the windows, (nwindows, 2*half+1, 2*half+1),
+            with BZERO and BSCALE applied.
+        x0, y0 : numpy.ndarray of integer
+            0-based column and row of the first pixel of each window; the
+            windows are shifted inside the frame at its edges.
+
+        """
+        size=2*half+1
+        ny,nx=self.shape[1:]
+        if nx<size or ny<size:
+            raise centroid_error(prog+'the frames are smaller than the windows')
+        x0=np.clip(np.round(x).astype(int)-1-half,0,nx-size)
+        y0=np.clip(np.round(y).astype(int)-1-half,0,ny-size)
+        cube=np.empty((len(iframe),size,size))
+        for k,(i,xk,yk) in enumerate(zip(iframe,x0,y0)):
+            cube[k]=self.frame(i)[yk:yk+size,xk:xk+size]
+        bscale=np.array([self.headers[i].get('BSCALE',1.0) for i in iframe],dtype=float)
+        bzero=np.array([self.headers[i].get('BZERO',0.0) for i in iframe],dtype=float)
+        cube*=bscale[:,None,None]
+        cube+=bzero[:,None,None]
+        return cube,x0,y0
+
+def measure(cube,x0,y0,nsigma=threshold):
+    """Measure the centroid and flux of the source of each window.
+
+    Parameters
+    ----------
+    cube : numpy.ndarray
+        Windows, (nwindows, size, size), see stack.windows.
+    x0, y0 : numpy.ndarray of integer
+        0-based column and row of the first pixel of each window.
+    nsigma : float
+        Pixels fainter than nsigma times the noise above the background are
+        not used.
+
+    Returns
+    -------
+    x, y : numpy.ndarray
+        FITS pixel coordinates of the centroids, NaN if there is no pixel
+        above threshold.
+    flux : numpy.ndarray
+        Flux above the background [ADU].
+
+    """
+    size=cube.shape[1]
+    border=np.concatenate([cube[:,0,:],cube[:,-1,:],cube[:,1:-1,0],cube[:,1:-1,-1]],axis=1)
+    background=np.median(border,axis=1)
+    # noise from the median absolute deviation of the border
+    noise=1.4826*np.median(np.abs(border-background[:,None]),axis=1)
+    signal=cube-background[:,None,None]
+    signal[signal<=nsigma*noise[:,None,None]]=0.0
+    flux=signal.sum(axis=(1,2))
+    index=np.arange(size,dtype=float)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        x=(signal.sum(axis=1)*index).sum(axis=1)/flux+x0+1.0
+        y=(signal.sum(axis=2)*index).sum(axis=1)/flux+y0+1.0
+    bad=flux<=0.0
+    x[bad]=np.nan
+    y[bad]=np.nan
+    return x,y,flux
+
+def read_track(positionfile,nframes):
+    """Predicted position of the meteor on the frames of the track.
+
+    Parameters
+    ----------
+    positionfile : string
+        Full path of positions.txt. Its assumed format (not checked against
+        the detection software): one line per detection of the meteor,
+        whitespace separated columns, '#' comments, the first four columns
+        being:
+         -the frame number: 0-based index of the frame in the fits2D
+          directory sorted by file name, possibly fractional,
+         -the time (not used here),
+         -x and y: FITS pixel coordinates of the meteor (first pixel is 1),
+        the other columns being ignored.
+    nframes : integer
+        Number of frames of the station.
+
+    Returns
+    -------
+    iframe : numpy.ndarray of integer
+        Index of the frames from the first to the last frame of the track.
+    x, y : numpy.ndarray
+        Position of the meteor interpolated on these frames.
+
+    """
+    positions=np.loadtxt(positionfile,ndmin=2)
+    if positions.shape[0]==0 or positions.shape[1]<4:
+        raise centroid_error(prog+'no track in '+positionfile)
+    order=np.argsort(positions[:,0])
+    frame=positions[order,0]
+    first=max(int(np.floor(frame[0])),0)
+    last=min(int(np.ceil(frame[-1])),nframes-1)
+    if last<first:
+        raise centroid_error(prog+'the track of '+positionfile+' is not on the frames')
+    iframe=np.arange(first,last+1)
+    return iframe,np.interp(iframe,frame,positions[order,2]),np.interp(iframe,frame,positions[order,3])
+
+def wcs_of(header,head_cards):
+    """WCS of a frame: its header completed and overridden by the head file."""
+    from astropy.io import fits
+    from astropy import wcs
+    merged=fits.Header()
+    for key,value in sorted(header.items()):
+        if key not in structural_keywords and not key.startswith('NAXIS'):
+            merged[key]=value
+    for key,raw in head_cards:
+        merged[key]=card_value(raw)
+    merged['NAXIS']=2
+    for axis,ctype in (('1','RA---TAN'),('2','DEC--TAN')):
+        if 'CTYPE'+axis not in merged:
+            merged['CTYPE'+axis]=ctype
+    return wcs.WCS(merged)
+
+def write_catalog(catafile,rows):
+    """Write a catalog in the SExtractor ASCII_HEAD format, atomically."""
+    with atomicfile.open_atomic(catafile) as out:
+        for i,column in enumerate(cata_columns):
+            out.write('#%4d %s\n'%(i+1,column))
+        for row in rows:
+            out.write('%11.4f %11.4f %12.7f %12.7f %8.4f\n'%tuple(row))
+
+def centroid(fits2Ddir,positionfile,head_file=None):
+    """Measure the meteor on the frames of a station and write their catalogs.
+
+    Parameters
+    ----------
+    fits2Ddir : string
+        Full path of the fits2D directory of the station.
+    positionfile : string
+        Full path of the positions.txt file of the station.
+    head_file : string
+        Full path of the head file (default: fits2Ddir/head.head).
+
+    Returns
+    -------
+    nmeasured : integer
+        Number of frames where the meteor was measured.
+
+    Raises
+    ------
+    centroid_error
+        If the frames or the track can not be measured, whatever the
+        reason; SExtractor has to be used instead.
+
+    """
+    try:
+        return _centroid(fits2Ddir,positionfile,head_file)
+    except centroid_error:
+        raise
+    except Exception as e:
+        raise centroid_error,(prog+'measurement of '+fits2Ddir+' failed: '+
+                              type(e).__name__+': '+str(e)),sys.exc_info()[2]
+
+def _centroid(fits2Ddir,positionfile,head_file):
+    """Measure the meteor and write the catalogs, see centroid."""
+    if head_file is None:
+        head_file=os.path.join(fits2Ddir,'head.head')
+    frames=sorted(glob.glob(os.path.join(fits2Ddir,'*.fit')))
+    stk=stack(frames)
+    iframe,x,y=read_track(positionfile,len(frames))
+    for n in range(niter):
+        cube,x0,y0=stk.windows(iframe,x,y)
+        mx,my,flux=measure(cube,x0,y0)
+        found=np.isfinite(mx)
+        x=np.where(found,mx,x)
+        y=np.where(found,my,y)
+    iframe,x,y,flux=iframe[found],x[found],y[found],flux[found]
+    # celestial coordinates: one WCS per pointing of the frames
+    head_cards=read_head(head_file) if os.path.isfile(head_file) else []
+    ra=np.zeros(len(iframe))
+    dec=np.zeros(len(iframe))
+    pointings={}
+    for k,i in enumerate(iframe):
+        header=stk.headers[i]
+        pointings.setdefault((header.get('CRVAL1'),header.get('CRVAL2')),[]).append(k)
+    for ks in pointings.values():
+        world=wcs_of(stk.headers[iframe[ks[0]]],head_cards).all_pix2world(x[ks],y[ks],1)
+        ra[ks]=world[0]
+        dec[ks]=world[1]
+    mag=mag_zeropoint-2.5*np.log10(flux)
+    rows=dict((i,[(x[k],y[k],ra[k],dec[k],mag[k])]) for k,i in enumerate(iframe))
+    for i,frame in enumerate(frames):
+        write_catalog(catalog_name(frame),rows.get(i,[]))
+    return len(iframe)
@@ -0,0 +1,107 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Record which units of an event succeeded or failed: each station, and
+  the trajectory
+ -tell the next run which units failed, to retry them
+
+The checkpoint is a JSON file saved in the Trajectory directory of the
+event, next to its manifest. For each unit it records its status ('ok' or
+'error'), the date, the *.met file of a station, and the typed error of a
+failed unit (see errors.py). The checkpoint does not skip any station:
+every station goes through the checks of its manifest (see manifest.py),
+so that a station that succeeded is processed again only if its frames,
+calibration or tools changed, and costs nothing otherwise. The failed units
+of the previous run are retried, and the trajectory is computed again if
+they succeed.
+
+"""
+import os
+import json
+from fripipe import metrics
+from fripipe import atomicfile
+
+prog="(checkpoint.py) "
+
+# name of the checkpoint file
+checkpoint_name='checkpoint.json'
+# unit of the trajectory of the event
+trajectory_unit='compute_traj'
+
+class checkpoint (object):
+    """Checkpoint of the units of an event.
+
+    Parameters
+    ----------
+    directory : string
+        Trajectory directory of the event, where the checkpoint is saved.
+    force : list of string
+        Stages to run again: if any, the checkpoint of the previous run is
+        ignored.
+
+    """
+    def __init__(self,directory,force=()):
+        self.filename=os.path.join(directory,checkpoint_name)
+        self.units={}
+        if os.path.isfile(self.filename) and not force:
+            try:
+                with open(self.filename) as f:
+                    self.units=json.load(f)
+            except (IOError,ValueError):
+                print prog+'*** WARNING: unreadable checkpoint '+self.filename+', all units will run'
+                self.units={}
+        # units of the previous run
+        self.previous=dict(self.units)
+
+    def previous_error(self,unit):
+        """Error of a unit that failed in the previous run, None otherwise."""
+        state=self.previous.get(unit)
+        if state is None or state['status']!=metrics.error:
+            return None
+        return state['error']
+
+    def keep(self,stations):
+        """Forget the stations that are no longer in the event directory."""
+        for unit in list(self.units):
+            if unit!=trajectory_unit and unit not in stations:
+                del self.units[unit]
+
+    def succeeded(self,unit):
+        """Tell if a station succeeded, and its *.met file exists."""
+        state=self.units.get(unit)
+        return (state is not None and state['status']==metrics.ok and
+                os.path.isfile(state.get('met_file') or ''))
+
+    def succeed(self,unit,met_file=None):
+        """Record the success of a unit."""
+        self.units[unit]={'status':metrics.ok,'date':metrics.utcnow(),'met_file':met_file}
+
+    def fail(self,unit,error):
+        """Record the failure of a unit.
+
+        Parameters
+        ----------
+        unit : string
+            Name of the station, or trajectory_unit.
+        error : errors.pipeline_error
+            Error of the unit.
+
+        """
+        self.units[unit]={'status':metrics.error,'date':metrics.utcnow(),'error':error.record()}
+
+    def met_files(self):
+        """*.met files of the stations that succeeded, sorted by station."""
+        return [self.units[unit]['met_file'] for unit in sorted(self.units)
+                if unit!=trajectory_unit and self.succeeded(unit)]
+
+    def failed(self):
+        """Names of the failed units."""
+        return sorted(unit for unit,state in self.units.items() if state['status']==metrics.error)
+
+    def save(self):
+        """Save the checkpoint atomically."""
+        with atomicfile.open_atomic(self.filename) as f:
+            json.dump(self.units,f,indent=1,sort_keys=True)
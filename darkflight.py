@@ -0,0 +1,369 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Integrate the dark flight of a meteoroid and of its clones at once
+ -Compute the distribution of the impact points
+
+All the clones are integrated together as NumPy arrays (one row per state
+variable, one column per clone), with the units of constants stripped to
+SI once. The state of a clone is its geodetic latitude and longitude [rad],
+altitude [m] and its velocity in the local East-North-Up frame [m/s],
+relative to the rotating Earth. The forces are gravity, the drag in the
+wind (Mach-dependent drag coefficient of a sphere) and the Coriolis and
+centrifugal accelerations; the Earth is a sphere of radius R_pla locally.
+The time step of each clone is such that it goes down by |constants.dh|
+per step; below constants.gnd_alt_thld above the ground, the terrain is
+queried at every step and the altitude step shrinks with the height above
+the ground, down to |dh|/fine_factor. The last step is interpolated onto
+the ground.
+
+The atmosphere is any callable returning density [kg/m^3], temperature
+[K] and the East and North wind [m/s] at an array of altitudes [m], and the
+ground any callable returning the terrain altitude [m] at arrays of
+latitudes and longitudes [deg]. Defaults are a windless exponential
+atmosphere and a ground at altitude 0; atmosphere.get_profile gives the
+atmosphere of the soundings, and topography.ground_altitude the ground of
+the IGN MNT.
+
+"""
+import numpy as np
+from fripipe.initialize import constants
+
+prog="(darkflight.py) "
+
+# drag coefficient of a sphere versus Mach number
+cd_mach=np.array([0.0,0.6,0.8,1.0,1.2,1.5,2.0,3.0,5.0])
+cd_sphere=np.array([0.47,0.50,0.60,0.80,0.92,0.95,0.95,0.92,0.92])
+# shape factor of a sphere: A = shape_factor*(m/rho)^(2/3)
+shape_factor=1.21
+# below gnd_alt_thld, the altitude step shrinks down to |dh|/fine_factor
+# as the ground gets close
+fine_factor=10.0
+# number of clones integrated together, small enough for the arrays to stay
+# in the processor cache
+chunk_size=16384
+# number of clones for a dense impact distribution, to pass as nclone: the
+# default stays constants.nclone
+many_clones=10000
+# maximum time step [s]
+max_dt=1.0
+# minimum vertical speed used to compute the time step [m/s]
+min_vz=1.0
+# specific gas constant of dry air [J/kg/K] and heat capacity ratio
+R_air=287.05
+gamma_air=1.4
+
+def _si(quantity,unit):
+    """Value of an astropy quantity in the given unit, as plain NumPy."""
+    return np.asarray(quantity.to(unit).value,dtype=float)
+
+class parameters (object):
+    """Dark flight constants of initialize.constants, in SI without units.
+
+    Attributes are g [m/s^2], w_pla [rad/s], R_pla [m], rhometeor
+    [kg/m^3], max_alt_DF [m], dh [m] (negative), gnd_alt_thld [m] and
+    nclone.
+
+    """
+    def __init__(self):
+        import astropy.units as u
+        self.g=float(_si(constants.g,u.m/u.s/u.s))
+        self.w_pla=float(_si(constants.w_pla,u.rad/u.s))
+        self.R_pla=float(_si(constants.R_pla,u.m))
+        self.rhometeor=float(_si(constants.rhometeor,u.kg/u.m**3))
+        self.max_alt_DF=float(_si(constants.max_alt_DF,u.m))
+        self.dh=float(_si(constants.dh,u.m))
+        self.gnd_alt_thld=float(_si(constants.gnd_alt_thld,u.m))
+        self.nclone=int(constants.nclone)
+
+def exponential_atmosphere(alt,rho0=1.225,scale_height=8500.0,T0=288.15,lapse=0.0065):
+    """Windless exponential atmosphere.
+
+    Parameters
+    ----------
+    alt : numpy.ndarray
+        Altitudes [m].
+
+    Returns
+    -------
+    rho, T, wind_e, wind_n : numpy.ndarray
+        Density [kg/m^3], temperature [K], East and North wind [m/s].
+
+    """
+    alt=np.asarray(alt,dtype=float)
+    rho=rho0*np.exp(-alt/scale_height)
+    T=np.maximum(T0-lapse*alt,216.65)
+    zero=np.zeros_like(alt)
+    return rho,T,zero,zero
+
+def flat_ground(lat,lon):
+    """Ground at altitude 0 everywhere."""
+    return np.zeros(np.shape(lat))
+
+def make_clones(lat,lon,alt,vel,mass,nclone=None,sigma_pos=0.0,sigma_vel=0.0,
+                sigma_mass=0.0,seed=None,R=6378136.6):
+    """Draw clones of a dark flight starting state.
+
+    Parameters
+    ----------
+    lat, lon : float
+        Geodetic latitude and longitude of the start [deg].
+    alt : float
+        Altitude of the start [m].
+    vel : sequence of 3 float
+        East, North, Up velocity relative to the ground [m/s].
+    mass : float
+        Mass [kg].
+    nclone : integer
+        Number of clones (default: constants.nclone). The first clone is
+        the nominal state; a dense impact distribution needs many clones,
+        e.g. many_clones, which is passed explicitly.
+    sigma_pos : float or sequence of 3 float
+        Standard deviation of the East, North, Up position [m].
+    sigma_vel : float or sequence of 3 float
+        Standard deviation of the East, North, Up velocity [m/s].
+    sigma_mass : float
+        Relative standard deviation of the mass.
+    seed : integer
+        Seed of the random generator.
+    R : float
+        Earth radius used to convert positions to angles [m].
+
+    Returns
+    -------
+    state : numpy.ndarray
+        (6,nclone) array: lat [rad], lon [rad], alt [m], vE, vN, vU [m/s].
+    mass : numpy.ndarray
+        (nclone,) array of masses [kg].
+
+    """
+    if nclone is None:
+        nclone=int(constants.nclone)
+    rng=np.random.RandomState(seed)
+    dpos=rng.normal(size=(3,nclone))*np.reshape(np.broadcast_to(sigma_pos,3),(3,1))
+    dvel=rng.normal(size=(3,nclone))*np.reshape(np.broadcast_to(sigma_vel,3),(3,1))
+    masses=mass*np.maximum(1.0+sigma_mass*rng.normal(size=nclone),1e-3)
+    dpos[:,0]=0.0
+    dvel[:,0]=0.0
+    masses[0]=mass
+    lat0=np.radians(lat)
+    state=np.empty((6,nclone))
+    state[0]=lat0+dpos[1]/(R+alt)
+    state[1]=np.radians(lon)+dpos[0]/((R+alt)*np.cos(lat0))
+    state[2]=alt+dpos[2]
+    state[3:]=np.reshape(vel,(3,1))+dvel
+    return state,masses
+
+def _frame(state,prm):
+    """Terms of the equations of motion frozen during a step.
+
+    The latitude and the distance to the Earth centre change by less than
+    1e-5 in relative value during a step, so the trigonometric terms, the
+    gravity and the centrifugal acceleration are computed once per step.
+
+    """
+    lat=state[0]
+    r=prm.R_pla+state[2]
+    sinlat=np.sin(lat)
+    coslat=np.cos(lat)
+    w=prm.w_pla
+    return {'invr':1.0/r,'invrcos':1.0/(r*coslat),'tanlat':sinlat/coslat,
+            'cor_s':2.0*w*sinlat,'cor_c':2.0*w*coslat,
+            'acc_n':-w*w*r*sinlat*coslat,
+            'acc_u':-prm.g*(prm.R_pla/r)**2+w*w*r*coslat*coslat}
+
+def _derivatives(state,area_mass,frame,atmosphere):
+    """Time derivatives of the states of the clones."""
+    ve,vn,vu=state[3],state[4],state[5]
+    rho,T,wind_e,wind_n=atmosphere(state[2])
+    # drag, in the air moving with the wind
+    re=ve-wind_e
+    rn=vn-wind_n
+    speed=np.sqrt(re*re+rn*rn+vu*vu)
+    cd=np.interp(speed/np.sqrt(gamma_air*R_air*T),cd_mach,cd_sphere)
+    k=0.5*rho*cd*area_mass*speed
+    # Coriolis (-2 w x v, w = w_pla (0, cos(lat), sin(lat)) in ENU),
+    # transport and centrifugal terms
+    invr=frame['invr']
+    vei=ve*invr
+    deriv=np.empty_like(state)
+    deriv[0]=vn*invr
+    deriv[1]=ve*frame['invrcos']
+    deriv[2]=vu
+    deriv[3]=-k*re+frame['cor_s']*vn-frame['cor_c']*vu+vei*(vn*frame['tanlat']-vu)
+    deriv[4]=-k*rn-frame['cor_s']*ve-vei*ve*frame['tanlat']-vn*vu*invr+frame['acc_n']
+    deriv[5]=-k*vu+frame['cor_c']*ve+(vei*ve+vn*vn*invr)+frame['acc_u']
+    return deriv
+
+def _rk4(state,dt,area_mass,prm,atmosphere):
+    """One Runge-Kutta 4 step of the clones, dt being an array."""
+    frame=_frame(state,prm)
+    k1=_derivatives(state,area_mass,frame,atmosphere)
+    k2=_derivatives(state+(0.5*dt)*k1,area_mass,frame,atmosphere)
+    k3=_derivatives(state+(0.5*dt)*k2,area_mass,frame,atmosphere)
+    k4=_derivatives(state+dt*k3,area_mass,frame,atmosphere)
+    k2+=k3
+    k2*=2.0
+    k2+=k1
+    k2+=k4
+    k2*=dt/6.0
+    k2+=state
+    return k2
+
+def integrate(state,mass,atmosphere=exponential_atmosphere,ground=flat_ground,
+              prm=None,max_steps=100000,chunk=chunk_size):
+    """Integrate the dark flight of all the clones down to the ground.
+
+    Parameters
+    ----------
+    state : numpy.ndarray
+        (6,n) array of the initial states, see make_clones.
+    mass : numpy.ndarray
+        (n,) array of the masses [kg].
+    atmosphere : callable
+        atmosphere(alt) -> rho [kg/m^3], T [K], wind_e, wind_n [m/s].
+    ground : callable
+        ground(lat,lon) -> terrain altitude [m], lat and lon in degrees.
+    prm : parameters
+        Dark flight constants (default: from initialize.constants).
+    max_steps : integer
+        Maximum number of steps.
+    chunk : integer
+        Number of clones integrated together.
+
+    Returns
+    -------
+    impact : dict
+        'lat', 'lon' [deg], 'alt' [m] of the impact points, 'time' [s] of
+        flight, 'speed' [m/s] at impact, and 'landed' (boolean) for each
+        clone.
+
+    """
+    if prm is None:
+        prm=parameters()
+    state=np.array(state,dtype=float)
+    n=state.shape[1]
+    mass=np.broadcast_to(np.asarray(mass,dtype=float),(n,))
+    if (n>chunk):
+        parts=[integrate(state[:,i:i+chunk],mass[i:i+chunk],atmosphere,ground,prm,max_steps,chunk)
+               for i in range(0,n,chunk)]
+        return dict((key,np.concatenate([part[key] for part in parts])) for key in parts[0])
+    area_mass=shape_factor*(mass/prm.rhometeor)**(2.0/3.0)/mass
+    step=abs(prm.dh)
+    impact=np.empty((6,n))
+    time=np.zeros(n)
+    landed=np.zeros(n,dtype=bool)
+    # working arrays of the clones still flying
+    active=np.arange(n)
+    s=state
+    t=np.zeros(n)
+    am=area_mass
+    ground_alt=np.zeros(n)
+    for istep in range(max_steps):
+        # height above the ground, the terrain being queried only when low
+        low=s[2]-ground_alt<prm.gnd_alt_thld
+        if low.any():
+            ground_alt[low]=ground(np.degrees(s[0,low]),np.degrees(s[1,low]))
+        height=s[2]-ground_alt
+        # the altitude step shrinks to step/fine_factor close to the ground
+        dz=np.where(low,np.clip(height,step/fine_factor,step),step)
+        dt=np.minimum(dz/np.maximum(-s[5],min_vz),max_dt)
+        new=_rk4(s,dt,am,prm,atmosphere)
+        newheight=new[2]-ground_alt
+        down=newheight<=0.0
+        if not down.any():
+            s=new
+            t+=dt
+            continue
+        # interpolate the crossing of the ground
+        frac=height[down]/np.maximum(height[down]-newheight[down],1e-12)
+        idx=active[down]
+        impact[:,idx]=s[:,down]+frac*(new[:,down]-s[:,down])
+        time[idx]=t[down]+frac*dt[down]
+        landed[idx]=True
+        keep=~down
+        active=active[keep]
+        if (len(active)==0):
+            break
+        s=new[:,keep]
+        t=t[keep]+dt[keep]
+        am=am[keep]
+        ground_alt=ground_alt[keep]
+    if (len(active)>0):
+        print prog+'*** WARNING: '+str(len(active))+' clones did not reach the ground'
+        impact[:,active]=s
+        time[active]=t
+    return {'lat':np.degrees(impact[0]),'lon':np.degrees(impact[1]),'alt':impact[2],
+            'time':time,'speed':np.sqrt((impact[3:]**2).sum(axis=0)),'landed':landed}
+
+def impact_statistics(impact,R=6378136.6):
+    """Distribution of the impact points.
+
+    Parameters
+    ----------
+    impact : dict
+        Result of integrate.
+    R : float
+        Earth radius used to convert angles to distances [m].
+
+    Returns
+    -------
+    stats : dict
+        'lat', 'lon' [deg]: mean impact point; 'cov' (2,2): covariance of
+        the East, North offsets [m^2]; 'axes' [m] and 'angle' [deg, from
+        North to East]: 1-sigma ellipse; 'nlanded': number of clones
+        that reached the ground.
+
+    """
+    ok=impact['landed']
+    lat=impact['lat'][ok]
+    lon=impact['lon'][ok]
+    lat0=lat.mean()
+    lon0=lon.mean()
+    east=np.radians(lon-lon0)*R*np.cos(np.radians(lat0))
+    north=np.radians(lat-lat0)*R
+    cov=np.cov(np.vstack([east,north])) if len(lat)>1 else np.zeros((2,2))
+    eigval,eigvec=np.linalg.eigh(cov)
+    angle=np.degrees(np.arctan2(eigvec[0,1],eigvec[1,1]))%180.0
+    return {'lat':lat0,'lon':lon0,'cov':cov,
+            'axes':np.sqrt(np.maximum(eigval[::-1],0.0)),'angle':angle,
+            'nlanded':int(ok.sum())}
+
+def darkflight(lat,lon,alt,vel,mass,nclone=None,sigma_pos=0.0,sigma_vel=0.0,
+               sigma_mass=0.0,seed=None,atmosphere=exponential_atmosphere,ground=flat_ground):
+    """Dark flight of a meteoroid and of its clones, down to the ground.
+
+    Parameters
+    ----------
+    lat, lon : float
+        Geodetic latitude and longitude of the end of the luminous flight [deg].
+    alt : float
+        Altitude of the end of the luminous flight [m], at most
+        constants.max_alt_DF.
+    vel : sequence of 3 float
+        East, North, Up velocity relative to the ground [m/s].
+    mass : float
+        Mass [kg].
+    nclone, sigma_pos, sigma_vel, sigma_mass, seed :
+        Clones, see make_clones.
+    atmosphere, ground : callable
+        See integrate.
+
+    Returns
+    -------
+    impact : dict
+        Impact point of each clone, see integrate.
+    stats : dict
+        Distribution of the impact points, see impact_statistics.
+
+    """
+    prm=parameters()
+    if (alt>prm.max_alt_DF):
+        print prog+'*** WARNING: dark flight starts at '+str(alt)+' m, above max_alt_DF='+str(prm.max_alt_DF)+' m'
+    state,masses=make_clones(lat,lon,alt,vel,mass,nclone,sigma_pos,sigma_vel,sigma_mass,
+                             seed,prm.R_pla)
+    impact=integrate(state,masses,atmosphere,ground,prm)
+    return impact,impact_statistics(impact,prm.R_pla)
@@ -0,0 +1,69 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Typed errors of the processing of the events, raised instead of sys.exit
+
+A station_error stops the processing of one station only: it is recorded
+in the log and in the checkpoint of the event (see checkpoint.py), and the
+other stations and events go on. An event_error stops the processing of one
+event, e.g. when too few stations succeeded to compute its trajectory. The
+message of an error keeps the '(prog) *** FATAL ERROR: ...' form of the
+former sys.exit messages. The errors can be sent back from the station
+workers: they keep their stage and station when pickled.
+
+"""
+
+prog="(errors.py) "
+
+class pipeline_error (Exception):
+    """Error of the processing of an event.
+
+    Parameters
+    ----------
+    message : string
+        Error message.
+    stage : string
+        Stage that failed, e.g. 'gethead', None if unknown.
+    station : string
+        Name of the station, None for the event itself.
+
+    """
+    def __init__(self,message,stage=None,station=None):
+        Exception.__init__(self,message)
+        self.message=message
+        self.stage=stage
+        self.station=station
+
+    def __str__(self):
+        return self.message
+
+    def __reduce__(self):
+        return (type(self),(self.message,self.stage,self.station))
+
+    def record(self):
+        """Description of the error, for the checkpoint and the reports."""
+        return {'type':type(self).__name__,'stage':self.stage,'station':self.station,
+                'message':self.message.strip()}
+
+class station_error (pipeline_error):
+    """Failure of one station: the other stations of the event go on."""
+    pass
+
+class calibration_error (station_error):
+    """The station is unknown, or has no usable scamp calibration."""
+    pass
+
+class data_error (station_error):
+    """Observation data of the station are missing (positions, frames)."""
+    pass
+
+class stage_error (station_error):
+    """A processing stage of the station failed."""
+    pass
+
+class event_error (pipeline_error):
+    """Failure of an event: no station, too few stations, or trajectory failed."""
+    pass
@@ -0,0 +1,315 @@
+"""Long-running service processing the multiple detection events.
+
+The service watches the path_and_file.work_mult_dir/<yyyymm>/ directories
+of the current and previous months and schedules every new event directory
+onto a bounded pool of event workers. An event can also be requested by
+dropping a file named after it in the queue directory.
+
+Parameters
+----------
+nevents : integer, optional
+    number of events processed at the same time (default: 1).
+nworkers : integer, optional
+    number of stations processed in parallel, by all the events (default:
+    number of CPUs).
+interval : float, optional
+    time between two scans of the directories, in seconds (default: 10).
+settle : float, optional
+    time without any change after which a new event directory is considered
+    complete, in seconds (default: 60).
+queue_dir : string, optional
+    directory where the event requests are dropped (default:
+    path_and_file.work_mult_dir/queue/).
+backlog : flag, optional
+    also process the events already present when the service starts.
+prometheus : string, optional
+    Prometheus textfile (*.prom) where the metrics of the last event are
+    exported.
+
+Returns
+-------
+None :
+    The service runs until it receives SIGTERM or SIGINT.
+
+Notes
+-----
+syntax is: python eventdaemon.py [-e nevents] [-n nworkers] [-i interval] [-s settle] [-q queue_dir] [--backlog] [--prometheus file]
+A request is a file named after the event, e.g. 20160806T220747_UT, dropped
+in queue_dir. Its optional content is the priority of the event: the lower
+the value, the sooner the event is processed (default: 10). A request is
+honoured even for an event that was already processed, but not for an
+event that is already queued or being processed: it is skipped, so that an
+event is never processed twice at the same time.
+A new event directory is complete once neither it, nor its station
+directories, nor their fits2D directories and frames changed for settle
+seconds.
+The SPICE kernels, the station registry and the scamp indexes are loaded once
+when the service starts, and stay loaded for all the events. The events are
+processed by threads of the service, which process their stations on a
+single pool of nworkers processes, created by the main thread before the
+event threads start: a process is never forked from an event thread.
+"""
+import sys
+import os
+import time
+import datetime
+import glob
+import argparse
+import itertools
+import multiprocessing
+import signal
+import threading
+import traceback
+import Queue
+from fripipe.initialize import path_and_file,constants,load_spice
+from fripipe import scampindex
+from fripipe import stations
+from fripipe import processevent_from_arg
+from fripipe import spicekernels
+from fripipe import errors
+
+prog="(eventdaemon.py) "
+syntax="python eventdaemon.py [-e nevents] [-n nworkers] [-i interval] [-s settle] [-q queue_dir] [--backlog] [--prometheus file]"
+
+# default priority of an event
+default_priority=10
+
+class eventdaemon (object):
+    """Watch the event directories and process the new events.
+
+    Parameters
+    ----------
+    datadir : string
+        Root of the directory tree where the data are processed.
+    userfri : integer
+        1 if the user is fripon, 0 otherwise.
+    nevents : integer
+        Number of events processed at the same time.
+    nworkers : integer
+        Number of stations processed in parallel, by all the events.
+    interval : float
+        Time between two scans of the directories, in seconds.
+    settle : float
+        Time without any change after which a new event directory is
+        considered complete, in seconds.
+    queue_dir : string
+        Directory where the event requests are dropped.
+    backlog : boolean
+        If True, also process the events already present at start.
+    prometheus : string
+        Prometheus textfile where the metrics of the events are exported.
+
+    """
+    def __init__(self,datadir,userfri,nevents=1,nworkers=1,interval=10.0,
+                 settle=60.0,queue_dir=None,backlog=False,prometheus=None):
+        self.datadir=datadir
+        self.userfri=userfri
+        self.nevents=nevents
+        self.nworkers=nworkers
+        self.interval=interval
+        self.settle=settle
+        if queue_dir is None:
+            queue_dir=path_and_file.work_mult_dir+'queue/'
+        self.queue_dir=queue_dir
+        self.backlog=backlog
+        self.prometheus=prometheus
+        # scheduled events, by priority then by order of arrival
+        self.queue=Queue.PriorityQueue()
+        self.order=itertools.count()
+        # event directories already scheduled
+        self.seen=set()
+        # event directories queued or being processed
+        self.inflight=set()
+        self.inflight_lock=threading.Lock()
+        self.stop=threading.Event()
+        # pool of the station processes, shared by the event threads
+        self.pool=None
+
+    def warm(self):
+        """Load once the data shared by all the events."""
+        # SPICE kernels
+        constants.abc_pla
+        # station registry
+        nstations=len(stations.get_registry().all())
+        # scamp indexes of all the stations
+        scampxmls=glob.glob(path_and_file.fri_proc_dir+'*/scamp/scamp.xml')
+        for scampxml in scampxmls:
+            scampindex.load_index(scampxml)
+        print prog+'SPICE kernels, '+str(nstations)+' stations and '+str(len(scampxmls))+' scamp indexes loaded'
+
+    def months(self):
+        """List the yyyymm directories to watch: current and previous month."""
+        now=datetime.datetime.utcnow()
+        previous=now.replace(day=1)-datetime.timedelta(days=1)
+        return [previous.strftime('%Y%m'),now.strftime('%Y%m')]
+
+    def settled(self,my_event):
+        """Tell if an event directory, its stations and their frames did not change for settle seconds."""
+        fits2Ddirs=glob.glob(my_event+'/*/'+processevent_from_arg.fits2D_dir)
+        paths=[my_event]+glob.glob(my_event+'/*')+fits2Ddirs
+        for fits2Ddir in fits2Ddirs:
+            paths+=glob.glob(fits2Ddir+'/*')
+        mtimes=[]
+        for path in paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                # removed since it was listed: the directory is still changing
+                return False
+        return (time.time()-max(mtimes)>=self.settle)
+
+    def schedule(self,my_event,priority=default_priority):
+        """Put an event in the queue.
+
+        Parameters
+        ----------
+        my_event : string
+            Full path of the event directory.
+        priority : integer
+            Priority of the event, the lower the sooner.
+
+        Returns
+        -------
+        scheduled : boolean
+            False if the event is already queued or being processed.
+
+        """
+        self.seen.add(my_event)
+        with self.inflight_lock:
+            if my_event in self.inflight:
+                print prog+'event '+my_event+' is already queued or being processed'
+                return False
+            self.inflight.add(my_event)
+        self.queue.put((priority,next(self.order),my_event))
+        print prog+'event '+my_event+' scheduled with priority '+str(priority)
+        return True
+
+    def scan_events(self,schedule=True):
+        """Look for the new event directories.
+
+        Parameters
+        ----------
+        schedule : boolean
+            If False, the new events are only marked as already seen.
+
+        Returns
+        -------
+        None.
+
+        """
+        for yyyymm in self.months():
+            for my_event in sorted(glob.glob(path_and_file.work_mult_dir+yyyymm+'/*_UT')):
+                if my_event in self.seen or not os.path.isdir(my_event):
+                    continue
+                if not schedule:
+                    self.seen.add(my_event)
+                elif self.settled(my_event):
+                    self.schedule(my_event)
+
+    def scan_requests(self):
+        """Schedule the events requested in the queue directory."""
+        if not os.path.isdir(self.queue_dir):
+            return
+        for request in sorted(os.listdir(self.queue_dir)):
+            requestfile=self.queue_dir+'/'+request
+            try:
+                content=open(requestfile).read().strip()
+                os.remove(requestfile)
+            except (IOError,OSError):
+                # the request is still being written, or another service took it
+                continue
+            try:
+                priority=int(content) if content else default_priority
+            except ValueError:
+                print prog+'*** WARNING: invalid priority '+content+' in request '+request
+                priority=default_priority
+            my_event="/".join([path_and_file.work_mult_dir,request[:6],request])
+            if os.path.isdir(my_event):
+                self.schedule(my_event,priority)
+            else:
+                print prog+'*** WARNING: requested event '+my_event+' does not exist'
+
+    def worker(self):
+        """Process the events of the queue, until the service stops."""
+        while not self.stop.is_set():
+            try:
+                priority,order,my_event=self.queue.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            start=time.time()
+            try:
+                log=processevent_from_arg.process_event(my_event,self.datadir,
+                                                        self.userfri,self.nworkers,
+                                                        prometheus=self.prometheus,
+                                                        pool=self.pool)
+                log.close()
+                print prog+'event '+my_event+' processed in '+str(time.time()-start)+' s'
+            except errors.pipeline_error as e:
+                print prog+'*** ERROR: event '+my_event+' failed: '+str(e)
+            except SystemExit as e:
+                print prog+'*** ERROR: event '+my_event+' failed: '+str(e.code)
+            except Exception:
+                print prog+'*** ERROR: event '+my_event+' failed:'
+                traceback.print_exc()
+            finally:
+                with self.inflight_lock:
+                    self.inflight.discard(my_event)
+                self.queue.task_done()
+
+    def run(self):
+        """Run the service until it is stopped."""
+        self.warm()
+        if not self.backlog:
+            self.scan_events(schedule=False)
+        # the processes are forked here, before any event thread exists
+        self.pool=multiprocessing.Pool(max(1,self.nworkers),initializer=load_spice)
+        try:
+            workers=[threading.Thread(target=self.worker,name='event-worker-'+str(i))
+                     for i in range(self.nevents)]
+            for thread in workers:
+                thread.daemon=True
+                thread.start()
+            print prog+'watching '+path_and_file.work_mult_dir+' and '+self.queue_dir
+            while not self.stop.is_set():
+                self.scan_requests()
+                self.scan_events()
+                self.stop.wait(self.interval)
+            for thread in workers:
+                thread.join()
+        finally:
+            self.pool.close()
+            self.pool.join()
+        print prog+'stopped'
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('-e','--nevents',type=int,default=1,
+                        help='number of events processed at the same time')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of stations of an event processed in parallel')
+    parser.add_argument('-i','--interval',type=float,default=10.0,
+                        help='time between two scans of the directories [s]')
+    parser.add_argument('-s','--settle',type=float,default=60.0,
+                        help='time after which a new event directory is complete [s]')
+    parser.add_argument('-q','--queue_dir',default=None,
+                        help='directory where the event requests are dropped')
+    parser.add_argument('--backlog',action='store_true',
+                        help='also process the events present at start')
+    parser.add_argument('--prometheus',default=None,
+                        help='Prometheus textfile where the metrics of the events are exported')
+    args=parser.parse_args()
+    datadir,userfri=processevent_from_arg.user_datadir()
+    # kernels of the stations, built once for all the events and furnished in this process
+    spicekernels.build()
+    load_spice()
+    daemon=eventdaemon(datadir,userfri,args.nevents,args.nworkers,args.interval,
+                       args.settle,args.queue_dir,args.backlog,args.prometheus)
+    def stop(signum,frame):
+        print prog+'signal '+str(signum)+' received, stopping after the current events'
+        daemon.stop.set()
+    signal.signal(signal.SIGTERM,stop)
+    signal.signal(signal.SIGINT,stop)
+    daemon.run()
@@ -0,0 +1,356 @@
+"""Run a campaign of Fakeor meteor entry simulations.
+
+A parameter grid is expanded into one run directory per combination of the
+parameters, under path_and_file.work_simu_dir/<campaign>/. Each run gets a
+copy of the simulation configuration file with its parameters, and AFM.x is
+run in the run directories on a pool of processes. The systematic noise law
+is then applied to the outputs of all the runs, and the results are saved
+in a single columnar file.
+
+Parameters
+----------
+campaign : string
+    name of the campaign, i.e. of its directory.
+grid : string
+    JSON file of the parameter grid: {"parameter": [values], ...}, with the
+    optional "repeat" key giving the number of runs of each combination.
+nworkers : integer, optional
+    number of AFM.x run at the same time (default: number of CPUs).
+cnf : string, optional
+    simulation configuration file (default: path_and_file.work_simu_cnf).
+
+Returns
+-------
+None :
+    The results are saved in work_simu_dir/<campaign>/campaign.npz.
+
+Notes
+-----
+syntax is: python fakeorcampaign.py campaign grid [-n nworkers] [--cnf file]
+A parameter of the grid replaces the 'name = value' line of the
+configuration file, or is appended if there is none; AFM.x is called with
+the configuration file as argument, in the run directory. The outputs are
+the output_pattern files of the run directories, text tables whose first
+line names the columns.
+A run is done once its done.json file exists: an interrupted campaign
+is resumed by running it again, only the runs not done being run. The noise
+is drawn from the seed of each run, so the results do not depend on the
+order of the runs.
+The 'sin' noise law adds to each angle column a sine of amplitude
+path_and_file.fkr_noise_acc over the duration of the record, with a random
+phase.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+from fripipe.initialize import path_and_file
+from fripipe import atomicfile
+
+prog="(fakeorcampaign.py) "
+syntax="python fakeorcampaign.py campaign grid [-n nworkers] [--cnf file]"
+
+# output files of AFM.x in a run directory
+output_pattern='*.dat'
+# columns of the outputs on which the noise is applied [deg]
+noise_columns=['ra','dec','az','alt']
+# column of the time of the outputs [s]
+time_column='time'
+# name of the description of the campaign, of the marker of a done run and of the results
+campaign_name='campaign.json'
+done_name='done.json'
+results_name='campaign.npz'
+
+def expand_grid(grid):
+    """Expand a parameter grid into the list of the runs.
+
+    Parameters
+    ----------
+    grid : dict
+        Parameter name -> list of values; the optional 'repeat' key is the
+        number of runs of each combination of the parameters.
+
+    Returns
+    -------
+    runs : list of dict
+        Parameters of each run, with its 'seed'.
+
+    """
+    grid=dict(grid)
+    repeat=int(grid.pop('repeat',1))
+    names=sorted(grid)
+    values=[grid[name] if isinstance(grid[name],list) else [grid[name]] for name in names]
+    runs=[]
+    for combination in itertools.product(*values):
+        for i in range(repeat):
+            run=dict(zip(names,combination))
+            run['seed']=len(runs)
+            runs.append(run)
+    return runs
+
+def write_cnf(template,cnffile,params):
+    """Write the configuration file of a run.
+
+    Parameters
+    ----------
+    template : string
+        Full path of the simulation configuration file.
+    cnffile : string
+        Full path of the configuration file of the run.
+    params : dict
+        Parameters of the run; 'seed' is not written.
+
+    Returns
+    -------
+    None.
+
+    """
+    params=dict((name,value) for name,value in params.items() if name!='seed')
+    lines=[]
+    with open(template) as f:
+        for line in f:
+            name=line.split('=',1)[0].strip()
+            if '=' in line and name in params:
+                line=name+' = '+str(params.pop(name))+'\n'
+            lines.append(line)
+    for name in sorted(params):
+        lines.append(name+' = '+str(params[name])+'\n')
+    with atomicfile.open_atomic(cnffile) as out:
+        out.writelines(lines)
+
+def run_dir(campaigndir,i):
+    """Directory of the i-th run of a campaign."""
+    return os.path.join(campaigndir,'run_%05d'%i)
+
+def run_afm(args):
+    """Run AFM.x in a run directory, unless the run is done.
+
+    Parameters
+    ----------
+    args : tuple
+        (rundir, exe, cnf): run directory, AFM.x executable and
+        configuration file of the run.
+
+    Returns
+    -------
+    rundir : string
+        Run directory.
+    status : dict
+        'returncode' and 'duration' [s] of the run.
+
+    """
+    rundir,exe,cnf=args
+    donefile=os.path.join(rundir,done_name)
+    if os.path.isfile(donefile):
+        with open(donefile) as f:
+            return rundir,json.load(f)
+    start=time.time()
+    with open(os.path.join(rundir,'afm.log'),'w') as log:
+        returncode=subprocess.call([exe,cnf],cwd=rundir,stdout=log,stderr=subprocess.STDOUT)
+    status={'returncode':returncode,'duration':time.time()-start}
+    if (returncode==0):
+        with atomicfile.open_atomic(donefile) as out:
+            json.dump(status,out)
+    return rundir,status
+
+def sin_noise(t,nseries,rng,acc):
+    """Systematic sine noise.
+
+    Parameters
+    ----------
+    t : numpy.ndarray
+        Times of the measurements [s].
+    nseries : integer
+        Number of noisy series (columns).
+    rng : numpy.random.RandomState
+        Random generator of the run.
+    acc : float
+        Amplitude of the noise.
+
+    Returns
+    -------
+    noise : numpy.ndarray
+        (nseries,len(t)) noise.
+
+    """
+    duration=max(np.ptp(t),1e-3) if len(t) else 1.0
+    phase=rng.uniform(0.0,2.0*np.pi,size=(nseries,1))
+    return acc*np.sin(2.0*np.pi*(t-t.min())/duration+phase) if len(t) else np.zeros((nseries,0))
+
+# noise laws: name -> function
+noise_laws={'sin':sin_noise}
+
+def read_outputs(rundir):
+    """Read the output tables of a run.
+
+    Returns
+    -------
+    tables : list of (string, numpy.ndarray)
+        Name and structured array of each output file.
+
+    """
+    tables=[]
+    for filename in sorted(glob.glob(os.path.join(rundir,output_pattern))):
+        data=np.genfromtxt(filename,names=True,dtype=float)
+        tables.append((os.path.basename(filename),np.atleast_1d(data)))
+    return tables
+
+def collect(campaigndir,runs,law=None,acc=None):
+    """Apply the noise law to the outputs of the done runs, and save them.
+
+    Parameters
+    ----------
+    campaigndir : string
+        Directory of the campaign.
+    runs : list of dict
+        Parameters of the runs, see expand_grid.
+    law : string
+        Noise law (default: path_and_file.fkr_noise_law).
+    acc : float
+        Amplitude of the noise [deg] (default: path_and_file.fkr_noise_acc).
+
+    Returns
+    -------
+    results : dict
+        Columns of the results: 'run' and 'output' number of each row,
+        the columns of the outputs, the 'outputs' file names, and the
+        parameters of the runs ('param_' prefix, one value per run).
+
+    """
+    import astropy.units as u
+    if law is None:
+        law=path_and_file.fkr_noise_law
+    if acc is None:
+        acc=path_and_file.fkr_noise_acc.to(u.deg).value
+    if law not in noise_laws:
+        sys.exit(prog+"*** FATAL ERROR: unknown noise law "+str(law)+", choice is: "+" ".join(sorted(noise_laws)))
+    # the run and output columns exist even if no run is done yet
+    columns={'run':[np.zeros(0)],'output':[np.zeros(0)]}
+    files=[]
+    nrows=0
+    for i,run in enumerate(runs):
+        rundir=run_dir(campaigndir,i)
+        if not os.path.isfile(os.path.join(rundir,done_name)):
+            continue
+        rng=np.random.RandomState(run['seed'])
+        for filename,data in read_outputs(rundir):
+            names=list(data.dtype.names)
+            noisy=[name for name in names if name in noise_columns]
+            if noisy and time_column in names:
+                noise=noise_laws[law](data[time_column],len(noisy),rng,acc)
+                for k,name in enumerate(noisy):
+                    data[name]+=noise[k]
+            for name in names:
+                if name not in columns:
+                    columns[name]=[np.full(nrows,np.nan)]
+            columns['run'].append(np.full(len(data),i))
+            columns['output'].append(np.full(len(data),len(files)))
+            for name in columns:
+                if name in names:
+                    columns[name].append(data[name])
+                elif name not in ('run','output'):
+                    columns[name].append(np.full(len(data),np.nan))
+            files.append(os.path.join(os.path.basename(rundir),filename))
+            nrows+=len(data)
+    results=dict((name,np.concatenate(chunks)) for name,chunks in columns.items())
+    results['outputs']=np.array(files,dtype=str)
+    for name in ('run','output'):
+        results[name]=results[name].astype(int)
+    for name in sorted(set(itertools.chain(*runs))):
+        results['param_'+name]=np.array([run.get(name,np.nan) for run in runs])
+    resultfile=os.path.join(campaigndir,results_name)
+    with atomicfile.open_atomic(resultfile,'wb') as out:
+        np.savez(out,**results)
+    return results
+
+def run_campaign(campaign,grid,nworkers=1,cnf=None,exe=None):
+    """Run, or resume, a simulation campaign.
+
+    Parameters
+    ----------
+    campaign : string
+        Name of the campaign.
+    grid : dict
+        Parameter grid, see expand_grid.
+    nworkers : integer
+        Number of AFM.x run at the same time.
+    cnf : string
+        Simulation configuration file (default: path_and_file.work_simu_cnf).
+    exe : string
+        AFM.x executable (default: path_and_file.work_afm_exe).
+
+    Returns
+    -------
+    results : dict
+        Results of the campaign, see collect.
+
+    """
+    if cnf is None:
+        cnf=path_and_file.work_simu_cnf
+    if exe is None:
+        exe=path_and_file.work_afm_exe
+    for name,filename in (('configuration',cnf),('AFM executable',exe)):
+        if not os.path.isfile(filename):
+            sys.exit(prog+"*** FATAL ERROR: "+name+" file "+filename+" does not exist")
+    campaigndir=os.path.join(path_and_file.work_simu_dir,campaign)
+    campaignfile=os.path.join(campaigndir,campaign_name)
+    description={'grid':grid,'cnf':os.path.abspath(cnf)}
+    if os.path.isfile(campaignfile):
+        with open(campaignfile) as f:
+            previous=json.load(f)
+        if previous!=json.loads(json.dumps(description)):
+            sys.exit(prog+"*** FATAL ERROR: campaign "+campaigndir+" exists with another grid or configuration")
+    else:
+        if not os.path.isdir(campaigndir):
+            os.makedirs(campaigndir)
+        with open(campaignfile,'w') as out:
+            json.dump(description,out,indent=1,sort_keys=True)
+    runs=expand_grid(grid)
+    todo=[]
+    for i,run in enumerate(runs):
+        rundir=run_dir(campaigndir,i)
+        if os.path.isfile(os.path.join(rundir,done_name)):
+            continue
+        if not os.path.isdir(rundir):
+            os.makedirs(rundir)
+        runcnf=os.path.join(rundir,os.path.basename(cnf))
+        write_cnf(cnf,runcnf,run)
+        todo.append((rundir,exe,runcnf))
+    print prog+campaigndir+': '+str(len(runs))+' runs, '+str(len(runs)-len(todo))+' already done'
+    failed=0
+    if todo:
+        pool=multiprocessing.Pool(max(1,min(nworkers,len(todo))))
+        try:
+            for rundir,status in pool.imap_unordered(run_afm,todo):
+                if (status['returncode']!=0):
+                    failed+=1
+                    print prog+'*** WARNING: AFM.x failed in '+rundir+' with code '+str(status['returncode'])
+        finally:
+            pool.close()
+            pool.join()
+    results=collect(campaigndir,runs)
+    print prog+str(len(results['outputs']))+' outputs of '+str(len(runs)-failed)+' runs saved in '+os.path.join(campaigndir,results_name)
+    if failed:
+        print prog+'*** WARNING: '+str(failed)+' runs failed, run the campaign again to retry them'
+    return results
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('campaign',help='name of the campaign')
+    parser.add_argument('grid',help='JSON file of the parameter grid')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of AFM.x run at the same time')
+    parser.add_argument('--cnf',default=None,help='simulation configuration file')
+    args=parser.parse_args()
+    with open(args.grid) as f:
+        grid=json.load(f)
+    run_campaign(args.campaign,grid,args.nworkers,args.cnf)
@@ -0,0 +1,334 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Convert arrays of points between geodetic, ECEF and station topocentric
+  (East-North-Up, azimuth/altitude) coordinates
+ -validate the conversions against SPICE georec and recgeo
+
+The Earth ellipsoid is constants.abc_pla (equatorial radius abc_pla[0],
+polar radius abc_pla[2]), stripped to meters once per process; every
+function takes plain NumPy arrays (or scalars) and broadcasts them, so that
+a whole trajectory, a set of clones or several stations are converted in
+one call. Latitudes, longitudes, azimuths and altitude angles are in
+degrees, distances in meters; the azimuth is counted from the North towards
+the East. The geodetic latitude of an ECEF point is computed by two
+iterations of the method of Bowring (1976), without trigonometric
+functions: the round trip to ECEF is accurate to a few nanometers from
+100 km below the ellipsoid to 1000 km above it, and to a micrometer up to
+the distance of the Moon.
+
+"""
+import numpy as np
+from fripipe.initialize import constants
+
+prog="(geodesy.py) "
+
+# number of iterations of the Bowring method
+niter=2
+# added to the norms that may be 0 [m]
+tiny=1e-30
+
+class ellipsoid (object):
+    """Ellipsoid of revolution, in meters.
+
+    Parameters
+    ----------
+    a : float
+        Equatorial radius [m].
+    b : float
+        Polar radius [m].
+
+    Attributes are a, b, f (flattening), e2 (first eccentricity squared)
+    and ep2 (second eccentricity squared).
+
+    """
+    def __init__(self,a,b):
+        self.a=float(a)
+        self.b=float(b)
+        self.f=(self.a-self.b)/self.a
+        self.e2=1.0-(self.b/self.a)**2
+        self.ep2=(self.a/self.b)**2-1.0
+
+    def __repr__(self):
+        return 'ellipsoid(%r,%r)'%(self.a,self.b)
+
+# ellipsoid of constants.abc_pla, built once
+_ellipsoid=None
+
+def get_ellipsoid():
+    """Ellipsoid of the Earth of constants.abc_pla, built once per process."""
+    global _ellipsoid
+    if _ellipsoid is None:
+        import astropy.units as u
+        abc=constants.abc_pla.to(u.m).value
+        _ellipsoid=ellipsoid(abc[0],abc[2])
+    return _ellipsoid
+
+def geodetic2ecef(lat,lon,alt,ell=None):
+    """Convert geodetic coordinates to ECEF cartesian coordinates.
+
+    Parameters
+    ----------
+    lat, lon : numpy.ndarray
+        Geodetic latitude and longitude [deg].
+    alt : numpy.ndarray
+        Altitude above the ellipsoid [m].
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    x, y, z : numpy.ndarray
+        ECEF coordinates [m].
+
+    """
+    if ell is None:
+        ell=get_ellipsoid()
+    lat=np.radians(lat)
+    lon=np.radians(lon)
+    sinlat=np.sin(lat)
+    coslat=np.cos(lat)
+    # radius of curvature in the prime vertical
+    N=ell.a/np.sqrt(1.0-ell.e2*sinlat*sinlat)
+    r=(N+alt)*coslat
+    return r*np.cos(lon),r*np.sin(lon),(N*(1.0-ell.e2)+alt)*sinlat
+
+def ecef2geodetic(x,y,z,ell=None):
+    """Convert ECEF cartesian coordinates to geodetic coordinates.
+
+    Parameters
+    ----------
+    x, y, z : numpy.ndarray
+        ECEF coordinates [m].
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    lat, lon : numpy.ndarray
+        Geodetic latitude and longitude [deg].
+    alt : numpy.ndarray
+        Altitude above the ellipsoid [m].
+
+    """
+    if ell is None:
+        ell=get_ellipsoid()
+    x,y,z=np.broadcast_arrays(*[np.asarray(c,dtype=float) for c in (x,y,z)])
+    p=np.sqrt(x*x+y*y)
+    # the iterations work on the sine and cosine of the reduced latitude,
+    # without trigonometric functions; tiny avoids 0/0 at the center
+    q=1.0-ell.f
+    num=z
+    den=p
+    for i in range(niter):
+        d=np.sqrt(q*q*num*num+den*den)+tiny
+        sinbeta=q*num/d
+        cosbeta=den/d
+        num=z+ell.ep2*ell.b*sinbeta*sinbeta*sinbeta
+        den=p-ell.e2*ell.a*cosbeta*cosbeta*cosbeta
+    d=np.sqrt(num*num+den*den)+tiny
+    sinlat=num/d
+    alt=(p*den+z*num)/d-ell.a*np.sqrt(1.0-ell.e2*sinlat*sinlat)
+    return np.degrees(np.arctan2(num,den)),np.degrees(np.arctan2(y,x)),alt
+
+def _rotation(lat0,lon0):
+    """Sines and cosines of the latitude and longitude of a station."""
+    lat0=np.radians(lat0)
+    lon0=np.radians(lon0)
+    return np.sin(lat0),np.cos(lat0),np.sin(lon0),np.cos(lon0)
+
+def ecef2enu(x,y,z,lat0,lon0,alt0,ell=None):
+    """Convert ECEF coordinates to the East-North-Up frame of a station.
+
+    Parameters
+    ----------
+    x, y, z : numpy.ndarray
+        ECEF coordinates [m].
+    lat0, lon0, alt0 : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m] of the
+        station(s), broadcast against the points.
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    e, n, u : numpy.ndarray
+        Topocentric coordinates [m].
+
+    """
+    x0,y0,z0=geodetic2ecef(lat0,lon0,alt0,ell)
+    dx=x-x0
+    dy=y-y0
+    dz=z-z0
+    sinlat,coslat,sinlon,coslon=_rotation(lat0,lon0)
+    t=coslon*dx+sinlon*dy
+    return (-sinlon*dx+coslon*dy,
+            -sinlat*t+coslat*dz,
+            coslat*t+sinlat*dz)
+
+def enu2ecef(e,n,u,lat0,lon0,alt0,ell=None):
+    """Convert East-North-Up coordinates of a station to ECEF coordinates.
+
+    Parameters
+    ----------
+    e, n, u : numpy.ndarray
+        Topocentric coordinates [m].
+    lat0, lon0, alt0 : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m] of the
+        station(s), broadcast against the points.
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    x, y, z : numpy.ndarray
+        ECEF coordinates [m].
+
+    """
+    x0,y0,z0=geodetic2ecef(lat0,lon0,alt0,ell)
+    sinlat,coslat,sinlon,coslon=_rotation(lat0,lon0)
+    t=coslat*u-sinlat*n
+    return (x0+coslon*t-sinlon*e,
+            y0+sinlon*t+coslon*e,
+            z0+sinlat*u+coslat*n)
+
+def enu2azalt(e,n,u):
+    """Convert East-North-Up coordinates to azimuth, altitude and range.
+
+    Parameters
+    ----------
+    e, n, u : numpy.ndarray
+        Topocentric coordinates [m].
+
+    Returns
+    -------
+    az : numpy.ndarray
+        Azimuth, from the North towards the East, in [0,360[ [deg].
+    alt : numpy.ndarray
+        Altitude above the horizon [deg].
+    rng : numpy.ndarray
+        Distance [m].
+
+    """
+    h2=e*e+n*n
+    return (np.degrees(np.arctan2(e,n))%360.0,
+            np.degrees(np.arctan2(u,np.sqrt(h2))),
+            np.sqrt(h2+u*u))
+
+def azalt2enu(az,alt,rng=1.0):
+    """Convert azimuth, altitude and range to East-North-Up coordinates.
+
+    Parameters
+    ----------
+    az : numpy.ndarray
+        Azimuth, from the North towards the East [deg].
+    alt : numpy.ndarray
+        Altitude above the horizon [deg].
+    rng : numpy.ndarray
+        Distance [m] (default: 1, for unit vectors).
+
+    Returns
+    -------
+    e, n, u : numpy.ndarray
+        Topocentric coordinates [m].
+
+    """
+    az=np.radians(az)
+    alt=np.radians(alt)
+    h=rng*np.cos(alt)
+    return h*np.sin(az),h*np.cos(az),rng*np.sin(alt)
+
+def geodetic2azalt(lat,lon,alt,lat0,lon0,alt0,ell=None):
+    """Azimuth, altitude and range of geodetic points seen from station(s).
+
+    Parameters
+    ----------
+    lat, lon, alt : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m] of the points.
+    lat0, lon0, alt0 : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m] of the
+        station(s), broadcast against the points.
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    az, alt, rng : numpy.ndarray
+        See enu2azalt.
+
+    """
+    x,y,z=geodetic2ecef(lat,lon,alt,ell)
+    return enu2azalt(*ecef2enu(x,y,z,lat0,lon0,alt0,ell))
+
+def azalt2geodetic(az,alt,rng,lat0,lon0,alt0,ell=None):
+    """Geodetic coordinates of points seen from station(s) at a given range.
+
+    Parameters
+    ----------
+    az, alt, rng : numpy.ndarray
+        Azimuth, altitude [deg] and range [m] of the points, see enu2azalt.
+    lat0, lon0, alt0 : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m] of the
+        station(s), broadcast against the points.
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    lat, lon, alt : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m].
+
+    """
+    e,n,u=azalt2enu(az,alt,rng)
+    return ecef2geodetic(*enu2ecef(e,n,u,lat0,lon0,alt0,ell),ell=ell)
+
+def validate(npoints=1000,seed=0,ell=None):
+    """Compare the conversions with SPICE georec and recgeo.
+
+    Random points from 1 km below the ellipsoid up to 1000 km above are
+    converted by geodetic2ecef and ecef2geodetic, and one by one by SPICE.
+
+    Parameters
+    ----------
+    npoints : integer
+        Number of random points.
+    seed : integer
+        Seed of the random generator.
+    ell : ellipsoid
+        Ellipsoid (default: get_ellipsoid()).
+
+    Returns
+    -------
+    errors : dict
+        Maximum differences with SPICE: 'ecef' [m], 'lat' and 'lon' [deg],
+        'alt' [m].
+
+    """
+    from fripipe.initialize import load_spice
+    sp=load_spice()
+    if ell is None:
+        ell=get_ellipsoid()
+    rng=np.random.RandomState(seed)
+    lat=np.degrees(np.arcsin(rng.uniform(-1.0,1.0,npoints)))
+    lon=rng.uniform(-180.0,180.0,npoints)
+    alt=rng.uniform(-1.0e3,1.0e6,npoints)
+    x,y,z=geodetic2ecef(lat,lon,alt,ell)
+    glat,glon,galt=ecef2geodetic(x,y,z,ell)
+    re=ell.a/1000.0
+    ecef=np.zeros((npoints,3))
+    geo=np.zeros((npoints,3))
+    for i in range(npoints):
+        ecef[i]=np.array(sp.georec(np.radians(lon[i]),np.radians(lat[i]),alt[i]/1000.0,re,ell.f))*1000.0
+        slon,slat,salt=sp.recgeo(ecef[i]/1000.0,re,ell.f)
+        geo[i]=[np.degrees(slat),np.degrees(slon),salt*1000.0]
+    dlon=(glon-geo[:,1]+180.0)%360.0-180.0
+    errors={'ecef':float(np.max(np.sqrt((x-ecef[:,0])**2+(y-ecef[:,1])**2+(z-ecef[:,2])**2))),
+            'lat':float(np.max(np.abs(glat-geo[:,0]))),
+            'lon':float(np.max(np.abs(dlon))),
+            'alt':float(np.max(np.abs(galt-geo[:,2])))}
+    print prog+'maximum differences with SPICE over '+str(npoints)+' points: '+\
+        ', '.join('%s=%.3g'%(key,errors[key]) for key in sorted(errors))
+    return errors
@@ -0,0 +1,89 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Copy a scamp head file without its CRVAL keywords (was: grep -v CRVAL)
+
+The head file is filtered line by line, and written to a temporary file of
+the destination directory renamed at the end: a reader never sees a partial
+head.head, and several workers may write the same file at the same time.
+The filtered content is kept in memory for each source head file (while its
+size and modification time are unchanged), since the same best head file
+of a station is used by many events; the destination is not rewritten when
+it already has the same content.
+
+"""
+import os
+import threading
+from fripipe import atomicfile
+
+prog="(headfile.py) "
+
+# keyword removed from the head files
+removed_keyword='CRVAL'
+
+# filtered heads: real path of the source -> (size, mtime, content)
+_heads={}
+_lock=threading.Lock()
+
+def strip_keyword(head_file,keyword=removed_keyword):
+    """Content of a head file without the lines containing a keyword.
+
+    Parameters
+    ----------
+    head_file : string
+        Full path of the source head file.
+    keyword : string
+        Lines containing this string are removed.
+
+    Returns
+    -------
+    content : string
+        Filtered content of the head file.
+
+    """
+    path=os.path.realpath(head_file)
+    stat=os.stat(path)
+    with _lock:
+        cached=_heads.get((path,keyword))
+    if cached is not None and cached[:2]==(stat.st_size,stat.st_mtime):
+        return cached[2]
+    with open(path) as f:
+        content=''.join(line for line in f if keyword not in line)
+    with _lock:
+        _heads[(path,keyword)]=(stat.st_size,stat.st_mtime,content)
+    return content
+
+def copy_head(head_file,local_file,keyword=removed_keyword):
+    """Copy a head file without the lines containing a keyword, atomically.
+
+    Parameters
+    ----------
+    head_file : string
+        Full path of the source head file.
+    local_file : string
+        Full path of the destination file, e.g. fits2D/head.head.
+    keyword : string
+        Lines containing this string are removed.
+
+    Returns
+    -------
+    written : boolean
+        False if local_file already had the filtered content.
+
+    Raises
+    ------
+    IOError, OSError
+        If the head file can not be read or the destination written.
+
+    """
+    content=strip_keyword(head_file,keyword)
+    if os.path.isfile(local_file):
+        with open(local_file) as f:
+            if f.read()==content:
+                return False
+    with atomicfile.open_atomic(local_file) as out:
+        out.write(content)
+    return True
@@ -0,0 +1,725 @@
+"""Ingest the detections of external meteor networks.
+
+The files of the MetRec, UFOAnalyzer, UWO and CAMS directories of
+path_and_file are read as streams, one detection at a time, and each
+detection is written as a *.met file with the columns of the FRIPON *.met
+files (metstore.met_columns: time, x, y, ra, dec, mag, NaN when missing),
+followed by az and alt when the format gives them. The files are ingested
+in parallel by a pool of processes, and a file is ingested again only when
+it is modified.
+The detections are then grouped into multiple detection events, in the
+layout read by processevent_from_arg.py: a detection whose start is within
+coincidence seconds of a FRIPON event of path_and_file.work_mult_dir joins
+it, and the detections of at least constants.min_stations stations within
+coincidence seconds of each other make a new event. Each detection becomes
+a station directory <network>-<station>_UT of its event, holding its
+<network>-<station>_UT.met file and the external_name file, so that
+processevent_from_arg.py (or batchprocess.py, eventdaemon.py) uses it
+directly for the trajectory. The location of the observing site, when the
+format gives it, is kept with the detection (in external_name); the
+stations of the detections grouped into events are added to
+path_and_file.external_station_file, read by stations.py with the FRIPON
+station file, so that their SPICE kernels are built (see spicekernels.py)
+and compute_traj places them. The detections not grouped yet are appended to
+pending_name (JSON lines), to be grouped with those of the next ingestions.
+
+Parameters
+----------
+networks : list of string, optional
+    networks to ingest, among MetRec, UFOAnalyzer, UWO and CAMS (default:
+    all).
+output : string, optional
+    directory of the *.met files (default: path_and_file.fri_detect_dir/external/).
+nworkers : integer, optional
+    number of files read in parallel (default: number of CPUs).
+
+Returns
+-------
+None :
+    The *.met files are saved in output/<network>/<yyyymm>/, named
+    <station>_<yyyymmddTHHMMSS>_<network>.met, and copied in the station
+    directories of their events.
+
+Notes
+-----
+syntax is: python ingestnetworks.py [-w network ...] [-o output] [-n nworkers]
+The time of a measurement is a julian date (UTC); the angles are in
+degrees; the missing columns are NaN.
+The site is given as latitude and longitude [deg, East positive] and
+altitude [m].
+The formats read are:
+ -CAMS: FTPdetectinfo*.txt files (CAMS and RMS); the time is that of the
+  FF file name plus frame/fps. The site is not in these files: the CAMS
+  stations have to be in the station file.
+ -UFOAnalyzer: *A.XML files; the time is that of the clip plus
+  frame/fps (fps attribute of the record, 25 if missing); the site is in
+  the lat, lng and alt attributes of the record.
+ -UWO: ASGARD ev_*.txt files; th and phi are converted to alt and az; the
+  site is in the 'latlon : latitude longitude altitude' header line.
+ -MetRec: *.inf files: '# key : value' header lines (Date, Time, Station,
+  and Latitude, Longitude, Altitude for the site), the names of the columns
+  on the last comment line, then one row per frame, the time being
+  hh:mm:ss.ss or seconds after the header time.
+"""
+import os
+import re
+import glob
+import json
+import argparse
+import datetime
+import traceback
+import multiprocessing
+import numpy as np
+from fripipe.initialize import path_and_file,constants
+from fripipe import metstore
+from fripipe import stations
+from fripipe import atomicfile
+
+prog="(ingestnetworks.py) "
+syntax="python ingestnetworks.py [-w network ...] [-o output] [-n nworkers]"
+
+# columns of the written *.met files: those of the FRIPON *.met files, then the optional ones
+met_columns=metstore.met_columns
+extra_columns=['az','alt']
+# name of the list of the ingested files, in the output directory
+ingested_name='ingested.json'
+# name of the list of the detections not grouped into an event yet, in the output directory
+pending_name='pending.jsonl'
+# pending detections older than the newest one by more than pending_days are dropped
+pending_days=30
+# maximum time between the starts of the detections of an event [s]
+coincidence=10.0
+# file of the station directory of an external detection in an event
+external_name='external.json'
+# time format of the names of the event directories
+event_format='%Y%m%dT%H%M%S'
+# julian date of the unix epoch
+jd_unix=2440587.5
+unix_epoch=datetime.datetime(1970,1,1)
+# accepted names of the columns of the text formats
+column_aliases={'time':['time','t','sec','seconds'],
+                'frame':['fr','frame','frame#','fno','no'],
+                'x':['x','cx','col','column'],
+                'y':['y','cy','row'],
+                'ra':['ra','alpha'],
+                'dec':['dec','delta'],
+                'az':['az','azim','phi'],
+                'alt':['alt','elev','ev','h'],
+                'zenith':['th','zenith','z'],
+                'mag':['mag','magnitude','m']}
+_aliases=dict((alias,name) for name,aliases in column_aliases.items() for alias in aliases)
+
+def julian_date(time):
+    """Julian date of a datetime (UTC)."""
+    return (time-unix_epoch).total_seconds()/86400.0+jd_unix
+
+class detection (object):
+    """Measurements of a meteor by a station of a network.
+
+    Parameters
+    ----------
+    network : string
+        Name of the network.
+    station : string
+        Identifier of the station (or camera).
+    start : datetime.datetime
+        Time of the first measurement (UTC).
+    table : dict
+        Column name -> numpy.ndarray, 'time' being a julian date.
+    site : tuple of float
+        Latitude, longitude [deg] and altitude [m] of the site, None if
+        unknown.
+
+    """
+    def __init__(self,network,station,start,table,site=None):
+        self.network=network
+        self.station=re.sub('[^A-Za-z0-9-]','',station) or 'unknown'
+        self.start=start
+        self.table=table
+        self.site=None
+        if site is not None and not any(np.isnan(_float(value)) for value in site):
+            self.site=tuple(_float(value) for value in site)
+
+    def met_name(self):
+        """Name of the *.met file of the detection."""
+        return '%s_%s_%s.met'%(self.station,self.start.strftime('%Y%m%dT%H%M%S'),self.network)
+
+def _float(value):
+    """Convert a value to float, NaN if it is missing or invalid."""
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return np.nan
+
+def _table(rows,names):
+    """Columns of rows of values, with normalized names."""
+    data=np.array([[_float(value) for value in row[:len(names)]] for row in rows],dtype=float)
+    data=data.reshape(len(rows),len(names))
+    return dict((_aliases.get(name.lower(),name.lower()),data[:,i]) for i,name in enumerate(names))
+
+#=================================================
+# CAMS and RMS FTPdetectinfo files
+def read_cams(filename):
+    """Stream the detections of a FTPdetectinfo file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the FTPdetectinfo file.
+
+    Returns
+    -------
+    detections : iterator of detection
+        Detections of the file.
+
+    """
+    names=['frame','x','y','ra','dec','az','alt','inten','mag']
+    with open(filename) as f:
+        lines=(line.strip() for line in f)
+        ffname=None
+        for line in lines:
+            if line.startswith('FF') and (line.endswith('.fits') or line.endswith('.bin')):
+                ffname=line
+                continue
+            words=line.split()
+            if ffname is None or len(words)<10 or not all(re.match(r'^[-+]?[\d.]+$',word) for word in words[1:]):
+                continue
+            # summary line: camera (number or station code) meteor nsegments fps ...
+            nseg=int(words[2])
+            fps=float(words[3])
+            rows=[next(lines).split() for i in range(nseg)]
+            parts=ffname.split('_')
+            start=None
+            for i in range(len(parts)-2):
+                if re.match(r'^\d{8}$',parts[i]) and re.match(r'^\d{6}$',parts[i+1]):
+                    start=datetime.datetime.strptime(parts[i]+parts[i+1],'%Y%m%d%H%M%S')
+                    start+=datetime.timedelta(milliseconds=int(parts[i+2][:3]))
+                    station=parts[i-1] if i>1 else words[0]
+                    break
+            if start is None:
+                print prog+'*** WARNING: no date in '+ffname+' of '+filename
+                ffname=None
+                continue
+            table=_table(rows,names)
+            table['time']=julian_date(start)+table.pop('frame')/fps/86400.0
+            table.pop('inten')
+            ffname=None
+            yield detection('CAMS',station,start,table)
+
+#=================================================
+# UFOAnalyzer A.XML files
+def read_ufo(filename):
+    """Stream the detections of a UFOAnalyzer A.XML file, one per object."""
+    import xml.etree.cElementTree as ElementTree
+    record=None
+    rows=[]
+    for event,elem in ElementTree.iterparse(filename,events=('start','end')):
+        tag=elem.tag.split('}')[-1]
+        if event=='start' and tag=='ufoanalyzer_record':
+            a=elem.attrib
+            seconds=_float(a.get('s',0))
+            start=datetime.datetime(int(a['y']),int(a['mo']),int(a['d']),int(a['h']),int(a['m']))
+            start+=datetime.timedelta(seconds=seconds)
+            record={'start':start,'fps':_float(a.get('fps',25)) or 25.0,
+                    'station':a.get('lid','')+a.get('sid',''),
+                    'site':(a.get('lat'),a.get('lng'),a.get('alt'))}
+        elif event=='end' and tag=='ua2_fdata2':
+            a=elem.attrib
+            rows.append([a.get(key) for key in ('fno','x','y','ra','dec','az','ev','mag')])
+            elem.clear()
+        elif event=='end' and tag=='ua2_object':
+            if rows and record is not None:
+                table=_table(rows,['frame','x','y','ra','dec','az','alt','mag'])
+                table['time']=julian_date(record['start'])+table.pop('frame')/record['fps']/86400.0
+                yield detection('UFOAnalyzer',record['station'],record['start'],table,record['site'])
+            rows=[]
+            elem.clear()
+        elif event=='end' and tag=='ufoanalyzer_record':
+            record=None
+            elem.clear()
+
+#=================================================
+# text files with '# key : value' headers: UWO ASGARD and MetRec
+def _read_header_table(filename):
+    """Read a text file: '# key : value' header lines, column names, rows.
+
+    Returns
+    -------
+    header : dict
+        Lower case key -> value of the header lines.
+    names : list of string
+        Names of the columns (last comment line that is not 'key : value').
+    rows : list of list of string
+        Rows of values.
+
+    """
+    header={}
+    names=[]
+    rows=[]
+    with open(filename) as f:
+        for line in f:
+            line=line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                content=line.lstrip('#').strip()
+                if ':' in content and not rows and len(content.split(':',1)[0].split())<=3:
+                    key,value=content.split(':',1)
+                    header[key.strip().lower()]=value.strip()
+                elif content:
+                    names=content.split()
+                continue
+            rows.append(line.split())
+    return header,names,rows
+
+def read_uwo(filename):
+    """Stream the detection of an ASGARD ev_*.txt file."""
+    header,names,rows=_read_header_table(filename)
+    if not rows or not names:
+        return
+    table=_table(rows,names)
+    if 'unix' in header:
+        unix=_float(header['unix'])
+        start=unix_epoch+datetime.timedelta(seconds=unix)
+    else:
+        start=datetime.datetime.strptime(header['time'][:24].replace(' UTC',''),'%Y%m%d %H:%M:%S.%f')
+    if 'zenith' in table:
+        table['alt']=90.0-table.pop('zenith')
+    table['time']=julian_date(start)+table.get('time',np.zeros(len(rows)))/86400.0
+    table.pop('frame',None)
+    site=header.get('latlon','').split()
+    yield detection('UWO',header.get('site',''),start,table,site[:3] if len(site)>=3 else None)
+
+def read_metrec(filename):
+    """Stream the detection of a MetRec *.inf file."""
+    header,names,rows=_read_header_table(filename)
+    if not rows or not names:
+        return
+    date=header.get('date','').replace('/','-').replace('.','-')
+    start=datetime.datetime.strptime(date+' '+header.get('time','00:00:00')[:8],'%Y-%m-%d %H:%M:%S')
+    normalized=[_aliases.get(name.lower(),name.lower()) for name in names]
+    itime=normalized.index('time') if 'time' in normalized else None
+    times=None
+    if itime is not None and ':' in rows[0][itime]:
+        # hh:mm:ss.ss, possibly after midnight
+        day=datetime.datetime(start.year,start.month,start.day)
+        times=[]
+        for row in rows:
+            h,m,s=row[itime].split(':')
+            t=day+datetime.timedelta(hours=int(h),minutes=int(m),seconds=float(s))
+            if t<start-datetime.timedelta(hours=12):
+                t+=datetime.timedelta(days=1)
+            times.append(julian_date(t))
+            row[itime]='nan'
+    table=_table(rows,names)
+    if times is not None:
+        table['time']=np.array(times)
+        start=unix_epoch+datetime.timedelta(days=times[0]-jd_unix)
+    else:
+        table['time']=julian_date(start)+table.get('time',np.zeros(len(rows)))/86400.0
+    table.pop('frame',None)
+    site=[header.get(key) for key in ('latitude','longitude','altitude')]
+    yield detection('MetRec',header.get('station',header.get('camera','')),start,table,
+                    site if None not in site else None)
+
+# networks: name -> (directory setting, file patterns, reader)
+networks={'CAMS':('CAMS_dir',['FTPdetectinfo*.txt'],read_cams),
+          'UFOAnalyzer':('UFO_dir',['*A.XML','*A.xml'],read_ufo),
+          'UWO':('UWO_dir',['ev_*.txt'],read_uwo),
+          'MetRec':('MetRec_dir',['*.inf'],read_metrec)}
+
+def write_met(met_file,table):
+    """Write the measurements of a detection, atomically.
+
+    Parameters
+    ----------
+    met_file : string
+        Full path of the *.met file.
+    table : dict
+        Column name -> numpy.ndarray.
+
+    Returns
+    -------
+    None.
+
+    """
+    nan=np.nan*np.ones(len(table['time']))
+    columns=met_columns+[name for name in extra_columns if name in table]
+    data=np.column_stack([table.get(name,nan) for name in columns])
+    with atomicfile.open_atomic(met_file) as out:
+        np.savetxt(out,data,fmt=['%.10f']+['%.6f']*(len(columns)-1),header=' '.join(columns))
+
+def ingest_file(args):
+    """Write the *.met files of the detections of a file.
+
+    Parameters
+    ----------
+    args : tuple
+        (network, filename, output): network, full path of the file and
+        output directory.
+
+    Returns
+    -------
+    filename : string
+        Full path of the file.
+    detections : list of dict
+        network, station, start (ISO 8601) and met_file of each detection
+        written, and latitude, longitude, altitude of its site if known.
+    nrows : integer
+        Number of measurements written.
+    errmsg : string
+        Error message, None if the file was ingested.
+
+    """
+    network,filename,output=args
+    reader=networks[network][2]
+    detections=[]
+    nrows=0
+    try:
+        for det in reader(filename):
+            outdir=os.path.join(output,network,det.start.strftime('%Y%m'))
+            if not os.path.isdir(outdir):
+                try:
+                    os.makedirs(outdir)
+                except OSError:
+                    if not os.path.isdir(outdir):
+                        raise
+            met_file=os.path.join(outdir,det.met_name())
+            write_met(met_file,det.table)
+            detections.append({'network':network,'station':det.station,
+                               'start':det.start.isoformat(),'met_file':met_file})
+            if det.site is not None:
+                detections[-1].update(zip(('latitude','longitude','altitude'),det.site))
+            nrows+=len(det.table['time'])
+    except Exception:
+        return filename,detections,nrows,traceback.format_exc()
+    return filename,detections,nrows,None
+
+def list_files(network):
+    """Files of a network, in its path_and_file directory."""
+    setting,patterns,reader=networks[network]
+    directory=getattr(path_and_file,setting)
+    files=set()
+    for pattern in patterns:
+        files.update(glob.glob(os.path.join(directory,pattern)))
+        files.update(glob.glob(os.path.join(directory,'*',pattern)))
+        files.update(glob.glob(os.path.join(directory,'*','*',pattern)))
+    return sorted(files)
+
+def ingest(names=None,output=None,nworkers=1):
+    """Ingest the new or modified files of networks.
+
+    Parameters
+    ----------
+    names : list of string
+        Networks to ingest (default: all).
+    output : string
+        Directory of the *.met files (default: fri_detect_dir/external/).
+    nworkers : integer
+        Number of files read in parallel.
+
+    Returns
+    -------
+    counts : dict
+        Network -> [number of files, of detections, of measurements].
+
+    """
+    if names is None:
+        names=sorted(networks)
+    if output is None:
+        output=os.path.join(path_and_file.fri_detect_dir,'external')
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    ledgerfile=os.path.join(output,ingested_name)
+    try:
+        with open(ledgerfile) as f:
+            ledger=json.load(f)
+    except (IOError,ValueError):
+        ledger={}
+    units=[]
+    for network in names:
+        for filename in list_files(network):
+            if ledger.get(filename)!=os.path.getmtime(filename):
+                units.append((network,filename,output))
+    print prog+str(len(units))+' new or modified files of '+' '.join(names)
+    counts=dict((network,[0,0,0]) for network in names)
+    pendingfile=os.path.join(output,pending_name)
+    pending=_read_pending(pendingfile)
+    if units:
+        pool=multiprocessing.Pool(max(1,min(nworkers,len(units))))
+        networkof=dict((unit[1],unit[0]) for unit in units)
+        # the new detections are appended to the pending ones, before their file is in the ledger
+        journal=open(pendingfile,'a')
+        try:
+            for i,(filename,detections,nrows,errmsg) in enumerate(pool.imap_unordered(ingest_file,units)):
+                if errmsg is not None:
+                    print prog+'*** WARNING: unable to ingest '+filename+':\n'+errmsg
+                    continue
+                pending+=detections
+                for det in detections:
+                    journal.write(json.dumps(det,sort_keys=True)+'\n')
+                counts[networkof[filename]][0]+=1
+                counts[networkof[filename]][1]+=len(detections)
+                counts[networkof[filename]][2]+=nrows
+                ledger[filename]=os.path.getmtime(filename)
+                # the ledger is saved regularly: an interrupted ingestion is resumed
+                if (i%100==99):
+                    journal.flush()
+                    _save_ledger(ledgerfile,ledger)
+        finally:
+            pool.close()
+            pool.join()
+            journal.close()
+            _save_ledger(ledgerfile,ledger)
+        for network in names:
+            print prog+network+': %d files, %d detections, %d measurements ingested'%tuple(counts[network])
+    # group the new and the pending detections into events, also those of the previous
+    # ingestions: a FRIPON event may have been created since
+    # a file ingested again gives its detections again
+    pending=dict((det['met_file'],det) for det in pending).values()
+    events,pending=group_events(pending)
+    for event_dir,detections in sorted(events.items()):
+        for det in detections:
+            write_station(event_dir,det)
+    register_stations([det for detections in events.values() for det in detections])
+    print prog+str(sum(len(detections) for detections in events.values()))+' detections added to '+\
+        str(len(events))+' events, '+str(len(pending))+' detections pending'
+    _save_pending(pendingfile,pending)
+    return counts
+
+def _start(det):
+    """Start of a detection, as a datetime."""
+    return datetime.datetime.strptime(det['start'][:19],'%Y-%m-%dT%H:%M:%S')
+
+def fripon_events(months):
+    """Multiple detection events of months, in path_and_file.work_mult_dir.
+
+    Parameters
+    ----------
+    months : list of string
+        yyyymm of the months.
+
+    Returns
+    -------
+    events : list of tuple
+        (time, full path of the event directory), sorted by time.
+
+    """
+    events=[]
+    for yyyymm in sorted(set(months)):
+        for event_dir in glob.glob(os.path.join(path_and_file.work_mult_dir,yyyymm,'*_UT')):
+            try:
+                time=datetime.datetime.strptime(os.path.basename(event_dir)[:15],event_format)
+            except ValueError:
+                continue
+            events.append((time,event_dir))
+    return sorted(events)
+
+def group_events(detections,window=coincidence,min_stations=None):
+    """Group detections into multiple detection events.
+
+    A detection starting within window seconds of an existing event joins
+    the closest one. The other detections are chained by time, two
+    detections being in the same group if their starts are within window
+    seconds; a group of at least min_stations stations makes a new event,
+    named after its first start.
+
+    Parameters
+    ----------
+    detections : list of dict
+        Detections, see ingest_file.
+    window : float
+        Maximum time between the starts of the detections of an event [s].
+    min_stations : integer
+        Minimum number of stations of a new event (default:
+        constants.min_stations).
+
+    Returns
+    -------
+    events : dict
+        Full path of the event directory -> list of its detections.
+    pending : list of dict
+        Detections not grouped, newer than pending_days before the newest
+        detection.
+
+    """
+    if min_stations is None:
+        min_stations=constants.min_stations
+    if not detections:
+        return {},[]
+    detections=sorted(detections,key=_start)
+    delta=datetime.timedelta(seconds=window)
+    months=set()
+    for det in detections:
+        for time in (_start(det)-delta,_start(det)+delta):
+            months.add(time.strftime('%Y%m'))
+    existing=fripon_events(months)
+    times=[time for time,event_dir in existing]
+    events={}
+    alone=[]
+    for det in detections:
+        start=_start(det)
+        # closest existing event
+        i=np.searchsorted(np.array(times,dtype='datetime64[us]'),np.datetime64(start,'us'))
+        near=[existing[j] for j in (i-1,i) if 0<=j<len(existing) and abs(existing[j][0]-start)<=delta]
+        if near:
+            event_dir=min(near,key=lambda event:abs(event[0]-start))[1]
+            events.setdefault(event_dir,[]).append(det)
+        else:
+            alone.append(det)
+    # chain the other detections by time
+    groups=[]
+    for det in alone:
+        if groups and _start(det)-_start(groups[-1][-1])<=delta:
+            groups[-1].append(det)
+        else:
+            groups.append([det])
+    pending=[]
+    for group in groups:
+        if len(set((det['network'],det['station']) for det in group))>=min_stations:
+            start=_start(group[0])
+            event_dir=os.path.join(path_and_file.work_mult_dir,start.strftime('%Y%m'),
+                                   start.strftime(event_format)+'_UT')
+            events.setdefault(event_dir,[]).extend(group)
+        else:
+            pending+=group
+    oldest=_start(detections[-1])-datetime.timedelta(days=pending_days)
+    return events,[det for det in pending if _start(det)>=oldest]
+
+def station_name(det):
+    """Name of the station directory of an external detection in its event."""
+    return det['network']+'-'+det['station']+'_UT'
+
+def write_station(event_dir,det):
+    """Write the station directory of an external detection in its event.
+
+    Parameters
+    ----------
+    event_dir : string
+        Full path of the event directory.
+    det : dict
+        Detection, see ingest_file.
+
+    Returns
+    -------
+    met_file : string
+        Full path of the *.met file of the station directory.
+
+    """
+    name=station_name(det)
+    station=os.path.join(event_dir,name)
+    if not os.path.isdir(station):
+        try:
+            os.makedirs(station)
+        except OSError:
+            if not os.path.isdir(station):
+                raise
+    met_file=os.path.join(station,name+'.met')
+    atomicfile.copy_atomic(det['met_file'],met_file)
+    with atomicfile.open_atomic(os.path.join(station,external_name)) as out:
+        json.dump(det,out,indent=1,sort_keys=True)
+    return met_file
+
+def external_met(station):
+    """*.met file of the station directory of an external detection.
+
+    Parameters
+    ----------
+    station : string
+        Full path of a station directory of an event.
+
+    Returns
+    -------
+    met_file : string
+        Full path of its *.met file, None if the station directory is not
+        that of an external detection.
+
+    """
+    name=os.path.basename(station.rstrip('/'))
+    met_file=os.path.join(station,name+'.met')
+    if os.path.isfile(os.path.join(station,external_name)) and os.path.isfile(met_file):
+        return met_file
+    return None
+
+def register_stations(detections):
+    """Add the stations of external detections to path_and_file.external_station_file.
+
+    Parameters
+    ----------
+    detections : list of dict
+        Detections, see ingest_file; those without site are not registered.
+
+    Returns
+    -------
+    nstations : integer
+        Number of stations added or whose site changed.
+
+    """
+    stationfile=path_and_file.external_station_file
+    rows={}
+    if os.path.isfile(stationfile):
+        for stn in stations.read_station_file(stationfile) or []:
+            rows[stn.code]=(stn.latitude,stn.longitude,stn.altitude)
+    changed=0
+    unknown=set()
+    for det in detections:
+        code=station_name(det)[:-len('_UT')]
+        if 'latitude' not in det:
+            if code not in rows:
+                unknown.add(code)
+            continue
+        site=(det['latitude'],det['longitude'],det['altitude'])
+        if rows.get(code)!=site:
+            rows[code]=site
+            changed+=1
+    if changed:
+        directory=os.path.dirname(stationfile)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with atomicfile.open_atomic(stationfile) as out:
+            out.write('# code name latitude longitude altitude\n')
+            for code in sorted(rows):
+                out.write('%s %s %.6f %.6f %.1f\n'%((code,code)+rows[code]))
+        print prog+str(changed)+' stations written in '+stationfile
+    if unknown:
+        print prog+'*** WARNING: no site for stations '+' '.join(sorted(unknown))+\
+            ': they have to be in the station file'
+    return changed
+
+def _read_pending(pendingfile):
+    """Read the pending detections, once each."""
+    pending={}
+    if os.path.isfile(pendingfile):
+        with open(pendingfile) as f:
+            for line in f:
+                try:
+                    det=json.loads(line)
+                except ValueError:
+                    # last line of an interrupted ingestion
+                    continue
+                pending[det['met_file']]=det
+    return [pending[met_file] for met_file in sorted(pending)]
+
+def _save_pending(pendingfile,pending):
+    """Save the pending detections atomically, as JSON lines."""
+    with atomicfile.open_atomic(pendingfile) as out:
+        for det in pending:
+            out.write(json.dumps(det,sort_keys=True)+'\n')
+
+def _save_ledger(ledgerfile,ledger):
+    """Save the list of the ingested files atomically."""
+    with atomicfile.open_atomic(ledgerfile) as out:
+        json.dump(ledger,out,indent=0,sort_keys=True)
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('-w','--networks',nargs='+',default=None,choices=sorted(networks),
+                        help='networks to ingest')
+    parser.add_argument('-o','--output',default=None,help='directory of the *.met files')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of files read in parallel')
+    args=parser.parse_args()
+    ingest(args.networks,args.output,args.nworkers)
@@ -4,205 +4,440 @@ Author : FRIPON project
 Copyright : Observatoire de Paris, FRIPON
 Free license
 
-Purpose: 
+Purpose:
  -Initializes fundamental data for the FRIPON pipeline
  -load spice kernels
 
+Nothing is done at import: every path, existence check, astropy quantity
+and SPICE value is resolved on first use, and only once per process.
+The paths and settings of path_and_file (and the plain settings of
+constants) may be overridden, in this order of precedence:
+ -by an environment variable FRIPIPE_<NAME>, e.g. FRIPIPE_DATA_DIR=/scratch/
+ -by the [path_and_file] or [constants] section of the configuration file
+  given by FRIPIPE_CONFIG (default: ~/.fripipe/fripipe.cfg)
+Overriding a base path (e.g. data_dir) moves all the paths derived from it.
+
+SPICE contract: the kernels are not loaded at import. Every program that
+uses SPICE, directly or through code calling spiceypy itself (compute_traj,
+position2met, the private section), has to call load_spice() once at start,
+and in the initializer of its pools of processes. The modules sp, u and np
+are still exported: they are imported on first use, and the kernels are
+loaded on the first use of sp.
+
 """
 import os, sys
-import numpy as np
-import astropy.units as u
-import spiceypy as sp
-import numpy as np
+import string
+import importlib
+import ConfigParser
+
+prog="(initialize.py) "
+
+# configuration file, read once on first use
+config_file=os.environ.get('FRIPIPE_CONFIG',os.path.expanduser('~/.fripipe/fripipe.cfg'))
+_config_parser=None
+
+# kinds of existence checks of the paths and files
+must_dir='must_dir'
+opt_dir='opt_dir'
+must_file='must_file'
+opt_file='opt_file'
+
+def _config_override(section,name):
+    """Get the value of a setting overridden by the user.
+
+    Parameters
+    ----------
+    section : string
+        Section of the configuration file: 'path_and_file' or 'constants'.
+    name : string
+        Name of the setting.
+
+    Returns
+    -------
+    value : string
+        Overriding value, None if the setting is not overridden.
+
+    """
+    global _config_parser
+    env='FRIPIPE_'+name.upper()
+    if env in os.environ:
+        return os.environ[env]
+    if _config_parser is None:
+        _config_parser=ConfigParser.SafeConfigParser()
+        _config_parser.optionxform=str
+        _config_parser.read(config_file)
+    if _config_parser.has_option(section,name):
+        return _config_parser.get(section,name)
+    return None
+
+def _check_path(path,kind):
+    """Check the existence of a path.
+
+    Missing mandatory directories and files are fatal errors, missing
+    optional ones only raise a warning.
+
+    Parameters
+    ----------
+    path : string
+        Directory or file name.
+    kind : string
+        One of must_dir, opt_dir, must_file, opt_file.
+
+    Returns
+    -------
+    None.
+
+    """
+    if kind in (must_dir,opt_dir):
+        exists=os.path.isdir(path)
+        what='directory '
+    else:
+        exists=os.path.isfile(path)
+        what='file '
+    if exists:
+        return
+    if kind in (must_dir,must_file):
+        sys.exit(prog+'*** FATAL ERROR: '+what+path+' does not exist')
+    print prog+'*** WARNING: '+what+path+' does not exist'
+
+
+class _lazy (object):
+    """Setting computed on first access, then stored on the instance.
+
+    Parameters
+    ----------
+    func : function
+        Computes the value of the setting from the configuration object.
+    check : string
+        Kind of existence check performed once the value is resolved
+        (must_dir, opt_dir, must_file, opt_file), None for no check.
+    override : type
+        Type of the value when overridden by the user, None if the setting
+        can not be overridden.
+
+    """
+    def __init__(self,func,check=None,override=None):
+        self.func=func
+        self.check=check
+        self.override=override
+        self.name=None
+
+    def __get__(self,obj,cls):
+        if obj is None:
+            return self
+        value=None
+        if self.override is not None:
+            value=_config_override(obj.section,self.name)
+        if value is None:
+            value=self.func(obj)
+        else:
+            value=self.override(value)
+        obj.__dict__[self.name]=value
+        if self.check is not None and obj.check:
+            _check_path(value,self.check)
+        return value
+
+def _value(value):
+    """Plain setting, that may be overridden by the user."""
+    return _lazy(lambda obj:value,override=type(value))
+
+def _path(template,check=None):
+    """Path built from other settings, that may be overridden by the user.
+
+    Parameters
+    ----------
+    template : string
+        Path template, e.g. '{data_dir}stations/'.
+    check : string
+        Kind of existence check (must_dir, opt_dir, must_file, opt_file).
+
+    """
+    return _lazy(lambda obj:string.Formatter().vformat(template,(),_settings(obj)),
+                 check=check,override=str)
+
+def _units(func):
+    """Astropy quantity, built on first use: astropy is imported only then."""
+    def build(obj):
+        import astropy.units as u
+        return func(u)
+    return _lazy(build)
+
+def _spice(func):
+    """Value computed from SPICE: the kernels are loaded on first use."""
+    def build(obj):
+        import astropy.units as u
+        return func(load_spice(),u)
+    return _lazy(build)
+
+
+class _settings (object):
+    """Mapping view of a configuration object, used to format the paths."""
+    def __init__(self,obj):
+        self.obj=obj
+    def __getitem__(self,name):
+        return getattr(self.obj,name)
+
+
+class _configuration (object):
+    """Base class of the lazily resolved configuration objects."""
+    section=''
 
+    def __init__(self):
+        for name,attr in type(self).__dict__.items():
+            if isinstance(attr,_lazy):
+                attr.name=name
 
-class path_and_file (object):
+    def settings(self):
+        """List the names of all the settings."""
+        return sorted(name for name,attr in type(self).__dict__.items()
+                      if isinstance(attr,_lazy))
+
+    def verify(self):
+        """Resolve all the settings, performing all the existence checks."""
+        for name in self.settings():
+            getattr(self,name)
+
+
+class _path_and_file (_configuration):
+    section='path_and_file'
     # performs check of existence of directories and files
-    check = 1
+    check = _value(1)
     # control =1 for debug purpose
-    fri_debug = 0
-    
+    fri_debug = _value(0)
+
     # FRIPON  data directory
     # data directory
-    data_dir = '/data/'
+    data_dir = _path('/data/',must_dir)
     # svn path
-    svn_path = data_dir+'friponsvn/'
+    svn_path = _path('{data_dir}friponsvn/',must_dir)
     # stations directory
-    fri_station_dir = data_dir+'stations/'
+    fri_station_dir = _path('{data_dir}stations/',must_dir)
     # station metadata directory
-    fri_meta_dir = data_dir + 'metadata/'
+    fri_meta_dir = _path('{data_dir}metadata/')
     # processed calibration images directory
-    fri_proc_dir = data_dir + 'processed/stations/'
+    fri_proc_dir = _path('{data_dir}processed/stations/')
     # detections director
-    fri_detect_dir = data_dir+'detections/'
+    fri_detect_dir = _path('{data_dir}detections/',must_dir)
     # multiple detections directory
-    fri_data_dir = fri_detect_dir+'multiple/'
-    
+    fri_data_dir = _path('{fri_detect_dir}multiple/',must_dir)
+
     # OTHER METEOR MEASUREMENTS-FORMAT directory
     # MetRec data dir. (S. Molau, IMO)
-    MetRec_dir = fri_detect_dir+'/MetRec/'
+    MetRec_dir = _path('{fri_detect_dir}/MetRec/',opt_dir)
     # UFOAnalyzer data dir. (SonotaCo, NMS)
-    UFO_dir = fri_detect_dir+'/UFOAnalyzer/'
+    UFO_dir = _path('{fri_detect_dir}/UFOAnalyzer/',opt_dir)
     # UWO data dir. (R. Weryk, D. Vida, UWO)
-    UWO_dir = fri_detect_dir+'/UWO/'
+    UWO_dir = _path('{fri_detect_dir}/UWO/',opt_dir)
     # CAMS data dir. (P. Gural, P. Jenniskens)
-    CAMS_dir = fri_detect_dir+'/CAMS/'
-    
+    CAMS_dir = _path('{fri_detect_dir}/CAMS/',opt_dir)
+
     # fripipe directory
-    fri_pipeline_path = svn_path+'/fripipe/'
+    fri_pipeline_path = _path('{svn_path}/fripipe/',must_dir)
     # fripipe data directory
-    fri_pipeline_data_path = svn_path+'/fripipe_data/'
+    fri_pipeline_data_path = _path('{svn_path}/fripipe_data/',must_dir)
     # fripipe configuration directory
-    fri_conf_dir = fri_pipeline_path+'conf/'
+    fri_conf_dir = _path('{fri_pipeline_path}conf/',must_dir)
     # fripipe AFM configuration directory
-    fri_conf_afm_dir = fri_conf_dir+'AFM/'
+    fri_conf_afm_dir = _path('{fri_conf_dir}AFM/',opt_dir)
     # fripipe scripts directory
-    fripipe_script_path = svn_path+'scripts/'
+    fripipe_script_path = _path('{svn_path}scripts/',opt_dir)
     # fripipe shell script directory
-    fripipe_shell_path = fripipe_script_path+'shell/'
+    fripipe_shell_path = _path('{fripipe_script_path}shell/',opt_dir)
     # fripipe topographic data directory
-    topo_data_path = fri_pipeline_data_path+'Topography/'
+    topo_data_path = _path('{fri_pipeline_data_path}Topography/',opt_dir)
     # fripipe French IGN topographic data directory
-    topo_IGN_data_path = topo_data_path+'IGN/MNT/'
+    topo_IGN_data_path = _path('{topo_data_path}IGN/MNT/')
     # fripipe All weather data directory
-    weather_data_path = fri_pipeline_data_path+'Weather/'
+    weather_data_path = _path('{fri_pipeline_data_path}Weather/',opt_dir)
     # MeteoFrance weather directory
-    MeteoFrance_path = weather_data_path+'MeteoFrance/'
+    MeteoFrance_path = _path('{weather_data_path}MeteoFrance/')
     # MeteoFrance weather data directory
-    MeteoFrance_data_path = MeteoFrance_path+'Data/'
+    MeteoFrance_data_path = _path('{MeteoFrance_path}Data/',opt_dir)
     # University of Wyoming weather data directory
-    UWyoming_path = weather_data_path+'/UWyoming/'
+    UWyoming_path = _path('{weather_data_path}/UWyoming/')
     # University of Wyoming weather data directory
-    UWyoming_data_path = UWyoming_path+'Data/'
+    UWyoming_data_path = _path('{UWyoming_path}Data/',opt_dir)
     # University of Wyoming weather data directory
-    UWyoming_station_file = UWyoming_path+'snstns.tbl'
+    UWyoming_station_file = _path('{UWyoming_path}snstns.tbl',opt_file)
     # SPICE librairy executable directory:
     # useful to generate frame kernels of the stations
     # and instrument kernels of the cameras
-    spice_exe_path = fri_pipeline_path+'spicexe/'
-    
+    spice_exe_path = _path('{fri_pipeline_path}spicexe/',must_dir)
+
+    # engine measuring the meteor on the fits2D frames: 'sextractor', or 'numpy'
+    # (in-process, see centroid.py, SExtractor if it fails; not validated yet)
+    centroid_engine = _value('sextractor')
     # SExtractor program
-    sex_exe = '/usr/bin/sextractor '
+    sex_exe = _value('/usr/bin/sextractor ')
+    # SExtractor configuration directory
+    sex_conf_dir = _path('{fri_conf_dir}sextractor/')
+    # shared cache of the SExtractor catalogs (see catacache.py)
+    cata_cache_dir = _path('{work_data_dir}cata_cache/')
+    # maximum size of the SExtractor catalog cache [bytes], 0 to disable it
+    cata_cache_size = _value(20*1024**3)
     # SCAMP program
-    scamp_exe = '/usr/local/bin/scamp '
+    scamp_exe = _value('/usr/local/bin/scamp ')
     # SCAMP star catalog
-    scamp_ASTREFCAT_NAME = fri_conf_dir + 'scamp/hip_main_cut3.ldac '
-    
+    scamp_ASTREFCAT_NAME = _path('{fri_conf_dir}scamp/hip_main_cut3.ldac ')
+
     # private directory
-    private_dir = ''.join([fri_pipeline_path,'/private/'])
-    
+    private_dir = _path('{fri_pipeline_path}/private/')
+
     # work paths
     # work data directory
-    work_data_dir = data_dir
+    work_data_dir = _path('{data_dir}',must_dir)
     # pipeline Fakeor directory
-    fripipe_fakeor_path = fri_pipeline_path+'fakeor/'
+    fripipe_fakeor_path = _path('{fri_pipeline_path}fakeor/',opt_dir)
     # data detection directory
-    work_detc_dir = work_data_dir+'detections/'
+    work_detc_dir = _path('{work_data_dir}detections/',must_dir)
     # data multiple detection data directory
-    work_mult_dir = work_detc_dir+'multiple/'
+    work_mult_dir = _path('{work_detc_dir}multiple/',must_dir)
     # data Fakeor directory
-    work_fake_dir = work_data_dir+'Fakeor/'
+    work_fake_dir = _path('{work_data_dir}Fakeor/',opt_dir)
     # data meteor entry simulation directory
-    work_simu_dir = work_fake_dir+'AFM_simul/'
+    work_simu_dir = _path('{work_fake_dir}AFM_simul/',opt_dir)
     # pipeline F90 directory
-    fripipe_f90_path = fripipe_fakeor_path+'F90/'
+    fripipe_f90_path = _path('{fripipe_fakeor_path}F90/',opt_dir)
     # pipeline radiant F90 program
-    work_radiant_exe = fripipe_f90_path+'radiant'
+    work_radiant_exe = _path('{fripipe_f90_path}radiant',opt_file)
     # pipeline fakeor simulation program directory
-    work_afm_dir = fripipe_fakeor_path+'AFM/'
+    work_afm_dir = _path('{fripipe_fakeor_path}AFM/',opt_dir)
     # fakeor simulation program executable file
-    work_afm_exe = work_afm_dir+'exe/AFM.x'
+    work_afm_exe = _path('{work_afm_dir}exe/AFM.x',opt_file)
     # fakeor data directory
-    data_fakeor_dir = 'Fakeor/'
+    data_fakeor_dir = _value('Fakeor/')
     # fakeor default simulation configuration file
-    work_simu_cnf = fri_conf_afm_dir+'4FRIPON.cnf'
-    
+    work_simu_cnf = _path('{fri_conf_afm_dir}4FRIPON.cnf',opt_file)
+
+    # station file, from the private section of the code
+    fri_station_file = _lazy(lambda obj:_private_file('fri_station_file'),override=str)
+    # station file of the stations of the external networks (see ingestnetworks.py)
+    external_station_file = _path('{fri_detect_dir}external/stations.txt')
+
     # SPICE
     # path to SPICE kernels
-    kernel_path = fri_pipeline_path+'/conf/kernels/'
-    # spice meta-kernel to load
-    spicekernel = kernel_path+'standard.ker'
-    # loads spice meta-kernel
-    sp.furnsh(spicekernel)
+    kernel_path = _path('{fri_pipeline_path}/conf/kernels/')
+    # spice meta-kernel to load, see load_spice
+    spicekernel = _path('{kernel_path}standard.ker',must_file)
+    # planetary constants kernel used to build the station kernels
+    spice_pck_file = _path('{kernel_path}pck00010.tpc')
+    # kernels of the stations and their cameras, one directory per version (see spicekernels.py)
+    station_kernel_dir = _path('{work_data_dir}kernels/stations/')
+    # meta-kernel of the current version of the station kernels, loaded by load_spice
+    station_metakernel = _path('{station_kernel_dir}stations.tm')
     # Note: the FRIPON metakernel is loaded in the private section of the code
-    
+
     # FRIPON camera data features
     # dimension of detector in pixels
-    fri_detector_dim =[1000,1000]*u.pix
+    fri_detector_dim = _units(lambda u:[1000,1000]*u.pix)
     # number of frame per second
-    fri_fps = 30.0 / u.s
+    fri_fps = _units(lambda u:30.0 / u.s)
     # mean astrometry precision reached by the measurement CHANGE THIS!!!
-    fri_astro_acc_pix = 0.1*u.pix
+    fri_astro_acc_pix = _units(lambda u:0.1*u.pix)
     # mean astrometry precision reached by the measurement CHANGE THIS!!!
-    fri_astro_acc_deg =0.1*u.deg
+    fri_astro_acc_deg = _units(lambda u:0.1*u.deg)
     # Limiting Magnitude CHANGE THIS!!!
-    fri_LimMag =0.0*u.mag
-    
+    fri_LimMag = _units(lambda u:0.0*u.mag)
+
     # Fakeor noise law
     # fakeor systematic noise law. choice is: 'sin'
-    fkr_noise_law ="sin"
+    fkr_noise_law = _value("sin")
     # fakeor systematic noise value
-    fkr_noise_acc =1.0/60.0*u.deg
-    
-    
-    # tests of existence of the paths and files
-    if check:
-        must_dirs = [data_dir,svn_path,fri_station_dir,fri_detect_dir,fri_data_dir,
-                 fri_conf_dir,spice_exe_path,fri_pipeline_path,fri_pipeline_data_path,
-                 work_data_dir,fri_pipeline_path,work_detc_dir,work_mult_dir]
-        opt_dirs  = [
-                 topo_data_path,weather_data_path,fripipe_script_path,
-                 fripipe_shell_path,fri_conf_afm_dir,
-                 fripipe_fakeor_path,work_fake_dir,
-                 work_simu_dir,fripipe_f90_path,work_afm_dir,
-                 MeteoFrance_data_path,UWyoming_data_path,
-                 MetRec_dir,UFO_dir,UWO_dir,CAMS_dir]
-        must_file = [spicekernel]
-        opt_file  = [work_afm_exe,work_radiant_exe,work_simu_cnf,
-                 UWyoming_station_file]
-    
-        for path in must_dirs:
-            if not os.path.isdir(path):
-                sys.exit(prog+'*** FATAL ERROR: directory '+path+
-                        ' does not exist')
-        for fil in must_file:
-            if not os.path.isfile(fil):
-                sys.exit(prog+'*** FATAL ERROR: file '+fil+
-                        ' does not exist')
-        for path in opt_dirs:
-            if not os.path.isdir(path):
-                print prog+'*** WARNING: directory '+path+' does not exist'
-        for fil in opt_file:
-            if not os.path.isfile(fil):
-                print prog+'*** WARNING: file '+fil+' does not exist'
-
+    fkr_noise_acc = _units(lambda u:1.0/60.0*u.deg)
 
 
 # set some useful variables
-class constants (object):
+class _constants (_configuration):
+    section='constants'
     # acceleration of gravity at the equator
-    g_equ = 9.780 * u.m / u.s/u.s
+    g_equ = _units(lambda u:9.780 * u.m / u.s/u.s)
     # acceleration of gravity at the pole
-    g_pol = 9.8321849378*u.m/u.s/u.s
+    g_pol = _units(lambda u:9.8321849378*u.m/u.s/u.s)
     # acceleration of gravity at 45deg lat
-    g_45 = 9.8306 *u.m/u.s/u.s
+    g_45 = _units(lambda u:9.8306 *u.m/u.s/u.s)
     # acceleration of gravity [m/s/s]
-    g = 9.81 *u.m/u.s/u.s
+    g = _units(lambda u:9.81 *u.m/u.s/u.s)
     # (mean) Earth angular velocity [rad/s]
-    w_pla = (2*np.pi)/86164.0 *u.rad/u.s
+    w_pla = _units(lambda u:(2*3.141592653589793)/86164.0 *u.rad/u.s)
     # Earth equatorial radius [m], from SPICE
-    R_pla = sp.bodvrd( "EARTH", "RADII", 3)[1][0]*u.km
+    R_pla = _spice(lambda sp,u:sp.bodvrd( "EARTH", "RADII", 3)[1][0]*u.km)
     # shape of the Earth ellipsoid [m,m,m], from SPICE
-    abc_pla = sp.bodvrd("EARTH","RADII",3)[1]*u.km
+    abc_pla = _spice(lambda sp,u:sp.bodvrd("EARTH","RADII",3)[1]*u.km)
     # flatness coefficient (frmm SPICE)
-    f_pla = (abc_pla[1]-abc_pla[2])/abc_pla[1]
+    f_pla = _lazy(lambda obj:(obj.abc_pla[1]-obj.abc_pla[2])/obj.abc_pla[1])
     # default meteoroid volumic mass [kg/m^3]
-    rhometeor = 3000.0 * u.kg/(u.m*u.m*u.m)
+    rhometeor = _units(lambda u:3000.0 * u.kg/(u.m*u.m*u.m))
     # altitude below which the Dark Flight is computed
-    max_alt_DF = 40*u.km
+    max_alt_DF = _units(lambda u:40*u.km)
     # Dark Flight: integration step in altitude [m]
-    dh = -100.0 *u.m
+    dh = _units(lambda u:-100.0 *u.m)
     # altitude below which the height above ground is computed (DrkFlgt)
-    gnd_alt_thld = 5000.0*u.m
+    gnd_alt_thld = _units(lambda u:5000.0*u.m)
     # default number of clones for the dark flight computation
-    nclone	= 10
+    nclone = _value(10)
+    # minimum number of stations with a *.met file to compute a trajectory
+    min_stations = _value(2)
+
+
+def _private_file(name):
+    """Get a file name defined in the private section of the code."""
+    try:
+        from fripipe.private import privatefiles
+    except ImportError:
+        return ''
+    return getattr(privatefiles,name,'')
+
+# SPICE module, once the meta-kernel is loaded
+_sp=None
+
+def load_spice():
+    """Load the SPICE meta-kernel, once per process.
+
+    The meta-kernel of the stations (path_and_file.station_metakernel) is
+    loaded too if it exists, and loaded again if a new version of the
+    station kernels was built since (see spicekernels.py).
+
+    Returns
+    -------
+    sp : module
+        spiceypy module, with the path_and_file.spicekernel meta-kernel loaded.
+
+    """
+    global _sp
+    if _sp is None:
+        import spiceypy as sp
+        # loads spice meta-kernel
+        sp.furnsh(path_and_file.spicekernel)
+        _sp=sp
+    from fripipe import spicekernels
+    spicekernels.load(_sp)
+    return _sp
+
+
+class _module (object):
+    """Module imported on the first use of one of its attributes.
+
+    Parameters
+    ----------
+    load : function
+        Imports and returns the module.
+
+    """
+    def __init__(self,load):
+        self._load=load
+        self._module=None
+
+    def __getattr__(self,name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._module is None:
+            self._module=self._load()
+        return getattr(self._module,name)
+
+
+path_and_file = _path_and_file()
+constants = _constants()
+# modules exported by 'from fripipe.initialize import *', imported on first use
+sp = _module(load_spice)
+u = _module(lambda:importlib.import_module('astropy.units'))
+np = _module(lambda:importlib.import_module('numpy'))
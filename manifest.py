@@ -0,0 +1,228 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Record, for each processing stage, the inputs, tool versions and outputs
+ -tell which stages have to be run again
+
+A manifest is a JSON file saved in the directory it describes (a station
+directory, or the Trajectory directory of an event). For each stage it
+records the size, modification time and SHA-1 hash of every input file,
+the parameters and tool versions, and the output files. A stage is up to
+date if none of these changed and all its outputs still exist. The hash of
+an input file is computed again only if its size or modification time
+changed since the previous run.
+
+"""
+import os
+import json
+import hashlib
+import inspect
+from fripipe import atomicfile
+
+prog="(manifest.py) "
+
+# name of the manifest file
+manifest_name='.fripipe_manifest.json'
+# name to force all stages
+all_stages='all'
+
+# in-process cache of the tool versions
+_tool_versions={}
+
+def filehash(filename,blocksize=1<<20):
+    """SHA-1 hash of the content of a file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the file.
+    blocksize : integer
+        Size of the blocks read, in bytes.
+
+    Returns
+    -------
+    sha1 : string
+        Hexadecimal SHA-1 hash.
+
+    """
+    sha1=hashlib.sha1()
+    with open(filename,'rb') as f:
+        block=f.read(blocksize)
+        while block:
+            sha1.update(block)
+            block=f.read(blocksize)
+    return sha1.hexdigest()
+
+def tool_version(tool):
+    """Version of a tool: hash of its executable, script or source file.
+
+    Parameters
+    ----------
+    tool : string or function
+        Full path of an executable or script, or a python function.
+
+    Returns
+    -------
+    version : string
+        Hexadecimal SHA-1 hash, '' if the file can not be found.
+
+    """
+    if callable(tool):
+        try:
+            tool=inspect.getsourcefile(tool)
+        except TypeError:
+            return ''
+    tool=tool.strip()
+    if tool not in _tool_versions:
+        _tool_versions[tool]=filehash(tool) if os.path.isfile(tool) else ''
+    return _tool_versions[tool]
+
+
+class manifest (object):
+    """Manifest of the stages done in a directory.
+
+    Parameters
+    ----------
+    directory : string
+        Directory described by the manifest, where it is saved.
+    force : list of string
+        Stages to run again whatever their state ('all' for all stages).
+
+    """
+    def __init__(self,directory,force=()):
+        self.filename=os.path.join(directory,manifest_name)
+        self.force=set(force)
+        self.stages={}
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.stages=json.load(f)
+            except (IOError,ValueError):
+                print prog+'*** WARNING: unreadable manifest '+self.filename+', all stages will run'
+                self.stages={}
+        # previous hashes, reused while size and modification time are unchanged
+        self._hashes={}
+        for record in self.stages.values():
+            for path,size,mtime,sha1 in record.get('inputs',[]):
+                self._hashes[path]=(size,mtime,sha1)
+
+    def signature(self,inputs):
+        """Signature of a list of input files.
+
+        Parameters
+        ----------
+        inputs : list of string
+            Full path of the input files.
+
+        Returns
+        -------
+        signature : list
+            [path, size, mtime, sha1] for each input file, sorted by path.
+            Missing files have a size of -1.
+
+        """
+        signature=[]
+        for path in sorted(inputs):
+            try:
+                stat=os.stat(path)
+            except OSError:
+                signature.append([path,-1,0.0,''])
+                continue
+            previous=self._hashes.get(path)
+            if previous is not None and previous[0]==stat.st_size and previous[1]==stat.st_mtime:
+                sha1=previous[2]
+            else:
+                sha1=filehash(path)
+                self._hashes[path]=(stat.st_size,stat.st_mtime,sha1)
+            signature.append([path,stat.st_size,stat.st_mtime,sha1])
+        return signature
+
+    def uptodate(self,stage,inputs,params):
+        """Tell if a stage does not need to run again.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        inputs : list of string
+            Full path of the input files of the stage.
+        params : dict
+            Parameters and tool versions of the stage.
+
+        Returns
+        -------
+        uptodate : boolean
+            True if the inputs and parameters did not change since the last
+            run of the stage and all its outputs exist.
+
+        """
+        if stage in self.force or all_stages in self.force:
+            return False
+        record=self.stages.get(stage)
+        if record is None:
+            return False
+        if record['params']!=_jsonable(params):
+            return False
+        if not all(os.path.exists(path) for path in record['outputs']):
+            return False
+        return _same(record['inputs'],self.signature(inputs))
+
+    def result(self,stage):
+        """Result recorded by the last run of a stage, None if none."""
+        record=self.stages.get(stage)
+        if record is None:
+            return None
+        return record.get('result')
+
+    def record(self,stage,inputs,params,outputs,result=None):
+        """Record a successful run of a stage and save the manifest.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        inputs : list of string
+            Full path of the input files of the stage.
+        params : dict
+            Parameters and tool versions of the stage.
+        outputs : list of string
+            Full path of the output files of the stage.
+        result : object
+            Result of the stage to reuse when it is up to date (JSON type).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.stages[stage]={'inputs':self.signature(inputs),
+                            'params':_jsonable(params),
+                            'outputs':sorted(outputs),
+                            'result':result}
+        self.save()
+
+    def invalidate(self,stage):
+        """Forget a stage, so that it runs again."""
+        if self.stages.pop(stage,None) is not None:
+            self.save()
+
+    def save(self):
+        """Save the manifest atomically."""
+        with atomicfile.open_atomic(self.filename) as f:
+            json.dump(self.stages,f,indent=1,sort_keys=True)
+
+def _jsonable(params):
+    """Parameters as they are read back from the JSON manifest."""
+    return json.loads(json.dumps(params))
+
+def _same(recorded,signature):
+    """Compare two signatures on path, size and hash."""
+    if len(recorded)!=len(signature):
+        return False
+    for (path0,size0,mtime0,sha0),(path1,size1,mtime1,sha1) in zip(recorded,signature):
+        if path0!=path1 or size0!=size1 or sha0!=sha1 or size1<0:
+            return False
+    return True
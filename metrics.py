@@ -0,0 +1,229 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Log the processing of an event: text log file and console
+ -Record machine-readable metrics of each stage, as JSON lines
+ -Summarize the event and export the metrics for Prometheus
+
+Each stage record is one JSON object per line, with the keys: event,
+station, stage, start (UTC, ISO 8601), duration (s), nfiles and status
+('ok', 'skipped' when the stage was up to date, 'cached' when its outputs
+were taken from a cache, or 'error'). The status of an event in its
+summary is 'ok', 'partial' when some of its stations failed, or 'error'.
+A recorder created without files keeps its messages and records in memory:
+this is how the station workers send them back to the event recorder.
+
+"""
+import time
+import json
+import datetime
+import contextlib
+from fripipe import atomicfile
+
+prog="(metrics.py) "
+
+# status of a stage
+ok='ok'
+skipped='skipped'
+cached='cached'
+error='error'
+# status of an event where some stations failed
+partial='partial'
+
+def utcnow():
+    """Current UTC date, ISO 8601."""
+    return datetime.datetime.utcnow().isoformat()+'Z'
+
+
+class recorder (object):
+    """Log messages and stage metrics of an event, or of one of its stations.
+
+    Parameters
+    ----------
+    event : string
+        Name of the event.
+    station : string
+        Name of the station, '' for the event itself.
+    logfile : string
+        Text log file, None to keep the messages in memory.
+    metricsfile : string
+        JSON lines metrics file, None to keep the records in memory.
+
+    """
+    def __init__(self,event,station='',logfile=None,metricsfile=None):
+        self.event=event
+        self.station=station
+        self.log=open(logfile,'w') if logfile else None
+        self.metrics=open(metricsfile,'w') if metricsfile else None
+        self.lines=[]
+        self.records=[]
+        self.start=time.time()
+
+    def __getstate__(self):
+        # only the in-memory recorders are sent between processes
+        state=self.__dict__.copy()
+        state['log']=None
+        state['metrics']=None
+        return state
+
+    def info(self,msg,echo=True):
+        """Log a message, and print it if echo is True."""
+        if not msg.endswith('\n'):
+            msg+='\n'
+        line=utcnow()+' '+msg
+        if self.log is not None:
+            self.log.write(line)
+            self.log.flush()
+        else:
+            self.lines.append(line)
+        if echo:
+            print msg
+
+    def emit(self,record):
+        """Save a stage record."""
+        self.records.append(record)
+        if self.metrics is not None:
+            self.metrics.write(json.dumps(record,sort_keys=True)+'\n')
+            self.metrics.flush()
+
+    @contextlib.contextmanager
+    def stage(self,stage,nfiles=0,station=None):
+        """Time a stage and record it.
+
+        The status of the stage is 'error' if it raises an exception (or
+        calls sys.exit), 'ok' otherwise unless it is changed in the yielded
+        record, e.g. to 'skipped'.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        nfiles : integer
+            Number of files processed by the stage; may be changed in the
+            yielded record.
+        station : string
+            Name of the station, default is the station of the recorder.
+
+        """
+        if station is None:
+            station=self.station
+        record={'event':self.event,'station':station,'stage':stage,
+                'start':utcnow(),'nfiles':nfiles,'status':ok}
+        start=time.time()
+        try:
+            yield record
+        except BaseException:
+            record['status']=error
+            raise
+        finally:
+            record['duration']=round(time.time()-start,6)
+            self.emit(record)
+
+    def merge(self,other):
+        """Add the messages and records of a station recorder."""
+        for line in other.lines:
+            if self.log is not None:
+                self.log.write(line)
+            else:
+                self.lines.append(line)
+        if self.log is not None:
+            self.log.flush()
+        for record in other.records:
+            self.emit(record)
+
+    def summary(self,status=ok):
+        """Summarize the stages of the event.
+
+        Parameters
+        ----------
+        status : string
+            Final status of the event.
+
+        Returns
+        -------
+        summary : dict
+            event, status, start, duration, nstations and, for each stage,
+            its number of runs, of skips, of cache hits and of errors, its total duration
+            and number of files.
+
+        """
+        stages={}
+        for record in self.records:
+            total=stages.setdefault(record['stage'],{'runs':0,'skipped':0,'cached':0,'errors':0,
+                                                     'duration':0.0,'nfiles':0})
+            total['runs']+=1
+            total['duration']+=record['duration']
+            total['nfiles']+=record['nfiles']
+            if (record['status']==skipped):
+                total['skipped']+=1
+            elif (record['status']==cached):
+                total['cached']+=1
+            elif (record['status']==error):
+                total['errors']+=1
+        stations=set(record['station'] for record in self.records if record['station'])
+        return {'event':self.event,'status':status,
+                'start':datetime.datetime.utcfromtimestamp(self.start).isoformat()+'Z',
+                'duration':round(time.time()-self.start,6),
+                'nstations':len(stations),'stages':stages}
+
+    def close(self):
+        """Close the files of the recorder."""
+        for f in (self.log,self.metrics):
+            if f is not None:
+                f.close()
+        self.log=None
+        self.metrics=None
+
+def save_summary(summary,filename):
+    """Save the summary of an event as JSON, atomically."""
+    with atomicfile.open_atomic(filename) as f:
+        json.dump(summary,f,indent=1,sort_keys=True)
+
+def _label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def export_prometheus(summary,records,filename):
+    """Export the metrics of the last event in the Prometheus textfile format.
+
+    The file is written atomically, as expected by the textfile collector
+    of the node exporter.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary of the event, see recorder.summary.
+    records : list of dict
+        Stage records of the event.
+    filename : string
+        Prometheus file, with the .prom extension.
+
+    Returns
+    -------
+    None.
+
+    """
+    event='event="'+_label(summary['event'])+'"'
+    lines=['# HELP fripipe_event_duration_seconds Duration of the processing of the last event.',
+           '# TYPE fripipe_event_duration_seconds gauge',
+           'fripipe_event_duration_seconds{%s,status="%s"} %f'%(event,_label(summary['status']),
+                                                                 summary['duration']),
+           '# HELP fripipe_event_stations Number of stations of the last event.',
+           '# TYPE fripipe_event_stations gauge',
+           'fripipe_event_stations{%s} %d'%(event,summary['nstations']),
+           '# HELP fripipe_stage_duration_seconds Duration of a stage for a station of the last event.',
+           '# TYPE fripipe_stage_duration_seconds gauge']
+    for record in records:
+        lines.append('fripipe_stage_duration_seconds{%s,station="%s",stage="%s",status="%s"} %f'%(
+            event,_label(record['station']),_label(record['stage']),_label(record['status']),
+            record['duration']))
+    lines+=['# HELP fripipe_stage_files Number of files processed by a stage for a station of the last event.',
+            '# TYPE fripipe_stage_files gauge']
+    for record in records:
+        lines.append('fripipe_stage_files{%s,station="%s",stage="%s"} %d'%(
+            event,_label(record['station']),_label(record['stage']),record['nfiles']))
+    with atomicfile.open_atomic(filename) as f:
+        f.write('\n'.join(lines)+'\n')
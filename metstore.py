@@ -0,0 +1,122 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Binary store of the measurements of an event: one table per station
+ -read back without parsing the text *.met files
+
+The *.met files of the stations of an event are read once, and their
+columns saved in one uncompressed NumPy .npz file, the array of a column
+being named '<station>/<column>'. The columns are named after the header
+of the *.met file (last comment line before the data), the usual names
+being normalized (see column_aliases): time, x, y, ra, dec, mag.
+A *.met file without header gets the names of met_columns.
+
+"""
+import os
+import re
+import numpy as np
+from fripipe import atomicfile
+
+prog="(metstore.py) "
+
+# name of the store of an event, in its Trajectory directory
+store_name='measurements.npz'
+# names of the columns of a *.met file without header
+met_columns=['time','x','y','ra','dec','mag']
+# normalized names of the columns
+column_aliases={'time':['time','t','jd','mjd','date'],
+                'x':['x','x_image','xpix'],
+                'y':['y','y_image','ypix'],
+                'ra':['ra','alpha','alpha_j2000','ra_j2000'],
+                'dec':['dec','delta','delta_j2000','dec_j2000'],
+                'mag':['mag','magnitude','mag_auto']}
+_aliases=dict((alias,name) for name,aliases in column_aliases.items() for alias in aliases)
+
+def station_name(met_file):
+    """Name of the station of a *.met file, e.g. 'BORDEAUX' for BORDEAUX_UT.met."""
+    return os.path.basename(met_file).split('_')[0]
+
+def read_met(met_file):
+    """Read the columns of a *.met file.
+
+    Parameters
+    ----------
+    met_file : string
+        Full path of the *.met file.
+
+    Returns
+    -------
+    table : dict
+        Column name -> numpy.ndarray of float.
+
+    """
+    header=None
+    with open(met_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                words=re.split(r'[\s,;]+',line.lstrip('#').strip())
+                if words and words[0]:
+                    header=words
+            elif line.strip():
+                break
+    data=np.loadtxt(met_file,ndmin=2,comments='#')
+    ncols=data.shape[1] if data.size else (len(header) if header else len(met_columns))
+    if header is None or len(header)!=ncols:
+        header=met_columns if ncols<=len(met_columns) else met_columns+['col%d'%i for i in range(len(met_columns),ncols)]
+    names=[_aliases.get(name.lower(),name.lower()) for name in header[:ncols]]
+    return dict((name,data[:,i] if data.size else np.zeros(0)) for i,name in enumerate(names))
+
+def write_store(storefile,met_files):
+    """Save the measurements of the *.met files of an event.
+
+    Parameters
+    ----------
+    storefile : string
+        Full path of the .npz store.
+    met_files : list of string
+        Full path of the *.met files of the stations.
+
+    Returns
+    -------
+    nrows : integer
+        Total number of measurements saved.
+
+    """
+    arrays={}
+    nrows=0
+    for met_file in sorted(met_files):
+        station=station_name(met_file)
+        for column,values in read_met(met_file).items():
+            arrays[station+'/'+column]=values
+            nrows+=len(values) if column=='time' else 0
+    with atomicfile.open_atomic(storefile,'wb') as out:
+        np.savez(out,**arrays)
+    return nrows
+
+def load_store(storefile):
+    """Load the measurements of an event.
+
+    Parameters
+    ----------
+    storefile : string
+        Full path of the .npz store.
+
+    Returns
+    -------
+    tables : dict
+        Station name -> table (column name -> numpy.ndarray).
+
+    """
+    tables={}
+    with np.load(storefile) as npz:
+        for key in npz.files:
+            station,column=key.split('/',1)
+            tables.setdefault(station,{})[column]=npz[key]
+    return tables
+
+def event_store(my_event):
+    """Full path of the store of an event directory."""
+    return os.path.join(my_event,'Trajectory',store_name)
@@ -6,6 +6,17 @@ Parameters
 ----------
 eventname : string
     name of the event where the data are saved.
+nworkers : integer, optional
+    number of stations processed in parallel (default: number of CPUs).
+force-stage : string, optional
+    stage to run again even if it is up to date, among gethead, headcopy,
+    sexmet, position2met, metstore, compute_traj or all. May be repeated.
+scratch : string, optional
+    local directory where the data are copied and processed, instead of
+    being symlinked into the home directory of the user. Use it when the
+    data are on slow storage. The results are then saved under scratch.
+prometheus : string, optional
+    Prometheus textfile (*.prom) where the metrics of the events are exported.
 
 Returns
 -------
@@ -14,25 +25,67 @@ None :
 
 Notes
 -----
-syntax is: python processievent_from_arg.py eventname
+syntax is: python processievent_from_arg.py eventname [-n nworkers] [--force-stage stage] [--scratch dir] [--prometheus file]
 the following directories and files HAVE to exist:
     my_detectdir: local directory where the original data will be sym-linked
 The following scripts and softwares are launched by this program:
     launch gethead4event.py script to get the best scamp head file and sym-linked it to local directory
-    launch sexmet_auto_detect.sh script output [X,Y,RA,DEC] of the event, using scamp output from previous step
+    launch sexmet_auto_detect.sh script to measure [X,Y,RA,DEC] of the event, using scamp output from previous step,
+    or measure them in-process if path_and_file.centroid_engine='numpy' (see centroid.py, SExtractor if it fails)
     launch position2met.py to create the *.met files
+    save the measurements of all the *.met files in Trajectory/measurements.npz (see metstore.py),
+    with those of the external networks ingested in the event (see ingestnetworks.py)
     launch compute_traj_from_arg.py script to compute trajectory and orbit, once the previous steps are done for all stations of the event
+The stations of an event are processed in parallel by a pool of nworkers
+processes. No process changes its working directory: all the commands are
+launched with absolute paths, and compute_traj is launched only once every
+station is done. The SPICE kernels (and those of the stations) are loaded
+by initialize.load_spice in this process and in each worker. CSPICE is not
+thread-safe: when the events are processed by threads of one process (see
+eventdaemon.py), loading the kernels and computing the trajectory are done
+by one thread at a time, under spice_lock.
+A station whose calibration or data are missing, or whose stage fails, is
+recorded with its typed error (see errors.py) and the other stations go on:
+the trajectory is computed if at least constants.min_stations stations
+succeeded, and the other events go on in any case. The status of each
+station and of the trajectory is saved in Trajectory/checkpoint.json (see
+checkpoint.py): the next run retries the failed units, while the manifests
+skip the stages of the other stations that are up to date.
+Each stage records its inputs (size and hash), parameters, tool versions
+and outputs in a manifest (see manifest.py): a rerun only executes the
+stages whose inputs changed.
+The duration, number of files and status of each stage of each station are
+saved as JSON lines in Trajectory/processmultidetect.jsonl, next to the text
+log, and the summary of the event in Trajectory/processmultidetect.json.
 """
-from astropy.io.votable import parse
 import sys
 import datetime
 import os
 import glob
+import argparse
+import subprocess
+import multiprocessing
+import threading
+import traceback
 import numpy as np
-from fripipe.path_and_file import data_dir,fri_proc_dir,fri_station_file,fripipe_shell_path,work_detc_dir,work_mult_dir
+from fripipe.initialize import path_and_file
+from fripipe.initialize import constants
+from fripipe.initialize import load_spice
 from fripipe.trajectory import compute_traj
-from fripipe.conversion import name2code,code2name
 from fripipe.position2met import position2met
+from fripipe import scampindex
+from fripipe import stations
+from fripipe import manifest
+from fripipe import staging
+from fripipe import metrics
+from fripipe import catacache
+from fripipe import headfile
+from fripipe import metstore
+from fripipe import spicekernels
+from fripipe import centroid
+from fripipe import errors
+from fripipe import checkpoint
+from fripipe import ingestnetworks
 
 #===============================================
 
@@ -43,6 +96,8 @@ def gethead4event(eventname,stationname,mincontrast=5.0,maxdeltat=30.0):
     having the minimum contrast (see scamp doc) greater or equal than
     mincontrast (=5 by default) and which date is less than maxdeltat days
     (default=30) from the event named eventname.
+    The scamp.xml file of the station is read through its index (see
+    scampindex), rebuilt only when scamp.xml changes.
     
     Parameters
     ----------
@@ -64,100 +119,334 @@ def gethead4event(eventname,stationname,mincontrast=5.0,maxdeltat=30.0):
         Full path file name of the .head file (previously created by the scamp
         software, see procstep=5).
     
+    Raises
+    ------
+    errors.calibration_error
+        If the station is unknown, or has no usable calibration.
+    
     """
     prog="(gethead4event.py) "
     
     #print prog,'eventname=',eventname
     #print prog,'stationname=',stationname
     # get the date of the event thanks to the name of the directory
-    y=int(eventname[0:4])
-    m=int(eventname[4:6])
-    d=int(eventname[6:8])
-    h=int(eventname[9:11])
-    n=int(eventname[11:13])
-    s=int(eventname[13:15])
     eventtime=datetime.datetime.strptime(eventname[0:15],'%Y%m%dT%H%M%S')
-    eventdecimalyear=(float(y)+float(m)/12.0+float(d)/365.0+
-                      float(h)/(365.0*24.0)+float(n)/(365.0*24.0*60.0)+
-                      float(s)/(365.0*24.0*60.0*60.0))
-    if not os.path.isfile(fri_station_file):
-        errmsg=prog+"*** FATAL ERROR: station file "+fri_station_file+" does not exist \n"
-        sys.exit(errmsg)
-    code=name2code.name2code(stationname)
-    if (code==""):
+    # decimal (julian) year, as the scamp Observation_Date
+    eventdecimalyear=2000.0+((eventtime-datetime.datetime(2000,1,1,12)).total_seconds()/
+                             (365.25*86400.0))
+    stn=stations.get_registry().by_name(stationname)
+    if stn is None:
         errmsg=prog+"*** FATAL ERROR: station unknown from station file \n"
-        sys.exit(errmsg)
-    scampxml=fri_proc_dir+code+"/scamp/scamp.xml"
+        raise errors.calibration_error(errmsg,'gethead',stationname)
+    scampxml=stn.scampxml
     if os.path.isfile(scampxml):
-        votable = parse(scampxml)
-        table = votable.get_first_table()
-        contrast = (table.array['XY_Contrast']).data
-        catname = (table.array['Catalog_Name']).data
-        date = (table.array['Observation_Date']).data
-        deltatime=(date-eventdecimalyear)*365
-        a = zip(deltatime,contrast,catname)
-        a.sort()
-        if (len(a)==0):
+        index=scampindex.load_index(scampxml)
+        if (len(index['date'])==0):
             errmsg=prog+"*** FATAL ERROR: there is no useful data in "+scampxml+"\n"
-            sys.exit(errmsg)
-        else:
-            while (a[0][1]<mincontrast):
-                del a[0]
-            return fri_proc_dir+code+"/scamp/"+os.path.splitext(a[0][2])[0]+'.head'
+            raise errors.calibration_error(errmsg,'gethead',stationname)
+        catname=scampindex.select_catalog(index,eventdecimalyear,mincontrast,maxdeltat)
+        if catname is None:
+            errmsg=''.join([prog,"*** FATAL ERROR: there is no calibration with contrast>=",
+                            str(mincontrast)," within ",str(maxdeltat)," days in ",scampxml,"\n"])
+            raise errors.calibration_error(errmsg,'gethead',stationname)
+        return stn.scamp_dir+os.path.splitext(catname)[0]+'.head'
     else:
         errmsg=prog+"*** FATAL ERROR: scamp xml file "+scampxml+" does not exist \n"
-        sys.exit(errmsg)
+        raise errors.calibration_error(errmsg,'gethead',stationname)
 
 #=================================================
-#=================== MAIN ========================
-#=================================================
-prog="(processevent_from_arg.py) "
-syntax="python processevent_from_arg.py eventname"
-eventname=sys.argv[1]
-print prog,"eventname=",eventname
-if not len(eventname):
-    sys.exit(prog+"*** FATAL ERROR: please specify the event name. syntax is"+synt)
-yyyymm=eventname[:6]
-eventdir="/".join([work_mult_dir,yyyymm,eventname])
-print prog,"evendir=",eventdir
-user=os.environ['USER']
-home=os.environ['HOME']
-if not (user=="fripon"):
-    datadir="/home/"+user+"/"
-    userfri=0
-else:
-    datadir=data_dir
-    userfri=1
-my_detectdir=datadir+"/detections/multiple/"
 
-fripon_detectdir=datadir+"/detections/multiple"
-fits2D_dir="fits2D"
-position_file="positions.txt"
+def process_station(station,my_detection_name,datadir,userfri,force=(),log=None):
+    """Process the data of one station of an event.
+    
+    Select the best scamp head file, copy it without the CRVAL keywords
+    into the fits2D directory, measure the meteor on the frames (in-process
+    with centroid.py, or with sexmet_auto_detect.sh unless the catalogs are
+    in the shared cache, see catacache) and create the *.met file with
+    position2met. The working directory is never changed:
+    this function is safe to run in parallel for several stations.
+    Each stage (gethead, headcopy, sexmet, position2met) is recorded in the
+    manifest of the station directory, and runs again only if its inputs,
+    parameters or tools changed since its last run.
+    
+    Parameters
+    ----------
+    station : string
+        Full path of the station directory, ending with '_UT'.
+    my_detection_name : string
+        Name of the event directory, example: '20160806T220747_UT'
+    datadir : string
+        Root of the directory tree where the data are processed.
+    userfri : integer
+        1 if the user is fripon, 0 otherwise.
+    force : list of string
+        Stages to run again whatever their state ('all' for all stages).
+    log : metrics.recorder
+        Recorder of the messages and stage metrics of the station.
+    
+    Returns
+    -------
+    met_file : string
+        Full path of the *.met file created for the station.
+    
+    Raises
+    ------
+    errors.station_error
+        If a stage failed: the other stations of the event go on.
+    
+    """
+    stationame=station.split('/')[-1].split('_' )[0]
+    if log is None:
+        log=metrics.recorder(my_detection_name,stationame)
+    codestn=stations.name2code(stationame)
+    print "-------------------------"
+    log.info(prog+"=== now treating data in "+station+" from station: "+stationame+" (code="+codestn+")")
+    my_station=station.replace(path_and_file.data_dir,datadir)
+    stages=manifest.manifest(my_station,force)
+    #=================================================
+    # select the scamp *.head file that is the closest in time, and with a good contrast
+    # using the path to determine where to look for scamp xml file
+    scampxml=path_and_file.fri_proc_dir+codestn+"/scamp/scamp.xml"
+    params={'eventname':my_detection_name}
+    with log.stage('gethead',1) as record:
+        head_file=stages.result('gethead')
+        if (head_file and stages.uptodate('gethead',[scampxml],params)):
+            record['status']=metrics.skipped
+        else:
+            head_file=gethead4event(my_detection_name,stationame)
+            stages.record('gethead',[scampxml],params,[head_file],head_file)
+        log.info(prog+"head_file="+head_file)
+        if not os.path.isfile(head_file): 
+            msg=prog+"*** FATAL ERROR: head_file="+head_file+" not created for some reasons... "
+            log.info(msg,echo=False)
+            raise errors.calibration_error(msg,'gethead',stationame)
+    # copy the best *.head file into the fits2D directory but remove the CRVAL lines
+    fits2Ddir=station+"/"+fits2D_dir
+    local_file="/".join([fits2Ddir,"head.head"])
+    if not userfri:
+        local_file=local_file.replace(path_and_file.data_dir,datadir)
+    with log.stage('headcopy',1) as record:
+        if stages.uptodate('headcopy',[head_file],{}):
+            record['status']=metrics.skipped
+            log.info(prog+local_file+" is up to date")
+        else:
+            try:
+                headfile.copy_head(head_file,local_file)
+            except (IOError,OSError) as e:
+                msg=prog+"*** FATAL ERROR: best *.head file could not be copied into "+local_file+": "+str(e)
+                log.info(msg,echo=False)
+                raise errors.stage_error(msg,'headcopy',stationame)
+            stages.record('headcopy',[head_file],{},[local_file])
+            log.info(prog+head_file+" copied into "+local_file+" and CRVAL removed ok")
+    #=================================================
+    # launches sextractor with the good options, again using the path to get the mask file
+    my_fits2Ddir=fits2Ddir.replace(path_and_file.data_dir,datadir)
+    # sextractor runs again only if the frames, the head file or the tools changed (takes a lot of time...)
+    # and if the catalogs are not in the shared cache
+    listfit=glob.glob(my_fits2Ddir+"/*.fit")
+    sexmet_script=path_and_file.fripipe_shell_path+"/sexmet_auto_detect.sh"
+    sexmet_inputs=listfit+[local_file]
+    positionfile=my_station+'/'+position_file
+    params={'stationame':stationame,
+            'sexmet_auto_detect':manifest.tool_version(sexmet_script),
+            'sextractor':manifest.tool_version(path_and_file.sex_exe)}
+    # the in-process engine measures the meteor in windows predicted from positions.txt
+    engine=path_and_file.centroid_engine
+    if (engine==centroid.engine_numpy):
+        sexmet_inputs.append(positionfile)
+        params['engine']=engine
+        params['centroid']=manifest.tool_version(centroid.centroid)
+    with log.stage('sexmet',len(listfit)) as record:
+        if stages.uptodate('sexmet',sexmet_inputs,params):
+            record['status']=metrics.skipped
+            log.info(prog+"catalogs of "+my_fits2Ddir+" are up to date")
+        else:
+            listcata=glob.glob(my_fits2Ddir+"/*.cata")
+            listhead=glob.glob(my_fits2Ddir+"/*.head")
+            log.info(prog+"number of fit, cata and head files="+str(len(listfit))+" "+str(len(listcata))+" "+str(len(listhead)))
+            if (stages.result('sexmet') is None and not 'sexmet' in force and
+                len(listfit)==len(listcata) and (len(listfit)==len(listhead)-1)):
+                # catalogs made before the manifest existed: adopted as they are
+                record['status']=metrics.skipped
+                log.info(prog+"existing catalogs of "+my_fits2Ddir+" recorded in the manifest")
+            else:
+                measured=None
+                if (engine==centroid.engine_numpy):
+                    try:
+                        measured=centroid.centroid(my_fits2Ddir,positionfile,local_file)
+                        log.info(prog+"meteor measured in-process on "+str(measured)+" frames of "+my_fits2Ddir)
+                    except centroid.centroid_error as e:
+                        log.info(prog+"*** WARNING: in-process measurement failed ("+str(e)+"), now using SExtractor")
+                if measured is None:
+                    # catalogs of the same frames, head file and configuration are shared by all users
+                    cache=catacache.get_cache()
+                    keys={}
+                    if cache is not None:
+                        keys=cache.keys(stages.signature(listfit),stages.signature([local_file])[0][3])
+                    if cache is not None and cache.fetch(keys):
+                        record['status']=metrics.cached
+                        log.info(prog+"catalogs of "+my_fits2Ddir+" taken from the cache "+cache.directory)
+                    else:
+                        # catalogs of a previous run would hide a failure of this one
+                        for frame in listfit:
+                            if os.path.isfile(catacache.catalog_name(frame)):
+                                os.remove(catacache.catalog_name(frame))
+                        cmd=[sexmet_script,stationame]
+                        log.info(prog+"now launching cmd="+" ".join(cmd)+" in "+my_fits2Ddir)
+                        returncode=subprocess.call(cmd,cwd=my_fits2Ddir)
+                        missing=[frame for frame in listfit if not os.path.isfile(catacache.catalog_name(frame))]
+                        if (returncode!=0 or missing):
+                            msg=''.join([prog,"*** FATAL ERROR: sexmet_auto_detect.sh failed for station ",
+                                         stationame," with code ",str(returncode),", ",str(len(missing)),
+                                         " frames of ",my_fits2Ddir," without catalog"])
+                            log.info(msg,echo=False)
+                            raise errors.stage_error(msg,'sexmet',stationame)
+                        log.info(prog+"sexmet_auto_detect.sh done for station "+stationame)
+                        # only the catalogs of a successful run are shared
+                        if cache is not None:
+                            cache.store(keys)
+            stages.record('sexmet',sexmet_inputs,params,glob.glob(my_fits2Ddir+"/*.cata"),'done')
+    #=================================================
+    # launches the position2met.sh script
+    met_file = my_station+'/'+station.split('/')[-1]+'.met'
+    position2met_inputs=[positionfile,local_file]+glob.glob(my_fits2Ddir+"/*.cata")
+    params={'position2met':manifest.tool_version(position2met)}
+    with log.stage('position2met',len(position2met_inputs)) as record:
+        if stages.uptodate('position2met',position2met_inputs,params):
+            record['status']=metrics.skipped
+            log.info(prog+"met_file="+met_file+" is up to date")
+        else:
+            log.info(prog+"now launching the position2met process. Data will be saved in met_file="+met_file)
+            position2met(positionfile,my_station+'/'+fits2D_dir,met_file)
+            if not os.path.isfile(met_file):
+                msg=prog+"*** FATAL ERROR: met_file="+met_file+" not created by position2met"
+                log.info(msg,echo=False)
+                raise errors.stage_error(msg,'position2met',stationame)
+            stages.record('position2met',position2met_inputs,params,[met_file])
+    return met_file
 
-# verification
-if not os.path.isfile(fri_station_file):
-    sys.exit(prog+" ### FATAL ERROR:  fri_station_file: "+fri_station_file+" does not exist")
-if not os.path.isdir(fripon_detectdir):
-    sys.exit(prog+" #### FATAL ERROR: fripon_detectdir: "+fripon_detectdir+" does not exist")
+def process_station_worker(args):
+    """Run process_station in a worker of the station pool.
+    
+    An exception in a pool worker would stop the whole event: the typed
+    error of the station is returned instead, and recorded by the main
+    process. A sys.exit of an external tool, or any unexpected exception,
+    is turned into a stage_error of the stage that was running.
+    
+    Returns
+    -------
+    station : string
+        Full path of the station directory.
+    met_file : string
+        Full path of the *.met file, None if the processing failed.
+    log : metrics.recorder
+        Messages and stage metrics of the station, to be merged in those
+        of the event.
+    error : errors.station_error
+        Error of the station, None if the processing succeeded.
+    
+    """
+    station,my_detection_name=args[0],args[1]
+    stationame=station.split('/')[-1].split('_' )[0]
+    log=metrics.recorder(my_detection_name,stationame)
+    try:
+        met_file=process_station(*args,log=log)
+    except errors.station_error as e:
+        return station,None,log,e
+    except (Exception,SystemExit) as e:
+        if isinstance(e,SystemExit):
+            msg=str(e.code)
+        else:
+            msg=prog+"*** FATAL ERROR: "+traceback.format_exc()
+        log.info(msg,echo=False)
+        failed=[record['stage'] for record in log.records if record['status']==metrics.error]
+        return station,None,log,errors.stage_error(msg,(failed or [None])[-1],stationame)
+    return station,met_file,log,None
 
-#=================================================
-# loop over the detections
-allevents=glob.glob("/".join([work_mult_dir,yyyymm,eventname+"*"]))
-if (len(allevents)==0):
-    sys.exit(prog+" *** FATAL ERROR: There is no event "+eventname)
-else:
-    print prog,"List of events to process: ",allevents
-for my_event in allevents:
+def process_event(my_event,datadir,userfri,nworkers,force=(),stage_mode=staging.link,
+                  prometheus=None,pool=None):
+    """Process one multiple detection event.
+    
+    The messages are saved in the Trajectory/processmultidetect.log file
+    of the event, the metrics of each stage of each station in the
+    Trajectory/processmultidetect.jsonl file (JSON lines, see metrics.py)
+    and the summary of the event in Trajectory/processmultidetect.json.
+    
+    Parameters
+    ----------
+    my_event : string
+        Full path of the event directory.
+    datadir : string
+        Root of the directory tree where the data are processed.
+    userfri : integer
+        1 if the user is fripon, 0 otherwise.
+    nworkers : integer
+        Number of stations processed in parallel.
+    force : list of string
+        Stages to run again whatever their state ('all' for all stages).
+    stage_mode : string
+        'link' to symlink the data into datadir, 'copy' to copy them (for a
+        local scratch datadir), if the user is not fripon.
+    prometheus : string
+        Prometheus textfile where the metrics of the event are exported,
+        None for no export.
+    pool : multiprocessing.Pool
+        Pool of processes where the stations are processed, created by the
+        caller in its main thread; None for a pool of nworkers processes
+        created for the event.
+    
+    Returns
+    -------
+    log : metrics.recorder
+        Recorder of the messages and metrics of the event.
+    
+    Raises
+    ------
+    errors.event_error
+        If the event has no station, too few stations succeeded, or the
+        computation of the trajectory failed. A failed station does not
+        stop the event: it is recorded in the checkpoint, and the status of
+        the event is 'partial'.
+    
+    """
+    log,output_dir=open_event(my_event,datadir)
+    status=metrics.error
+    try:
+        failed=_process_event(log,my_event,datadir,userfri,nworkers,force,stage_mode,output_dir,pool)
+        status=metrics.partial if failed else metrics.ok
+    finally:
+        close_event(log,status,output_dir,prometheus)
+    return log
+
+def open_event(my_event,datadir):
+    """Create the output directory and the recorder of an event.
+    
+    Parameters
+    ----------
+    my_event : string
+        Full path of the event directory.
+    datadir : string
+        Root of the directory tree where the data are processed.
+    
+    Returns
+    -------
+    log : metrics.recorder
+        Recorder of the messages and metrics of the event.
+    output_dir : string
+        Trajectory directory of the event, under datadir.
+    
+    """
     my_detection_dir=os.path.dirname(my_event)
     my_detection_name=os.path.basename(my_event)
+    my_detectdir=datadir+"/detections/multiple/"
     output_dir=my_event+"/Trajectory"
-    output_dir=output_dir.replace(data_dir,datadir)
+    output_dir=output_dir.replace(path_and_file.data_dir,datadir)
     print prog+"#########################################"
     print prog+"# Now treating my_event= ",my_event
     print prog+"# my_detection_name=",my_detection_name
     print prog+"#########################################"
     print prog,'datadir=',datadir
-    print prog,'data_dir=',data_dir
+    print prog,'data_dir=',path_and_file.data_dir
     print prog,'my_detection_dir=',my_detection_dir
     print prog,'my_detectdir=',my_detectdir
     print prog,'output_dir=',output_dir
@@ -165,206 +454,396 @@ for my_event in allevents:
     if not os.path.isdir(output_dir):
         print prog+"now creating directory: "+output_dir
         os.makedirs(output_dir)
-    # log file
+    # log and metrics files
     my_logfile=output_dir+"/processmultidetect.log"
     print prog,'log info will be saved in logfile=',my_logfile
-    plzchklog="Please check the log file located in "+my_logfile+" for more info"
-    log=open(my_logfile,'w')
-    log.write(str(datetime.datetime.now())+"\n")
+    log=metrics.recorder(my_detection_name,'',my_logfile,output_dir+"/processmultidetect.jsonl")
+    return log,output_dir
+
+def close_event(log,status,output_dir,prometheus=None):
+    """Save the summary of an event, and export its metrics.
+    
+    Parameters
+    ----------
+    log : metrics.recorder
+        Recorder of the messages and metrics of the event.
+    status : string
+        Final status of the event (metrics.ok, metrics.partial or
+        metrics.error).
+    output_dir : string
+        Trajectory directory of the event.
+    prometheus : string
+        Prometheus textfile where the metrics of the event are exported,
+        None for no export.
+    
+    Returns
+    -------
+    summary : dict
+        Summary of the event, see metrics.recorder.summary.
+    
+    """
+    summary=log.summary(status)
+    metrics.save_summary(summary,output_dir+"/processmultidetect.json")
+    if prometheus is not None:
+        metrics.export_prometheus(summary,log.records,prometheus)
+    return summary
+
+def _process_event(log,my_event,datadir,userfri,nworkers,force,stage_mode,output_dir,pool=None):
+    """Check, stage and process the stations of an event, see process_event."""
+    # SPICE kernels of this process, and of the workers in their initializer
+    with spice_lock:
+        load_spice()
+    jobs,ckpt=prepare_event(log,my_event,datadir,userfri,force,stage_mode,output_dir)
+    # loop over the stations, processed in parallel
+    nworkers=max(1,min(nworkers,len(jobs)))
+    log.info(prog+"now processing "+str(len(jobs))+" stations with "+str(nworkers)+" workers")
+    if pool is not None:
+        results=pool.map(process_station_worker,jobs)
+    elif (nworkers==1):
+        results=map(process_station_worker,jobs)
+    else:
+        pool=multiprocessing.Pool(nworkers,initializer=load_spice)
+        try:
+            results=pool.map(process_station_worker,jobs)
+        finally:
+            pool.close()
+            pool.join()
+    # end of loop over the stations
+    return finish_event(log,my_event,results,force,output_dir,ckpt)
+
+def _plzchklog(output_dir):
+    """End of the fatal error messages of an event."""
+    return "Please check the log file located in "+output_dir+"/processmultidetect.log for more info"
+
+def prepare_event(log,my_event,datadir,userfri,force,stage_mode,output_dir):
+    """Check and stage the data of the stations of an event.
+    
+    A station whose data are missing is recorded as failed in the
+    checkpoint (see checkpoint.py), and the other stations go on. The
+    stations of external networks (see ingestnetworks.py) already have
+    their *.met file, and are recorded as succeeded. The
+    stations that failed in the previous run are retried; those that
+    succeeded are processed too, their manifests skipping the stages that
+    are up to date.
+    
+    Parameters
+    ----------
+    log : metrics.recorder
+        Recorder of the messages and metrics of the event.
+    my_event : string
+        Full path of the event directory.
+    datadir, userfri, force, stage_mode :
+        See process_event.
+    output_dir : string
+        Trajectory directory of the event.
+    
+    Returns
+    -------
+    jobs : list of tuple
+        Arguments of process_station_worker for each station to process.
+    ckpt : checkpoint.checkpoint
+        Checkpoint of the event.
+    
+    Raises
+    ------
+    errors.event_error
+        If there is no station in the event directory.
+    
+    """
+    my_detection_name=os.path.basename(my_event)
+    ckpt=checkpoint.checkpoint(output_dir,force)
 
     # now loops over all the stations and checks that all the needed data are present
     listations=glob.glob(my_event+"/*_UT")
-    msg=''.join([prog,'the directory ',my_event,
+    log.info(''.join([prog,'the directory ',my_event,
         ' contains the following usefull directories: ',
-        ' '.join(listations),'\n'])
-    log.write(msg)
-    print msg
+        ' '.join(listations)]))
     if (len(listations)==0):
-        msg=prog+'*** FATAL ERROR: there is no station observation record in '+my_event+'\n'
-        log.write(msg)
-        sys.exit(msg)
+        msg=prog+'*** FATAL ERROR: there is no station observation record in '+my_event
+        log.info(msg,echo=False)
+        raise errors.event_error(msg+_plzchklog(output_dir),'prepare')
+    ckpt.keep([station.split('/')[-1].split('_' )[0] for station in listations])
+    jobs=[]
     for station in listations:
         if (station.endswith('_UT')):
             print prog,'station=',station
             name=station.split('/')[-1].split('_' )[0]
-            codestn=name2code.name2code(name)
-            msg=''.join([prog,"now checking data for station ",name,
-                              " (code=",codestn,") \n"])
-            log.write(msg)
-            print msg
-            # First check if the scamp.xml file is present
-            scampxmlfile=datadir.replace(datadir,data_dir)+"/stations/"+codestn+"/scamp/scamp.xml"
-            if os.path.isfile(scampxmlfile):
-                msg=prog+"scamp.xml file exsits for station "+name+" "+ codestn+". ok! \n"
-                log.write(msg)
-                print msg
-            else:
-                msg=''.join([prog,"*** FATAL ERROR: file ",scampxmlfile,
-                    " does not exist (station=",name,
-                    "). Please run processing.py with proclevel=5 for station ",
-                    codestn,"\n"])
-                log.write(msg)
-                sys.exit(msg+plzchklog)
-            # now checks that the observation data are all here
-            positionfile=station+'/'+position_file
-            if not os.path.isfile(positionfile):
-                msg=prog+"*** FATAL ERROR: file "+positionfile+" does not exist. Aborting program \n"
-                log.write(msg)
-                sys.exit(msg+plzchklog)
+            # measurements of an external network, ready for the trajectory (see ingestnetworks.py)
+            met_file=ingestnetworks.external_met(station)
+            if met_file is not None:
+                log.info(prog+"station "+name+" was measured by an external network: "+met_file)
+                ckpt.succeed(name,met_file)
+                continue
+            previous=ckpt.previous_error(name)
+            if previous is not None:
+                log.info(''.join([prog,"station ",name," failed at stage ",str(previous['stage']),
+                                  " in the previous run, now retried"]))
+            try:
+                _check_station(log,station,name,datadir,userfri,stage_mode)
+            except errors.station_error as e:
+                ckpt.fail(name,e)
+                continue
+            jobs.append((station,my_detection_name,datadir,userfri,force))
+    ckpt.save()
+    return jobs,ckpt
+
+def _check_station(log,station,name,datadir,userfri,stage_mode):
+    """Check and stage the data of one station, see prepare_event.
+    
+    Raises
+    ------
+    errors.station_error
+        If the calibration or the observation data of the station are missing.
+    
+    """
+    codestn=stations.name2code(name)
+    log.info(''.join([prog,"now checking data for station ",name,
+                      " (code=",codestn,")"]))
+    # First check if the scamp.xml file is present
+    scampxmlfile=datadir.replace(datadir,path_and_file.data_dir)+"/stations/"+codestn+"/scamp/scamp.xml"
+    if os.path.isfile(scampxmlfile):
+        log.info(prog+"scamp.xml file exsits for station "+name+" "+ codestn+". ok!")
+    else:
+        msg=''.join([prog,"*** FATAL ERROR: file ",scampxmlfile,
+            " does not exist (station=",name,
+            "). Please run processing.py with proclevel=5 for station ",
+            codestn,"\n"])
+        log.info(msg,echo=False)
+        raise errors.calibration_error(msg,'check',name)
+    # now checks that the observation data are all here
+    positionfile=station+'/'+position_file
+    if not os.path.isfile(positionfile):
+        msg=prog+"*** FATAL ERROR: file "+positionfile+" does not exist. Station "+name+" skipped \n"
+        log.info(msg,echo=False)
+        raise errors.data_error(msg,'check',name)
+    else:
+        log.info(prog+positionfile+" does exist. ok!")
+    # now test if the images are present or not, and stage the data
+    # if the user is not fripon (a single pass over each directory)
+    fits2Ddir=station+"/"+fits2D_dir
+    my_station=station.replace(path_and_file.data_dir,datadir)
+    with log.stage('staging',station=name) as record:
+        try:
+            if not userfri:
+                staging.stage_files(station,my_station,[position_file],stage_mode)
+            summary=staging.stage_directory(fits2Ddir,fits2Ddir.replace(path_and_file.data_dir,datadir),
+                                            mode=stage_mode)
+        except (IOError,OSError) as e:
+            msg=''.join([prog,"*** FATAL ERROR: data of station ",name," could not be staged: ",
+                         str(e),". Station ",name," skipped \n"])
+            log.info(msg,echo=False)
+            raise errors.data_error(msg,'staging',name)
+        record['nfiles']=summary['nstaged']
+        log.info(staging.summary_message(summary))
+        if (summary['nfiles']==0):
+            msg=''.join([prog,"*** FATAL ERROR: directory ",fits2Ddir,
+                         " is empty. Station "+name+" skipped \n"])
+            log.info(msg,echo=False)
+            raise errors.data_error(msg,'staging',name)
+
+def finish_event(log,my_event,results,force,output_dir,ckpt):
+    """Record the results of the stations, then compute the trajectory.
+    
+    The trajectory is computed with the *.met files of all the stations
+    that succeeded, in this run or in a previous one, if there are at least
+    constants.min_stations of them.
+    
+    Parameters
+    ----------
+    log : metrics.recorder
+        Recorder of the messages and metrics of the event.
+    my_event : string
+        Full path of the event directory.
+    results : list of tuple
+        Results of process_station_worker for each station.
+    force : list of string
+        Stages to run again whatever their state ('all' for all stages).
+    output_dir : string
+        Trajectory directory of the event.
+    ckpt : checkpoint.checkpoint
+        Checkpoint of the event, saved with the results.
+    
+    Returns
+    -------
+    failed : list of string
+        Names of the stations that failed.
+    
+    Raises
+    ------
+    errors.event_error
+        If too few stations succeeded, or the computation of the trajectory
+        failed.
+    
+    """
+    my_detection_dir=os.path.dirname(my_event)
+    my_detection_name=os.path.basename(my_event)
+    # record the result of each station: a failed station does not stop the event
+    for station,met_file,stationlog,error in results:
+        log.merge(stationlog)
+        name=station.split('/')[-1].split('_' )[0]
+        if error is not None:
+            log.info(prog+"*** WARNING: station "+name+" failed at stage "+str(error.stage)+": "+
+                     str(error).strip())
+            ckpt.fail(name,error)
+        else:
+            ckpt.succeed(name,met_file)
+    failed=[unit for unit in ckpt.failed() if unit!=checkpoint.trajectory_unit]
+    # the trajectory is computed with the *.met files of all the stations that succeeded
+    met_files=ckpt.met_files()
+    if (len(met_files)<constants.min_stations):
+        msg=''.join([prog,"*** FATAL ERROR: only ",str(len(met_files))," stations succeeded (",
+                     str(constants.min_stations)," needed) for event ",my_event,
+                     ", failed stations: ",' '.join(failed),"\n"])
+        raise _trajectory_error(log,ckpt,msg,output_dir)
+
+    try:
+        # binary store of the measurements of all the stations, unless no *.met file changed
+        stages=manifest.manifest(output_dir,force)
+        storefile=output_dir+"/"+metstore.store_name
+        params={'metstore':manifest.tool_version(metstore.write_store)}
+        with log.stage('metstore',len(met_files)) as record:
+            if stages.uptodate('metstore',met_files,params):
+                record['status']=metrics.skipped
+                log.info(prog+"measurement store "+storefile+" is up to date")
             else:
-                msg=prog+positionfile+" does exist. ok! \n"
-                log.write(msg)
-                print msg
-                # now symlink the data if the user is not fripon
-                if not userfri:
-                    # first creates the appropriate directory
-                    if not os.path.isdir(station.replace(data_dir,datadir)):
-                        msg=prog+"now creating directory "+station.replace(data_dir,datadir)+"\n"
-                        log.write(msg)
-                        print msg
-                        os.system("mkdir -p "+station.replace(data_dir,datadir)) # because the following does not work: os.makedirs(station.replace(data_dir,datadir))
-                # now creates symbolic link
-                if not os.path.islink(positionfile.replace(data_dir,datadir)):
-                    msg=prog+"symlink "+positionfile+" into "+positionfile.replace(data_dir,datadir)+"\n"
-                    log.write(msg)
-                    print msg
-                    os.symlink(positionfile,positionfile.replace(data_dir,datadir))
-            # now test if the images are present or not
-            fits2Ddir=station+"/"+fits2D_dir
-            listfits2D=glob.glob(fits2Ddir+"/*")
-            msg=''.join([prog,'the directory ',fits2Ddir,
-                        ' contains the following files: ',
-                        ' '.join(listfits2D),"\n"])
-            log.write(msg)
-            #print msg
-            if (len(listfits2D)==0):
-                msg=''.join([prog,"*** FATAL ERROR: directory ",fits2Ddir,
-                             " is empty. Aborting program \n"])
-                log.write(msg)
-                sys.exit(msg+plzchklog)
+                nrows=metstore.write_store(storefile,met_files)
+                stages.record('metstore',met_files,params,[storefile])
+                log.info(prog+str(nrows)+" measurements of "+str(len(met_files))+" stations saved in "+storefile)
+
+        # launches the computation of orbits, unless no *.met file changed
+        params={'compute_traj':manifest.tool_version(compute_traj.compute_traj)}
+        with log.stage('compute_traj',len(met_files)) as record:
+            if stages.uptodate('compute_traj',met_files,params):
+                record['status']=metrics.skipped
+                log.info(prog+"trajectory and orbit of event "+my_event+" are up to date")
             else:
-                msg=''.join([prog,fits2Ddir," is not empty. ok! \n"])
-                log.write(msg)
-                print msg
-            # now symlynk of user is not fripon
-            if not userfri:
-                if not os.path.isdir(fits2Ddir.replace(data_dir,datadir)):
-                    os.makedirs(fits2Ddir.replace(data_dir,datadir))
-                os.chdir(fits2Ddir.replace(data_dir,datadir))
-            for fitfile in glob.glob(fits2Ddir+"/*.fit"):
-                if not os.path.islink(fitfile.replace(data_dir,datadir)):
-                    msg=''.join([prog,"symlink ",fitfile," into ",
-                            fitfile.replace(data_dir,datadir),"\n"])
-                    log.write(msg)
-                    print msg
-                    os.symlink(fitfile,fitfile.replace(data_dir,datadir))
-            for catafile in glob.glob(fits2Ddir+"/*.cata"):
-                if not os.path.islink(catafile.replace(data_dir,datadir)):
-                    msg=''.join([prog,"symlink ",catafile," into ",
-                            catafile.replace(data_dir,datadir),"\n"])
-                    log.write(msg)
-                    print msg
-                    os.symlink(catafile,catafile.replace(data_dir,datadir))
-            for headfile in glob.glob(fits2Ddir+"/frame*.head"):
-                if not os.path.islink(headfile.replace(data_dir,datadir)):
-                    msg=''.join([prog,"symlink ",headfile," into ",
-                            headfile.replace(data_dir,datadir),"\n"])
-                    log.write(msg)
-                    print msg
-                    os.symlink(headfile,headfile.replace(data_dir,datadir))
-            os.chdir(station)
-    # ==============================
-    # Now really process the data
-    # loop over the stations
-    for station in glob.glob(my_event+"/*"):
-        if (station.endswith('_UT')):
-            stationame=station.split('/')[-1].split('_' )[0]
-            codestn=name2code.name2code(stationame)
-            msg=prog+"=== now treating data in "+station+" from station: "+stationame+" (code="+codestn+") \n"
-            print "-------------------------"
-            log.write(msg)
-            print msg
-            #=================================================
-            # select the scamp *.head file that is the closest in time, and with a good contrast
-            # using the path to determine where to look for scamp xml file
-            head_file=gethead4event(my_detection_name,stationame)
-            print prog,"head_file=",head_file
-            if not os.path.isfile(head_file): 
-                msg=prog+"*** FATAL ERROR: head_file="+head_file+" not created for some reasons... \n"
-                log.write(msg)
-                sys.exit(msg+plzchklog)
-            # copy the best *.head file into the fits2D directory but remove the CRVAL lines
-            fits2Ddir=station+"/"+fits2D_dir
-            local_file="/".join([fits2Ddir,"head.head"])
-            if not userfri:
-                local_file=local_file.replace(data_dir,datadir)
-            if os.path.isfile(local_file):
-                os.remove(local_file)
-            cmd="grep -v CRVAL "+head_file+" > "+local_file
-            msg=prog+"now launching cmd="+cmd+"\n"
-            log.write(msg)
-            print msg
-            os.system(cmd)
-            if not os.path.isfile(local_file):
-                msg=prog+"*** FATAL ERROR: best *.head file could not be copied into "+local_file+" for some reasons \n"
-                log.write(msg)
-                sys.exit(msg)
-            msg=prog+head_file+" copied into "+local_file+" and CRVAL removed ok \n"
-            log.write(msg)
-            print msg
-            #=================================================
-            # launches sextractor with the good options, again using the path to get the mask file
-            msg=prog+"now relocating to "+fits2Ddir.replace(data_dir,datadir)+"\n"
-            log.write(msg)
-            print msg
-            os.chdir(fits2Ddir.replace(data_dir,datadir))
-            # first check if the cata files are already here => useless to run sextractor again (takes a lot of time...)
-            listcata=glob.glob("*.cata")
-            listfit=glob.glob("*.fit")
-            listhead=glob.glob("*.head")
-            msg=prog+"number of fit, cata and head files="+str(len(listfit))+" "+str(len(listcata))+" "+str(len(listhead))+"\n"
-            log.write(msg)
-            print msg
-            if not (len(listfit)==len(listcata) and (len(listfit)==len(listhead)-1)):
-                cmd=fripipe_shell_path+"/sexmet_auto_detect.sh "+stationame
-                msg=prog+"now launching cmd="+cmd+"\n"
-                log.write(msg)
-                print msg
-                os.system(cmd)
-            # now checks the result of the sexmet_auto_detect.sh script
-            # ADD HERE A WAY TO DOUBLE CHECK THAT THE PREVIOUS STEP IS OK
-            #=================================================
-            # launches the position2met.sh script
-            msg=prog+"now relocating to "+station.replace(data_dir,datadir)+"\n"
-            log.write(msg)
-            print msg
-            os.chdir(station.replace(data_dir,datadir))
-            log.write(msg)
-            print msg
-            met_file = station.split('/')[-1]+'.met'
-            msg=prog+"now launching the position2met process. Data will be saved in met_file="+met_file
-            log.write(msg)
-            print msg
-            position2met(position_file,fits2D_dir,met_file)
-    # end of loop over the stations
-    #=================================================
+                log.info(''.join([prog,"-------------------------------- \n",
+                             prog,"now launches the computation of trajectory and orbit for event in ",
+                             my_detection_dir]))
+                # compute_traj calls spiceypy itself: the kernels have to be loaded
+                with spice_lock:
+                    load_spice()
+                    compute_traj.compute_traj(my_detection_name)
+                stages.record('compute_traj',met_files,params,[])
+    except SystemExit as e:
+        raise _trajectory_error(log,ckpt,str(e.code),output_dir)
+    except Exception as e:
+        log.info(traceback.format_exc(),echo=False)
+        msg=prog+"*** FATAL ERROR: computation of the trajectory failed: "+repr(e)+"\n"
+        raise _trajectory_error(log,ckpt,msg,output_dir)
+    ckpt.succeed(checkpoint.trajectory_unit)
+    ckpt.save()
+    
+    log.info(''.join([prog,"-------------------------------- \n",
+                 prog,"Treatment of event ",my_event," done",
+                 (" without stations "+' '.join(failed) if failed else "")]))
+    return failed
+
+def _trajectory_error(log,ckpt,msg,output_dir):
+    """Log and checkpoint the failure of the trajectory of an event.
+    
+    Returns
+    -------
+    error : errors.event_error
+        Error to raise.
+    
+    """
+    log.info(msg,echo=False)
+    error=errors.event_error(msg+_plzchklog(output_dir),checkpoint.trajectory_unit)
+    ckpt.fail(checkpoint.trajectory_unit,error)
+    ckpt.save()
+    return error
+
+def user_datadir():
+    """Get the directory tree where the data are processed for the user.
+    
+    Returns
+    -------
+    datadir : string
+        path_and_file.data_dir for the fripon user, the home directory of
+        the user otherwise.
+    userfri : integer
+        1 if the user is fripon, 0 otherwise.
+    
+    """
+    user=os.environ['USER']
+    if not (user=="fripon"):
+        return "/home/"+user+"/",0
+    return path_and_file.data_dir,1
 
-    # launches the computation of orbits
-    msg=''.join([prog,"-------------------------------- \n",
-                 prog,"now launches the computation of trajectory and orbit for event in ",
-                 my_detection_dir,"\n"])
-    log.write(msg)
-    print msg
-    compute_traj.compute_traj(eventname)
-    
-    msg=''.join([prog,"-------------------------------- \n",
-                 prog,"Treatment of event ",my_event," done \n"])
-    log.write(msg)
-    print msg
+#=================================================
+#=================== MAIN ========================
+#=================================================
+prog="(processevent_from_arg.py) "
+syntax="python processevent_from_arg.py eventname [-n nworkers] [--force-stage stage] [--scratch dir] [--prometheus file]"
+# processing stages, recorded in the manifests
+stage_names=['gethead','headcopy','sexmet','position2met','metstore','compute_traj']
+# SPICE is used by one thread of the process at a time
+spice_lock=threading.RLock()
+fits2D_dir="fits2D"
+position_file="positions.txt"
 
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(usage=syntax)
+    parser.add_argument('eventname',help='name of the event to process')
+    parser.add_argument('-n','--nworkers',type=int,default=multiprocessing.cpu_count(),
+                        help='number of stations processed in parallel')
+    parser.add_argument('--force-stage',dest='force',action='append',default=[],
+                        choices=stage_names+[manifest.all_stages],
+                        help='stage to run again even if it is up to date (may be repeated)')
+    parser.add_argument('--scratch',default=None,
+                        help='local directory where the data are copied and processed')
+    parser.add_argument('--prometheus',default=None,
+                        help='Prometheus textfile where the metrics of the events are exported')
+    args=parser.parse_args()
+    eventname=args.eventname
+    print prog,"eventname=",eventname
+    if not len(eventname):
+        sys.exit(prog+"*** FATAL ERROR: please specify the event name. syntax is"+syntax)
+    yyyymm=eventname[:6]
+    eventdir="/".join([path_and_file.work_mult_dir,yyyymm,eventname])
+    print prog,"evendir=",eventdir
+    datadir,userfri=user_datadir()
+    stage_mode=staging.link
+    if args.scratch is not None:
+        datadir=args.scratch.rstrip('/')+'/'
+        userfri=0
+        stage_mode=staging.copy
+        if not os.path.isdir(datadir+"/detections/multiple"):
+            os.makedirs(datadir+"/detections/multiple")
+    fripon_detectdir=datadir+"/detections/multiple"
 
+    # verification
+    if not os.path.isfile(path_and_file.fri_station_file):
+        sys.exit(prog+" ### FATAL ERROR:  fri_station_file: "+path_and_file.fri_station_file+" does not exist")
+    if not os.path.isdir(fripon_detectdir):
+        sys.exit(prog+" #### FATAL ERROR: fripon_detectdir: "+fripon_detectdir+" does not exist")
 
-msg=prog+'done'
-log.write(msg)
-print msg
+    #=================================================
+    # loop over the detections
+    allevents=glob.glob("/".join([path_and_file.work_mult_dir,yyyymm,eventname+"*"]))
+    if (len(allevents)==0):
+        sys.exit(prog+" *** FATAL ERROR: There is no event "+eventname)
+    else:
+        print prog,"List of events to process: ",allevents
+    # kernels of the stations, built once for all the events and furnished in this process
+    spicekernels.build()
+    load_spice()
+    failed=[]
+    for my_event in allevents:
+        try:
+            log=process_event(my_event,datadir,userfri,args.nworkers,args.force,stage_mode,
+                              args.prometheus)
+            log.close()
+        except errors.pipeline_error as e:
+            # the other events go on, the next run retries the failed units
+            print str(e)
+            failed.append(my_event)
+        except Exception:
+            print prog+"*** ERROR: event "+my_event+" failed:"
+            traceback.print_exc()
+            failed.append(my_event)
+    if failed:
+        sys.exit(prog+"*** FATAL ERROR: "+str(len(failed))+" events failed: "+' '.join(failed))
 
+    print prog+'done'
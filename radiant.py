@@ -0,0 +1,291 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Compute the radiants and heliocentric orbits of many meteoroids at once,
+  from their entry states (was: one launch of the radiant F90 program,
+  path_and_file.work_radiant_exe, per trajectory)
+ -compare them with the output of the F90 program on a reference set
+
+The entry state of a meteoroid is its epoch (TDB seconds past J2000, see
+sp.str2et), and its position [m] and velocity [m/s] in the Earth fixed
+frame (spicekernels.center_frame by default; ecef_state builds them from
+geodetic coordinates and East-North-Up velocities). SPICE is called once per
+distinct epoch, for the rotation of the Earth and the state of the Earth
+around the Sun, with the kernels loaded by initialize.load_spice; all the
+rest is computed on NumPy arrays:
+ -the geocentric state in J2000 (velocity including the rotation of the
+  Earth), the geocentric velocity at infinity and the geocentric radiant,
+  from the incoming asymptote of the hyperbolic orbit around the Earth
+  (correction of the Earth attraction)
+ -the heliocentric state: the velocity at infinity plus the velocity of the
+  Earth, at the position of the meteoroid
+ -the osculating heliocentric elements in the ecliptic and equinox J2000.
+Distances are in km and speeds in km/s unless stated otherwise, angles in
+degrees.
+
+"""
+import sys
+import numpy as np
+from fripipe import spicekernels
+
+prog="(radiant.py) "
+
+# astronomical unit [km]
+au_km=149597870.7
+# inertial and ecliptic frames
+inertial_frame='J2000'
+ecliptic_frame='ECLIPJ2000'
+# names of the results, in the order of the columns of the reference files
+result_names=['ra_g','dec_g','v_g','ra_h','dec_h','v_h','a','q','e','i','node','peri','nu']
+# tolerances of the comparison with the F90 program: angles [deg], speeds
+# [km/s], distances [AU], eccentricity
+tolerances={'ra_g':0.01,'dec_g':0.01,'v_g':0.01,'ra_h':0.01,'dec_h':0.01,'v_h':0.01,
+            'a':0.01,'q':0.001,'e':0.001,'i':0.01,'node':0.01,'peri':0.01,'nu':0.01}
+
+def _dot(u,v):
+    """Row by row dot product of (n,3) arrays."""
+    return np.einsum('ij,ij->i',u,v)
+
+def _norm(u):
+    """Row by row norm of a (n,3) array."""
+    return np.sqrt(_dot(u,u))
+
+def _radec(u):
+    """Right ascension in [0,360[ and declination of (n,3) vectors [deg]."""
+    return (np.degrees(np.arctan2(u[:,1],u[:,0]))%360.0,
+            np.degrees(np.arctan2(u[:,2],np.hypot(u[:,0],u[:,1]))))
+
+def ecef_state(lat,lon,alt,vel_e,vel_n,vel_u,ell=None):
+    """Earth fixed state from geodetic coordinates and topocentric velocity.
+
+    Parameters
+    ----------
+    lat, lon, alt : numpy.ndarray
+        Geodetic latitude, longitude [deg] and altitude [m].
+    vel_e, vel_n, vel_u : numpy.ndarray
+        Velocity in the East-North-Up frame of the point [m/s].
+    ell : geodesy.ellipsoid
+        Ellipsoid (default: geodesy.get_ellipsoid()).
+
+    Returns
+    -------
+    position, velocity : numpy.ndarray
+        Earth fixed position [m] and velocity [m/s], (n,3).
+
+    """
+    from fripipe import geodesy
+    x,y,z=geodesy.geodetic2ecef(lat,lon,alt,ell)
+    vx,vy,vz=geodesy.enu2ecef(vel_e,vel_n,vel_u,lat,lon,alt,ell)
+    position=np.column_stack(np.broadcast_arrays(x,y,z))
+    velocity=np.column_stack(np.broadcast_arrays(vx-x,vy-y,vz-z))
+    return position,velocity
+
+def elements(position,velocity,mu):
+    """Osculating orbital elements of states, vectorized.
+
+    Parameters
+    ----------
+    position, velocity : numpy.ndarray
+        Positions [km] and velocities [km/s], (n,3).
+    mu : float
+        Gravitational parameter of the central body [km^3/s^2].
+
+    Returns
+    -------
+    elements : dict
+        'a' semi-major axis [km] (negative for hyperbolic orbits), 'q'
+        perihelion distance [km], 'e' eccentricity, 'i' inclination, 'node'
+        longitude of the ascending node, 'peri' argument of perihelion, 'nu'
+        true anomaly [deg].
+
+    """
+    r=_norm(position)
+    v2=_dot(velocity,velocity)
+    rv=_dot(position,velocity)
+    h=np.cross(position,velocity)
+    hnorm=_norm(h)
+    evec=((v2-mu/r)[:,None]*position-rv[:,None]*velocity)/mu
+    e=_norm(evec)
+    # node vector z x h, undefined for equatorial orbits (taken along x)
+    node=np.column_stack([-h[:,1],h[:,0],np.zeros(len(h))])
+    nnorm=_norm(node)
+    equatorial=nnorm<=1e-12*hnorm
+    node[equatorial]=[1.0,0.0,0.0]
+    nnorm[equatorial]=1.0
+    with np.errstate(divide='ignore'):
+        a=1.0/(2.0/r-v2/mu)
+    # argument of perihelion and true anomaly, signed by the out of plane components
+    q_vec=np.cross(h,node)/(hnorm*nnorm)[:,None]
+    peri=np.degrees(np.arctan2(_dot(evec,q_vec),_dot(evec,node)/nnorm))%360.0
+    p_vec=evec/np.where(e>0.0,e,1.0)[:,None]
+    w_vec=np.cross(h,p_vec)/hnorm[:,None]
+    nu=np.degrees(np.arctan2(_dot(position,w_vec),_dot(position,p_vec)))%360.0
+    return {'a':a,'q':hnorm**2/mu/(1.0+e),'e':e,
+            'i':np.degrees(np.arccos(np.clip(h[:,2]/hnorm,-1.0,1.0))),
+            'node':np.degrees(np.arctan2(h[:,0],-h[:,1]))%360.0,
+            'peri':peri,'nu':nu}
+
+def _epoch_terms(et,frame,sp):
+    """SPICE terms of each distinct epoch, gathered for all the states.
+
+    Returns
+    -------
+    xform : numpy.ndarray
+        State transformation matrices from frame to J2000, (n,6,6).
+    earth : numpy.ndarray
+        State of the Earth around the Sun in J2000 [km,km/s], (n,6).
+
+    """
+    epochs,inverse=np.unique(et,return_inverse=True)
+    xform=np.empty((len(epochs),6,6))
+    earth=np.empty((len(epochs),6))
+    for k,epoch in enumerate(epochs):
+        xform[k]=sp.sxform(frame,inertial_frame,epoch)
+        earth[k]=sp.spkezr('EARTH',epoch,inertial_frame,'NONE','SUN')[0]
+    return xform[inverse],earth[inverse]
+
+def radiants(et,position,velocity,frame=None,sp=None):
+    """Radiants and heliocentric orbits of meteoroids from their entry states.
+
+    Parameters
+    ----------
+    et : numpy.ndarray
+        Epochs of the states, TDB seconds past J2000, (n,).
+    position : numpy.ndarray
+        Positions in the Earth fixed frame [m], (n,3).
+    velocity : numpy.ndarray
+        Velocities relative to the Earth fixed frame [m/s], (n,3).
+    frame : string
+        Earth fixed frame (default: spicekernels.center_frame).
+    sp : module
+        spiceypy module, with the kernels loaded (default:
+        initialize.load_spice()).
+
+    Returns
+    -------
+    results : dict
+        Arrays of n values:
+        'ra_g', 'dec_g' geocentric radiant (J2000) [deg], 'v_g' geocentric
+        velocity at infinity [km/s];
+        'ra_h', 'dec_h' heliocentric radiant (J2000) [deg], 'v_h'
+        heliocentric velocity [km/s];
+        'a' semi-major axis [AU] (negative for hyperbolic orbits), 'q'
+        perihelion distance [AU], 'e' eccentricity, 'i' inclination,
+        'node' longitude of the ascending node, 'peri' argument of
+        perihelion, 'nu' true anomaly (ecliptic J2000) [deg].
+
+    """
+    if sp is None:
+        from fripipe.initialize import load_spice
+        sp=load_spice()
+    if frame is None:
+        frame=spicekernels.center_frame
+    et=np.atleast_1d(np.asarray(et,dtype=float))
+    state=np.hstack([np.atleast_2d(position),np.atleast_2d(velocity)])/1000.0
+    state=np.broadcast_to(state,(len(et),6)) if len(state)==1 else state
+    mu_earth=sp.bodvrd('EARTH','GM',1)[1][0]
+    mu_sun=sp.bodvrd('SUN','GM',1)[1][0]
+    xform,earth=_epoch_terms(et,frame,sp)
+    # geocentric state in J2000, the velocity including the rotation of the Earth
+    geo=np.einsum('nij,nj->ni',xform,state)
+    r=geo[:,:3]
+    v=geo[:,3:]
+    rnorm=_norm(r)
+    v2=_dot(v,v)
+    # hyperbolic orbit around the Earth: speed and direction at infinity
+    v_g=np.sqrt(np.maximum(v2-2.0*mu_earth/rnorm,0.0))
+    h=np.cross(r,v)
+    evec=((v2-mu_earth/rnorm)[:,None]*r-_dot(r,v)[:,None]*v)/mu_earth
+    e=np.maximum(_norm(evec),1.0+1e-12)
+    p_vec=evec/e[:,None]
+    q_vec=np.cross(h,p_vec)/_norm(h)[:,None]
+    incoming=(p_vec+np.sqrt(e*e-1.0)[:,None]*q_vec)/e[:,None]
+    # the meteoroid comes from the opposite of its velocity
+    ra_g,dec_g=_radec(-incoming)
+    # heliocentric state, in the ecliptic J2000 for the elements
+    v_inf=v_g[:,None]*incoming
+    helio_r=earth[:,:3]+r
+    helio_v=earth[:,3:]+v_inf
+    ra_h,dec_h=_radec(-helio_v)
+    rotation=np.array(sp.pxform(inertial_frame,ecliptic_frame,0.0))
+    orbit=elements(helio_r.dot(rotation.T),helio_v.dot(rotation.T),mu_sun)
+    orbit['a']=orbit['a']/au_km
+    orbit['q']=orbit['q']/au_km
+    orbit.update({'ra_g':ra_g,'dec_g':dec_g,'v_g':v_g,
+                  'ra_h':ra_h,'dec_h':dec_h,'v_h':_norm(helio_v)})
+    return orbit
+
+def read_reference(reference_file):
+    """Read a reference set computed by the F90 radiant program.
+
+    The file has one row per trajectory and a header line (commented with
+    '#') naming the columns: et, x, y, z [m], vx, vy, vz [m/s] (Earth fixed
+    entry state), and the results of the F90 program, named as in
+    result_names (any subset of them).
+
+    Returns
+    -------
+    table : dict
+        Column name -> numpy.ndarray.
+
+    """
+    header=None
+    with open(reference_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                header=line.lstrip('#').split()
+            elif line.strip():
+                break
+    if header is None:
+        sys.exit(prog+"*** FATAL ERROR: no header line in "+reference_file)
+    data=np.loadtxt(reference_file,ndmin=2,comments='#')
+    return dict((name,data[:,i]) for i,name in enumerate(header))
+
+def compare(reference_file,sp=None):
+    """Compare radiants with the output of the F90 program on a reference set.
+
+    Parameters
+    ----------
+    reference_file : string
+        Full path of the reference set, see read_reference.
+    sp : module
+        spiceypy module (default: initialize.load_spice()).
+
+    Returns
+    -------
+    differences : dict
+        Result name -> maximum absolute difference with the F90 program
+        (angles wrapped to [-180,180[), for the results of the file.
+
+    """
+    table=read_reference(reference_file)
+    missing=[name for name in ['et','x','y','z','vx','vy','vz'] if name not in table]
+    if missing:
+        sys.exit(prog+"*** FATAL ERROR: columns "+' '.join(missing)+" missing from "+reference_file)
+    results=radiants(table['et'],
+                     np.column_stack([table['x'],table['y'],table['z']]),
+                     np.column_stack([table['vx'],table['vy'],table['vz']]),sp=sp)
+    differences={}
+    for name in result_names:
+        if name not in table:
+            continue
+        diff=results[name]-table[name]
+        if name in ('ra_g','ra_h','node','peri','nu'):
+            diff=(diff+180.0)%360.0-180.0
+        differences[name]=float(np.max(np.abs(diff))) if len(diff) else 0.0
+        flag='' if differences[name]<=tolerances[name] else ' *** WARNING: above tolerance %g'%tolerances[name]
+        print prog+'%s: max difference with F90 = %.3g%s'%(name,differences[name],flag)
+    return differences
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    if len(sys.argv)!=2:
+        sys.exit(prog+"*** FATAL ERROR: syntax is: python radiant.py reference_file")
+    differences=compare(sys.argv[1])
+    if any(value>tolerances[name] for name,value in differences.items()):
+        sys.exit(prog+"*** FATAL ERROR: results differ from the F90 program")
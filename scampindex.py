@@ -0,0 +1,160 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose: 
+ -Persistent index of the scamp calibrations of a station
+ -select the best scamp head file for a given date
+
+The scamp.xml file of a station is parsed once and the Observation_Date,
+XY_Contrast and Catalog_Name columns are saved, sorted by date, in a NumPy
+.npz file next to it (or in the user cache directory if the scamp directory
+is not writable). The index is rebuilt only when the modification time of
+scamp.xml changes, and is kept in memory for the rest of the process.
+
+"""
+import os
+import numpy as np
+from fripipe import atomicfile
+
+prog="(scampindex.py) "
+
+# suffix of the index file, saved next to scamp.xml
+index_suffix='_index.npz'
+# fallback directory for the index files, if scamp directory is not writable
+user_index_dir=os.path.expanduser('~/.fripipe/scampindex/')
+
+# in-process cache: scamp.xml file name -> (mtime, index)
+_indexes={}
+
+def index_file(scampxml):
+    """Name of the index file of a scamp.xml file.
+    
+    Parameters
+    ----------
+    scampxml : string
+        Full path of the scamp.xml file.
+    
+    Returns
+    -------
+    indexfile : string
+        Full path of the .npz index file.
+    
+    """
+    scampdir=os.path.dirname(os.path.abspath(scampxml))
+    if os.access(scampdir,os.W_OK):
+        return os.path.splitext(scampxml)[0]+index_suffix
+    name=os.path.abspath(scampxml).strip('/').replace('/','_')
+    return user_index_dir+os.path.splitext(name)[0]+index_suffix
+
+def build_index(scampxml):
+    """Parse a scamp.xml file and build its index.
+    
+    Parameters
+    ----------
+    scampxml : string
+        Full path of the scamp.xml file.
+    
+    Returns
+    -------
+    index : dict
+        'date' (decimal year), 'contrast' and 'catname' arrays, sorted by date.
+    
+    """
+    # astropy is only needed when the index has to be rebuilt
+    from astropy.io.votable import parse
+    table=parse(scampxml).get_first_table()
+    date=np.asarray(table.array['Observation_Date'].data,dtype=float)
+    contrast=np.asarray(table.array['XY_Contrast'].data,dtype=float)
+    catname=np.asarray(table.array['Catalog_Name'].data).astype(str)
+    order=np.argsort(date,kind='mergesort')
+    return {'date':date[order],'contrast':contrast[order],'catname':catname[order]}
+
+def load_index(scampxml):
+    """Get the index of a scamp.xml file, rebuilding it only if needed.
+    
+    Parameters
+    ----------
+    scampxml : string
+        Full path of the scamp.xml file.
+    
+    Returns
+    -------
+    index : dict
+        'date' (decimal year), 'contrast' and 'catname' arrays, sorted by date.
+    
+    """
+    mtime=os.path.getmtime(scampxml)
+    cached=_indexes.get(scampxml)
+    if cached is not None and cached[0]==mtime:
+        return cached[1]
+    indexfile=index_file(scampxml)
+    index=None
+    if os.path.isfile(indexfile):
+        try:
+            npz=np.load(indexfile)
+            if float(npz['mtime'])==mtime:
+                index={'date':npz['date'],'contrast':npz['contrast'],
+                       'catname':npz['catname']}
+            npz.close()
+        except (IOError,OSError,KeyError,ValueError):
+            index=None
+    if index is None:
+        index=build_index(scampxml)
+        save_index(indexfile,mtime,index)
+    _indexes[scampxml]=(mtime,index)
+    return index
+
+def save_index(indexfile,mtime,index):
+    """Save an index file atomically.
+    
+    Parameters
+    ----------
+    indexfile : string
+        Full path of the .npz index file.
+    mtime : float
+        Modification time of the scamp.xml file the index was built from.
+    index : dict
+        'date', 'contrast' and 'catname' arrays.
+    
+    Returns
+    -------
+    None.
+    
+    """
+    atomicfile.save_cache(indexfile,lambda out:np.savez(out,mtime=mtime,**index),prog)
+
+def select_catalog(index,eventdecimalyear,mincontrast=5.0,maxdeltat=30.0):
+    """Select the calibration closest in time with a good enough contrast.
+    
+    Parameters
+    ----------
+    index : dict
+        Index of a scamp.xml file, see load_index.
+    eventdecimalyear : float
+        Date of the event, in decimal year.
+    mincontrast : float
+        minimum contrast required for the calibration.
+    maxdeltat : float
+        maximum time difference between the date of the event and that
+        of the calibration. Unit is days.
+    
+    Returns
+    -------
+    catname : string
+        Catalog_Name of the selected calibration, None if there is none.
+    
+    """
+    good=np.flatnonzero(index['contrast']>=mincontrast)
+    if (len(good)==0):
+        return None
+    date=index['date'][good]
+    # dates are sorted: the closest one is on either side of the event date
+    i=np.searchsorted(date,eventdecimalyear)
+    candidates=np.array([max(i-1,0),min(i,len(date)-1)])
+    deltatime=np.abs(date[candidates]-eventdecimalyear)*365.25
+    best=np.argmin(deltatime)
+    if (deltatime[best]>maxdeltat):
+        return None
+    return index['catname'][good[candidates[best]]]
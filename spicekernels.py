@@ -0,0 +1,330 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Build the SPICE kernels of all the stations in one pass: station SPK and
+  topocentric frame kernel (FK), camera instrument kernel (IK)
+ -cache them by version of the station metadata, and load them through one
+  meta-kernel
+
+The kernels are built from the metadata of the station registry (code,
+latitude, longitude, altitude, camera): the SPK and the FK by one run of
+the SPICE pinpoint program of path_and_file.spice_exe_path for all the
+stations, the IK written directly. They are saved in a directory of
+path_and_file.station_kernel_dir named after the SHA-1 of the metadata, and
+never built again while the metadata do not change. The meta-kernel
+path_and_file.station_metakernel points to the current directory; it is
+furnished by initialize.load_spice, once per process, and furnished again
+only if a new version of the kernels is built.
+
+Each station gets a NAIF ID that does not depend on the other stations:
+the 'naif_id' column of the station file if it has one, first_id plus the
+CRC-32 of its code modulo id_range otherwise, so that adding or removing a
+station never renumbers the others. Two stations with the same ID are a
+fatal error: give one of them a naif_id in the station file. The name of a
+station is its code; its topocentric frame is <code>_TOPO (+Z up, +X
+north). Its camera gets the instrument ID -(station ID) and the name
+<code>_CAM, with an all-sky field of view of fov_angle degrees around the
+zenith.
+
+"""
+import os
+import sys
+import shutil
+import zlib
+import hashlib
+import subprocess
+from fripipe.initialize import path_and_file
+from fripipe import stations
+from fripipe import atomicfile
+
+prog="(spicekernels.py) "
+
+# version of the layout of the kernels: changing it builds them again
+kernel_version='2'
+# NAIF IDs of the stations: first_id+(CRC-32 of the code)%id_range, up to 399999999
+first_id=399100000
+id_range=900000
+# reference body and frame of the stations
+center_id=399
+center_frame='IAU_EARTH'
+# time coverage of the station SPK
+bounds=('1980-JAN-01','2100-JAN-01')
+# half angle of the field of view of the cameras [deg]: all-sky, SPICE requires less than 90
+fov_angle=89.0
+# names of the kernels in a version directory
+spk_name='stations.bsp'
+fk_name='stations.tf'
+ik_name='cameras.ti'
+def_name='stations.def'
+# number of versions kept in station_kernel_dir
+nkeep=5
+# maximum length of a string of a SPICE text kernel
+max_string=78
+
+# meta-kernel furnished in this process: (path, mtime)
+_loaded=None
+# warning about a missing pinpoint program already printed
+_warned=False
+
+def station_id(stn):
+    """NAIF ID of a station: its naif_id in the station file, or the hash of its code."""
+    naif_id=stn.metadata.get('naif_id')
+    if naif_id:
+        return int(naif_id)
+    return first_id+(zlib.crc32(stn.code)&0xffffffff)%id_range
+
+def camera_id(stn):
+    """NAIF instrument ID of the camera of a station."""
+    return -station_id(stn)
+
+def kernel_stations(stns=None):
+    """Stations that have the metadata needed for their kernels.
+
+    Parameters
+    ----------
+    stns : list of stations.station
+        Stations (default: all the stations of the registry).
+
+    Returns
+    -------
+    stns : list of stations.station
+        Stations with a latitude and a longitude, sorted by code.
+
+    """
+    if stns is None:
+        stns=stations.get_registry().all()
+    selected=[]
+    for stn in sorted(stns,key=lambda stn:stn.code):
+        if stn.latitude is None or stn.longitude is None:
+            print prog+'*** WARNING: no location for station '+stn.code+': no kernel built'
+            continue
+        selected.append(stn)
+    codes={}
+    for stn in selected:
+        other=codes.setdefault(station_id(stn),stn.code)
+        if other!=stn.code:
+            sys.exit(''.join([prog,'*** FATAL ERROR: stations ',other,' and ',stn.code,
+                              ' have the same NAIF ID ',str(station_id(stn)),
+                              ': give one of them a naif_id in the station file']))
+    return selected
+
+def metadata_key(stns):
+    """Version of the kernels: SHA-1 of the metadata of the stations."""
+    sha1=hashlib.sha1()
+    sha1.update(kernel_version)
+    sha1.update(repr((center_frame,bounds,fov_angle,tuple(path_and_file.fri_detector_dim.value))))
+    for stn in stns:
+        sha1.update(repr((stn.code,station_id(stn),stn.latitude,stn.longitude,stn.altitude or 0.0,
+                          stn.camera)))
+    return sha1.hexdigest()
+
+def _kernel_string(value):
+    """Quoted string of a text kernel, continued with '+' if too long."""
+    chunks=[value[i:i+max_string-3] for i in range(0,len(value),max_string-3)] or ['']
+    return '\n'.join("'"+chunk.replace("'","''")+("+'" if i<len(chunks)-1 else "'")
+                     for i,chunk in enumerate(chunks))
+
+def write_definitions(filename,stns):
+    """Write the pinpoint definitions file of the stations.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the definitions file.
+    stns : list of stations.station
+        Stations, sorted by code.
+
+    Returns
+    -------
+    None.
+
+    """
+    with open(filename,'w') as out:
+        out.write('FRIPON stations, for pinpoint\n\\begindata\n')
+        out.write('SITES = ( '+' '.join("'"+stn.code+"'" for stn in stns)+' )\n')
+        for stn in stns:
+            out.write(stn.code+'_CENTER = '+str(center_id)+'\n')
+            out.write(stn.code+"_FRAME = '"+center_frame+"'\n")
+            out.write(stn.code+'_IDCODE = '+str(station_id(stn))+'\n')
+            out.write(stn.code+'_LATLON = ( %.8f %.8f %.6f )\n'%(stn.latitude,stn.longitude,
+                                                                  (stn.altitude or 0.0)/1000.0))
+            out.write(stn.code+'_BOUNDS = ( @'+bounds[0]+' @'+bounds[1]+' )\n')
+            out.write(stn.code+"_UP = 'Z'\n")
+            out.write(stn.code+"_NORTH = 'X'\n")
+        out.write('\\begintext\n')
+
+def write_instruments(filename,stns):
+    """Write the instrument kernel of the cameras of the stations.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the instrument kernel.
+    stns : list of stations.station
+        Stations, sorted by code.
+
+    Returns
+    -------
+    None.
+
+    """
+    nx,ny=[int(n) for n in path_and_file.fri_detector_dim.value]
+    with open(filename,'w') as out:
+        out.write('KPL/IK\nFRIPON cameras, all-sky field of view around the zenith.\n\\begindata\n')
+        out.write('NAIF_BODY_NAME += ( '+' '.join("'"+stn.code+"_CAM'" for stn in stns)+' )\n')
+        out.write('NAIF_BODY_CODE += ( '+' '.join(str(camera_id(stn)) for stn in stns)+' )\n')
+        for stn in stns:
+            ins='INS'+str(camera_id(stn))
+            out.write(ins+'_CAMERA = '+_kernel_string(stn.camera)+'\n')
+            out.write(ins+"_FOV_FRAME = '"+stn.code+"_TOPO'\n")
+            out.write(ins+"_FOV_SHAPE = 'CIRCLE'\n")
+            out.write(ins+'_BORESIGHT = ( 0.0 0.0 1.0 )\n')
+            out.write(ins+"_FOV_CLASS_SPEC = 'ANGLES'\n")
+            out.write(ins+'_FOV_REF_VECTOR = ( 1.0 0.0 0.0 )\n')
+            out.write(ins+'_FOV_REF_ANGLE = %.1f\n'%fov_angle)
+            out.write(ins+"_FOV_ANGLE_UNITS = 'DEGREES'\n")
+            out.write(ins+'_PIXEL_SAMPLES = '+str(nx)+'\n')
+            out.write(ins+'_PIXEL_LINES = '+str(ny)+'\n')
+        out.write('\\begintext\n')
+
+def write_metakernel(filename,kernel_dir):
+    """Write the meta-kernel of the kernels of a version directory, atomically."""
+    with atomicfile.open_atomic(filename) as out:
+        out.write('KPL/MK\nKernels of the FRIPON stations, see spicekernels.py\n\\begindata\n')
+        out.write('PATH_VALUES = ( '+_kernel_string(kernel_dir.rstrip('/'))+' )\n')
+        out.write("PATH_SYMBOLS = ( 'STN' )\n")
+        out.write('KERNELS_TO_LOAD = ( '+' '.join("'$STN/"+name+"'" for name in (spk_name,fk_name,ik_name))+' )\n')
+        out.write('\\begintext\n')
+
+def pinpoint_exe():
+    """Full path of the pinpoint program."""
+    return os.path.join(path_and_file.spice_exe_path,'pinpoint')
+
+def build(stns=None,force=False):
+    """Build the kernels of all the stations, unless they are up to date.
+
+    Parameters
+    ----------
+    stns : list of stations.station
+        Stations (default: all the stations of the registry).
+    force : boolean
+        If True, build the kernels even if they exist.
+
+    Returns
+    -------
+    metakernel : string
+        Full path of the meta-kernel of the stations, None if the kernels
+        could not be built (no station, or no pinpoint program).
+
+    """
+    global _warned
+    stns=kernel_stations(stns)
+    if (len(stns)==0):
+        print prog+'*** WARNING: no station with a location: no kernel built'
+        return None
+    key=metadata_key(stns)
+    directory=path_and_file.station_kernel_dir
+    kernel_dir=os.path.join(directory,key)
+    metakernel=path_and_file.station_metakernel
+    if os.path.isdir(kernel_dir) and not force:
+        if not _points_to(metakernel,kernel_dir):
+            write_metakernel(metakernel,kernel_dir)
+        return metakernel
+    exe=pinpoint_exe()
+    pck=path_and_file.spice_pck_file
+    if not (os.path.isfile(exe) and os.path.isfile(pck)):
+        if not _warned:
+            print prog+'*** WARNING: '+exe+' or '+pck+' does not exist: no station kernel built'
+            _warned=True
+        return None
+    # build in a temporary directory, renamed at the end: processes may build at the same time
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmpdir=atomicfile.tmp_name(kernel_dir)
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    try:
+        defs=os.path.join(tmpdir,def_name)
+        write_definitions(defs,stns)
+        cmd=[exe,'-def',defs,'-spk',os.path.join(tmpdir,spk_name),'-pck',pck,
+             '-fk',os.path.join(tmpdir,fk_name),'-batch']
+        proc=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output=proc.communicate()[0]
+        if proc.returncode!=0 or not os.path.isfile(os.path.join(tmpdir,fk_name)):
+            sys.exit(prog+'*** FATAL ERROR: '+' '.join(cmd)+' failed:\n'+output)
+        write_instruments(os.path.join(tmpdir,ik_name),stns)
+        if force and os.path.isdir(kernel_dir):
+            shutil.rmtree(kernel_dir)
+        try:
+            os.rename(tmpdir,kernel_dir)
+        except OSError:
+            # built by another process meanwhile
+            if not os.path.isdir(kernel_dir):
+                raise
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+    write_metakernel(metakernel,kernel_dir)
+    print prog+'kernels of '+str(len(stns))+' stations built in '+kernel_dir
+    _clean(directory,kernel_dir)
+    return metakernel
+
+def _points_to(metakernel,kernel_dir):
+    """True if a meta-kernel loads the kernels of a version directory."""
+    if not os.path.isfile(metakernel):
+        return False
+    with open(metakernel) as f:
+        return os.path.basename(kernel_dir.rstrip('/')) in f.read()
+
+def _clean(directory,current):
+    """Remove the oldest version directories, keeping nkeep of them."""
+    versions=[os.path.join(directory,name) for name in os.listdir(directory)
+              if len(name)==40 and os.path.isdir(os.path.join(directory,name))]
+    versions.sort(key=os.path.getmtime,reverse=True)
+    for old in versions[nkeep:]:
+        if old!=current:
+            shutil.rmtree(old,ignore_errors=True)
+
+def load(sp):
+    """Furnish the meta-kernel of the stations, once per process.
+
+    The meta-kernel is furnished again only if it was rewritten for a new
+    version of the kernels; the kernels of the previous version are then
+    unloaded first.
+
+    Parameters
+    ----------
+    sp : module
+        spiceypy module.
+
+    Returns
+    -------
+    metakernel : string
+        Full path of the meta-kernel furnished, None if there is none.
+
+    """
+    global _loaded
+    metakernel=path_and_file.station_metakernel
+    if not os.path.isfile(metakernel):
+        return None
+    state=(metakernel,os.path.getmtime(metakernel))
+    if _loaded==state:
+        return metakernel
+    if _loaded is not None:
+        sp.unload(_loaded[0])
+    sp.furnsh(metakernel)
+    _loaded=state
+    return metakernel
+
+#=================================================
+#=================== MAIN ========================
+#=================================================
+if __name__ == '__main__':
+    metakernel=build(force='--force' in sys.argv[1:])
+    if metakernel is None:
+        sys.exit(prog+'*** FATAL ERROR: no station kernel built')
+    print prog+'meta-kernel of the stations: '+metakernel
@@ -0,0 +1,205 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Stage the data of an event into the directory tree of a user
+
+Each source directory is read once, with os.scandir when it is available,
+and the destination directory is read once to know what is already staged;
+a copy is made again when its size or modification time differs from that
+of its source.
+The files are then either symbolic-linked in bulk, or copied with a pool of
+threads when the source is on slow storage and the destination is a local
+scratch directory. A single summary is returned for each directory.
+
+"""
+import os
+import time
+import shutil
+import fnmatch
+from multiprocessing.pool import ThreadPool
+from fripipe import atomicfile
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # fall back to os.listdir
+        scandir=None
+
+prog="(staging.py) "
+
+# files of a fits2D directory to stage
+fits2D_patterns=['*.fit','*.cata','frame*.head']
+# staged files removed once an event is done, the catalogs being kept
+frame_patterns=['*.fit']
+# staging modes
+link='link'
+copy='copy'
+# default number of threads copying files
+default_nthreads=8
+
+def list_files(directory):
+    """List the names of the files of a directory, in a single pass.
+
+    Parameters
+    ----------
+    directory : string
+        Full path of the directory.
+
+    Returns
+    -------
+    names : list of string
+        Names of the files (or links to files) of the directory.
+
+    """
+    if scandir is not None:
+        return [entry.name for entry in scandir(directory) if entry.is_file()]
+    return [name for name in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory,name))]
+
+def select(names,patterns):
+    """Select the file names matching any of the patterns."""
+    return [name for name in names
+            if any(fnmatch.fnmatchcase(name,pattern) for pattern in patterns)]
+
+def _copy(args):
+    """Copy a file atomically: to a temporary file, then rename."""
+    src,dst=args
+    atomicfile.copy_atomic(src,dst,shutil.copy2)
+
+def _same_copy(src,dst):
+    """Tell if dst is a copy of src: same size and modification time (to the second)."""
+    try:
+        srcstat=os.stat(src)
+        dststat=os.stat(dst)
+    except OSError:
+        return False
+    return (srcstat.st_size==dststat.st_size and
+            int(srcstat.st_mtime)==int(dststat.st_mtime))
+
+def stage_files(srcdir,dstdir,names,mode=link,nthreads=default_nthreads):
+    """Stage files of a directory into another one.
+
+    Parameters
+    ----------
+    srcdir : string
+        Full path of the source directory.
+    dstdir : string
+        Full path of the destination directory, created if needed.
+    names : list of string
+        Names of the files to stage.
+    mode : string
+        'link' to create symbolic links, 'copy' to copy the files.
+    nthreads : integer
+        Number of threads copying files, in 'copy' mode.
+
+    Returns
+    -------
+    nstaged : integer
+        Number of files staged. The files already in dstdir are skipped:
+        the links, and the copies of the same size and modification time
+        as their source (copy2 keeps it), a source replaced since being
+        copied again.
+
+    """
+    if not os.path.isdir(dstdir):
+        os.makedirs(dstdir)
+    existing=set(os.listdir(dstdir))
+    todo=[(os.path.join(srcdir,name),os.path.join(dstdir,name))
+          for name in names if name not in existing or (mode==copy and
+          not _same_copy(os.path.join(srcdir,name),os.path.join(dstdir,name)))]
+    if (len(todo)==0):
+        return 0
+    if (mode==link):
+        for src,dst in todo:
+            os.symlink(src,dst)
+    elif (mode==copy):
+        pool=ThreadPool(max(1,min(nthreads,len(todo))))
+        try:
+            pool.map(_copy,todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        raise ValueError(prog+'unknown staging mode: '+str(mode))
+    return len(todo)
+
+def stage_directory(srcdir,dstdir,patterns=fits2D_patterns,mode=link,
+                    nthreads=default_nthreads):
+    """Stage the files of a directory matching some patterns.
+
+    Parameters
+    ----------
+    srcdir : string
+        Full path of the source directory.
+    dstdir : string
+        Full path of the destination directory, created if needed.
+        If dstdir is srcdir, nothing is staged.
+    patterns : list of string
+        Shell patterns of the files to stage.
+    mode : string
+        'link' to create symbolic links, 'copy' to copy the files.
+    nthreads : integer
+        Number of threads copying files, in 'copy' mode.
+
+    Returns
+    -------
+    summary : dict
+        'srcdir', 'dstdir', 'mode', 'nfiles' (number of files in srcdir),
+        'nselected' (number of files matching the patterns), 'nstaged'
+        (number of files staged) and 'duration' (in seconds).
+
+    """
+    start=time.time()
+    names=list_files(srcdir)
+    selected=select(names,patterns)
+    nstaged=0
+    if os.path.abspath(srcdir)!=os.path.abspath(dstdir):
+        nstaged=stage_files(srcdir,dstdir,selected,mode,nthreads)
+    return {'srcdir':srcdir,'dstdir':dstdir,'mode':mode,'nfiles':len(names),
+            'nselected':len(selected),'nstaged':nstaged,
+            'duration':time.time()-start}
+
+def summary_message(summary):
+    """One line log message of a staging summary."""
+    return ''.join([prog,summary['srcdir'],': ',str(summary['nfiles']),' files, ',
+                    str(summary['nselected']),' selected, ',str(summary['nstaged']),
+                    ' staged (',summary['mode'],') into ',summary['dstdir'],
+                    ' in ','%.3f'%summary['duration'],' s\n'])
+
+def unstage_directory(srcdir,dstdir,patterns=frame_patterns):
+    """Remove the staged copies of the files of a directory matching some patterns.
+
+    Only the files of dstdir that also exist in srcdir are removed, so that
+    the products of the pipeline stay; nothing is removed if dstdir is
+    srcdir.
+
+    Parameters
+    ----------
+    srcdir : string
+        Full path of the source directory.
+    dstdir : string
+        Full path of the directory where the files were staged.
+    patterns : list of string
+        Shell patterns of the files to remove.
+
+    Returns
+    -------
+    nremoved : integer
+        Number of files removed.
+
+    """
+    if (os.path.abspath(srcdir)==os.path.abspath(dstdir) or not os.path.isdir(srcdir)
+        or not os.path.isdir(dstdir)):
+        return 0
+    sources=set(list_files(srcdir))
+    nremoved=0
+    for name in select(list_files(dstdir),patterns):
+        if name in sources:
+            os.remove(os.path.join(dstdir,name))
+            nremoved+=1
+    return nremoved
@@ -0,0 +1,273 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -In-memory registry of the FRIPON stations, read from fri_station_file,
+  and of the stations of the external networks, from external_station_file
+ -lookups by name and by code, and metadata of the stations
+
+The station file is read once per process, and read again only when its
+modification time changes (checked at most every check_interval seconds).
+Its first line is the header, possibly commented with '#', giving the names
+of the columns; the columns are separated by ',', ';', tabs or spaces.
+The 'code' and 'name' columns are required; 'latitude', 'longitude',
+'altitude' and 'camera' (or their short forms) are used if present, and
+all the columns are kept in the metadata of each station.
+If the header has no 'code' and 'name' columns, the lookups fall back to
+fripipe.conversion.name2code and code2name, memoized; the list of all the
+stations is then unknown, and all() is a fatal error. A row without code or
+name is skipped with a warning.
+The external station file, written by ingestnetworks.py, has the same
+format; it is optional, and its stations are added to those of the station
+file.
+
+"""
+import os
+import sys
+import time
+from fripipe.initialize import path_and_file
+
+prog="(stations.py) "
+
+# minimum time between two checks of the station file modification time [s]
+check_interval=1.0
+
+# accepted names of the columns
+column_aliases={'code':['code','stationcode','station_code','id'],
+                'name':['name','stationname','station_name','station'],
+                'latitude':['latitude','lat'],
+                'longitude':['longitude','lon','long'],
+                'altitude':['altitude','alt','elevation','height'],
+                'camera':['camera','cam','instrument']}
+
+
+class station (object):
+    """Metadata of a station.
+
+    Parameters
+    ----------
+    code : string
+        Code of the station, e.g. 'FRxx01'.
+    name : string
+        Name of the station, as in the name of the event directories.
+    metadata : dict
+        All the columns of the station file for this station.
+
+    """
+    def __init__(self,code,name,metadata=None):
+        self.code=code
+        self.name=name
+        self.metadata=metadata or {}
+        self.latitude=_float(self.metadata.get('latitude'))
+        self.longitude=_float(self.metadata.get('longitude'))
+        self.altitude=_float(self.metadata.get('altitude'))
+        self.camera=self.metadata.get('camera','')
+
+    def __repr__(self):
+        return 'station(%r,%r)'%(self.code,self.name)
+
+    @property
+    def proc_dir(self):
+        """Processed calibration images directory of the station."""
+        return path_and_file.fri_proc_dir+self.code+'/'
+
+    @property
+    def scamp_dir(self):
+        """Scamp calibration directory of the station."""
+        return self.proc_dir+'scamp/'
+
+    @property
+    def scampxml(self):
+        """Scamp xml file of the station."""
+        return self.scamp_dir+'scamp.xml'
+
+    @property
+    def meta_dir(self):
+        """Metadata directory of the station."""
+        return path_and_file.fri_meta_dir+self.code+'/'
+
+
+class registry (object):
+    """Registry of the stations of a station file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the station file.
+    extra : string
+        Full path of an optional station file whose stations are added,
+        e.g. path_and_file.external_station_file.
+
+    """
+    def __init__(self,filename,extra=None):
+        self.filename=filename
+        self.extra=extra
+        self.mtime=None
+        self.checked=0.0
+        self.names={}
+        self.codes={}
+        self.legacy=False
+
+    def refresh(self):
+        """Read the station file again if it changed."""
+        now=time.time()
+        if self.mtime is not None and now-self.checked<check_interval:
+            return
+        self.checked=now
+        try:
+            mtime=os.path.getmtime(self.filename)
+        except OSError:
+            sys.exit(prog+"*** FATAL ERROR: station file "+self.filename+" does not exist")
+        if self.extra is not None and os.path.isfile(self.extra):
+            mtime=(mtime,os.path.getmtime(self.extra))
+        if (mtime!=self.mtime):
+            self.load()
+            self.mtime=mtime
+
+    def load(self):
+        """Read the station file, and the extra station file if it exists."""
+        self.names={}
+        self.codes={}
+        stns=read_station_file(self.filename)
+        self.legacy=stns is None
+        if self.legacy:
+            print prog+'*** WARNING: no code and name columns in '+self.filename+', using fripipe.conversion'
+            stns=[]
+        if self.extra is not None and os.path.isfile(self.extra):
+            stns+=read_station_file(self.extra) or []
+        for stn in stns:
+            self.codes[stn.code]=stn
+            self.names[stn.name]=stn
+
+    def by_name(self,name):
+        """Station of a given name, None if unknown."""
+        self.refresh()
+        if self.legacy and name not in self.names:
+            from fripipe.conversion import name2code
+            code=name2code.name2code(name)
+            if not code:
+                return None
+            self.names[name]=self.codes[code]=station(code,name)
+        return self.names.get(name)
+
+    def by_code(self,code):
+        """Station of a given code, None if unknown."""
+        self.refresh()
+        if self.legacy and code not in self.codes:
+            from fripipe.conversion import code2name
+            name=code2name.code2name(code)
+            if not name:
+                return None
+            self.names[name]=self.codes[code]=station(code,name)
+        return self.codes.get(code)
+
+    def name2code(self,name):
+        """Code of a station, '' if unknown."""
+        stn=self.by_name(name)
+        return stn.code if stn is not None else ''
+
+    def code2name(self,code):
+        """Name of a station, '' if unknown."""
+        stn=self.by_code(code)
+        return stn.name if stn is not None else ''
+
+    def all(self):
+        """All the stations of the station file, sorted by code."""
+        self.refresh()
+        if self.legacy:
+            sys.exit(prog+"*** FATAL ERROR: station file "+self.filename+" has no header with code and "+
+                     "name columns: the list of the stations is unknown, please add the header")
+        return [self.codes[code] for code in sorted(self.codes)]
+
+def read_station_file(filename):
+    """Read the stations of a station file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the station file.
+
+    Returns
+    -------
+    stns : list of station
+        Stations of the file, None if its header has no code and name
+        columns.
+
+    """
+    with open(filename) as f:
+        lines=[line.strip() for line in f if line.strip()]
+    if (len(lines)==0):
+        return None
+    columns=[column.lower() for column in _split(lines[0].lstrip('#'))]
+    index={}
+    for key,aliases in column_aliases.items():
+        for alias in aliases:
+            if alias in columns:
+                index[key]=columns.index(alias)
+                break
+    if not ('code' in index and 'name' in index):
+        return None
+    stns=[]
+    for line in lines[1:]:
+        if line.startswith('#'):
+            continue
+        values=_split(line)
+        metadata=dict(zip(columns,values))
+        for key,i in index.items():
+            if i<len(values):
+                metadata[key]=values[i]
+        if not (metadata.get('code') and metadata.get('name')):
+            print prog+'*** WARNING: no code or name in line "'+line+'" of '+filename+': skipped'
+            continue
+        stns.append(station(metadata['code'],metadata['name'],metadata))
+    return stns
+
+def _split(line):
+    """Split a line of the station file on its separator."""
+    for sep in (',',';','\t'):
+        if sep in line:
+            return [value.strip() for value in line.split(sep)]
+    return line.split()
+
+def _float(value):
+    """Convert a value to float, None if it is missing or invalid."""
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return None
+
+# registries of the process, by station file
+_registries={}
+
+def get_registry(filename=None):
+    """Get the registry of a station file, created once per process.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the station file (default: path_and_file.fri_station_file,
+        with the stations of path_and_file.external_station_file).
+
+    Returns
+    -------
+    registry : registry
+        Registry of the station file.
+
+    """
+    extra=None
+    if filename is None:
+        filename=path_and_file.fri_station_file
+        extra=path_and_file.external_station_file
+    if filename not in _registries:
+        _registries[filename]=registry(filename,extra)
+    return _registries[filename]
+
+def name2code(name):
+    """Code of a station from its name, '' if unknown."""
+    return get_registry().name2code(name)
+
+def code2name(code):
+    """Name of a station from its code, '' if unknown."""
+    return get_registry().code2name(code)
@@ -0,0 +1,359 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Build synthetic FRIPON data trees, to measure the pipeline offline
+ -Provide stand-ins for SExtractor and for the private or external parts
+  of the pipeline (station file, name2code, position2met, compute_traj,
+  spiceypy)
+
+The tree built under root mimics /data:
+ root/detections/multiple/<yyyymm>/<event>/<STATION>_UT/positions.txt
+ root/detections/multiple/<yyyymm>/<event>/<STATION>_UT/fits2D/frame_NNNN.fit
+ root/processed/stations/<CODE>/scamp/scamp.xml and its *.head files
+ root/stations/<CODE>, a link to root/processed/stations/<CODE>
+ root/friponsvn/scripts/shell/sexmet_auto_detect.sh (SExtractor stand-in)
+ root/friponsvn/fripipe/conf/kernels/standard.ker (SPICE stand-in: a text
+  kernel defining the Earth radii and the GM of the Sun and of the Earth)
+ root/stations.txt (station file)
+environ(root) gives the FRIPIPE_* variables pointing path_and_file to it.
+
+"""
+import os
+import re
+import sys
+import types
+import datetime
+import numpy as np
+
+prog="(synthetic.py) "
+
+# SExtractor stand-in: one small catalog per frame, with an optional delay
+sexmet_stub='''#!/bin/sh
+# synthetic sexmet_auto_detect.sh: writes one catalog per frame
+for fit in *.fit; do
+    [ -n "$SEX_STUB_DELAY" ] && sleep "$SEX_STUB_DELAY"
+    printf '#   1 X_IMAGE\\n#   2 Y_IMAGE\\n#   3 ALPHA_J2000\\n#   4 DELTA_J2000\\n#   5 MAG_AUTO\\n500.0 500.0 180.0 45.0 -2.0\\n' > "${fit%.fit}.cata"
+done
+'''
+
+# SPICE stand-in for the standard.ker meta-kernel
+spice_stub='''KPL/PCK
+Synthetic kernel for offline runs of the FRIPON pipeline.
+\\begindata
+BODY399_RADII = ( 6378.1366 6378.1366 6356.7519 )
+BODY10_GM     = ( 132712440041.93938 )
+BODY399_GM    = ( 398600.435436 )
+\\begintext
+'''
+
+# NAIF codes of the bodies known to the spiceypy stand-in
+spice_bodies={'SUN':10,'EARTH':399}
+
+# peak [ADU] and gaussian width [pixel] of the synthetic meteor
+meteor_flux=400.0
+meteor_sigma=1.5
+
+def station_name(i):
+    """Name of the i-th synthetic station."""
+    return 'SYNTH%02d'%i
+
+def station_code(i):
+    """Code of the i-th synthetic station."""
+    return 'FRSY%02d'%i
+
+def write_fits(filename,data,cards=()):
+    """Write a 2D int16 image as a minimal FITS file.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the FITS file.
+    data : numpy.ndarray
+        2D image.
+    cards : list of string
+        Other cards of the header, e.g. the pointing (CRVAL1, CRVAL2).
+
+    Returns
+    -------
+    None.
+
+    """
+    cards=['SIMPLE  = %20s'%'T','BITPIX  = %20d'%16,'NAXIS   = %20d'%2,
+           'NAXIS1  = %20d'%data.shape[1],'NAXIS2  = %20d'%data.shape[0]]+list(cards)+['END']
+    header=''.join(card.ljust(80) for card in cards)
+    header=header.ljust(2880*((len(header)+2879)//2880))
+    raw=data.astype('>i2').tostring()
+    with open(filename,'wb') as f:
+        f.write(header)
+        f.write(raw)
+        f.write('\0'*(-len(raw)%2880))
+
+def write_head(filename,ra=180.0,dec=45.0):
+    """Write a scamp-like .head file."""
+    cards=["CRVAL1  = %20.10f"%ra,"CRVAL2  = %20.10f"%dec,
+           "CRPIX1  = %20.10f"%500.0,"CRPIX2  = %20.10f"%500.0,
+           "CD1_1   = %20.10E"%-0.18,"CD1_2   = %20.10E"%0.0,
+           "CD2_1   = %20.10E"%0.0,"CD2_2   = %20.10E"%0.18,"END"]
+    with open(filename,'w') as f:
+        f.write('\n'.join(cards)+'\n')
+
+def write_scampxml(filename,catnames,dates,contrasts):
+    """Write a minimal scamp.xml VOTable with the fields used by the pipeline.
+
+    Parameters
+    ----------
+    filename : string
+        Full path of the scamp.xml file.
+    catnames : list of string
+        Catalog_Name column.
+    dates : numpy.ndarray
+        Observation_Date column, in decimal year.
+    contrasts : numpy.ndarray
+        XY_Contrast column.
+
+    Returns
+    -------
+    None.
+
+    """
+    with open(filename,'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<VOTABLE version="1.1" xmlns="http://www.ivoa.net/xml/VOTable/v1.1">\n'
+                '<RESOURCE><TABLE name="Fields">\n'
+                '<FIELD name="Catalog_Name" datatype="char" arraysize="*"/>\n'
+                '<FIELD name="Observation_Date" datatype="double"/>\n'
+                '<FIELD name="XY_Contrast" datatype="float"/>\n'
+                '<DATA><TABLEDATA>\n')
+        for catname,date,contrast in zip(catnames,dates,contrasts):
+            f.write('<TR><TD>%s</TD><TD>%.8f</TD><TD>%.3f</TD></TR>\n'%(catname,date,contrast))
+        f.write('</TABLEDATA></DATA></TABLE></RESOURCE></VOTABLE>\n')
+
+def decimalyear(date):
+    """Julian decimal year of a datetime, as the scamp Observation_Date."""
+    return 2000.0+(date-datetime.datetime(2000,1,1,12)).total_seconds()/(365.25*86400.0)
+
+def make_station_calibration(root,code,eventtime,ncalib,nheads=None,seed=0):
+    """Build the scamp calibration directory of a synthetic station.
+
+    Parameters
+    ----------
+    root : string
+        Root of the synthetic tree.
+    code : string
+        Code of the station.
+    eventtime : datetime.datetime
+        Date around which the calibrations are spread (+-1 year).
+    ncalib : integer
+        Number of rows of scamp.xml.
+    nheads : integer
+        Number of calibrations close to eventtime, the only ones whose .head
+        file is written (default: all of them).
+    seed : integer
+        Seed of the random generator.
+
+    Returns
+    -------
+    scampxml : string
+        Full path of the scamp.xml file.
+
+    """
+    rng=np.random.RandomState(seed)
+    scampdir=os.path.join(root,'processed','stations',code,'scamp')
+    if not os.path.isdir(scampdir):
+        os.makedirs(scampdir)
+    if nheads is None:
+        nheads=ncalib
+    nheads=min(nheads,ncalib)
+    # the nheads first calibrations are within 20 days of the event, with a
+    # good contrast: the selected .head file is always one of them
+    deltat=np.concatenate([rng.uniform(-20.0,20.0,nheads),
+                           rng.choice([-1.0,1.0],ncalib-nheads)*rng.uniform(40.0,365.0,ncalib-nheads)])
+    dates=decimalyear(eventtime)+deltat/365.25
+    contrasts=np.concatenate([rng.uniform(5.0,20.0,nheads),rng.uniform(1.0,20.0,ncalib-nheads)])
+    catnames=['calib_%06d.cat'%i for i in range(ncalib)]
+    scampxml=os.path.join(scampdir,'scamp.xml')
+    write_scampxml(scampxml,catnames,dates,contrasts)
+    for catname in catnames[:nheads]:
+        write_head(os.path.join(scampdir,os.path.splitext(catname)[0]+'.head'))
+    # the station directory is also checked for the scamp directory
+    stationdir=os.path.join(root,'stations',code)
+    if not os.path.isdir(os.path.join(root,'stations')):
+        os.makedirs(os.path.join(root,'stations'))
+    if not os.path.lexists(stationdir):
+        os.symlink(os.path.join(root,'processed','stations',code),stationdir)
+    return scampxml
+
+def make_tree(root,eventname='20160806T220747_UT',nstations=8,nframes=100,
+              ncalib=1000,shape=(64,64),seed=0):
+    """Build a synthetic data tree with one event.
+
+    Parameters
+    ----------
+    root : string
+        Root of the synthetic tree, created if needed.
+    eventname : string
+        Name of the event.
+    nstations : integer
+        Number of stations that observed the event.
+    nframes : integer
+        Number of fits2D frames per station.
+    ncalib : integer
+        Number of scamp calibrations per station.
+    shape : tuple of integer
+        Dimension of the frames, in pixels.
+    seed : integer
+        Seed of the random generator.
+
+    Returns
+    -------
+    my_event : string
+        Full path of the event directory.
+
+    """
+    rng=np.random.RandomState(seed)
+    eventtime=datetime.datetime.strptime(eventname[:15],'%Y%m%dT%H%M%S')
+    for path in ['friponsvn/fripipe/conf/kernels','friponsvn/fripipe/spicexe',
+                 'friponsvn/fripipe_data','friponsvn/scripts/shell','processed/stations',
+                 'detections/multiple','stations','metadata']:
+        if not os.path.isdir(os.path.join(root,path)):
+            os.makedirs(os.path.join(root,path))
+    sexmet=os.path.join(root,'friponsvn','scripts','shell','sexmet_auto_detect.sh')
+    with open(sexmet,'w') as f:
+        f.write(sexmet_stub)
+    os.chmod(sexmet,0o755)
+    with open(os.path.join(root,'friponsvn','fripipe','conf','kernels','standard.ker'),'w') as f:
+        f.write(spice_stub)
+    with open(os.path.join(root,'stations.txt'),'w') as f:
+        f.write('# code name latitude longitude altitude\n')
+        for i in range(nstations):
+            f.write('%s %s %.6f %.6f %.1f\n'%(station_code(i),station_name(i),
+                                              rng.uniform(43.0,50.0),rng.uniform(-4.0,7.0),
+                                              rng.uniform(0.0,1000.0)))
+    my_event=os.path.join(root,'detections','multiple',eventname[:6],eventname)
+    for i in range(nstations):
+        make_station_calibration(root,station_code(i),eventtime,ncalib,
+                                 nheads=min(ncalib,50),seed=seed+i)
+        station=os.path.join(my_event,station_name(i)+'_UT')
+        fits2Ddir=os.path.join(station,'fits2D')
+        if not os.path.isdir(fits2Ddir):
+            os.makedirs(fits2Ddir)
+        # the meteor crosses the frames, a gaussian spot on the Poisson background
+        t=np.arange(nframes)/30.0
+        fraction=t/max(t[-1],1e-3)
+        x=shape[1]*(0.15+0.7*fraction)
+        y=shape[0]*(0.2+0.6*fraction)
+        np.savetxt(os.path.join(station,'positions.txt'),
+                   np.column_stack([np.arange(nframes),t,x+rng.normal(0.0,0.2,nframes),
+                                    y+rng.normal(0.0,0.2,nframes)]),fmt='%d %.6f %.3f %.3f',
+                   header='frame time x y')
+        row,col=np.mgrid[1:shape[0]+1,1:shape[1]+1]
+        pointing=['CRVAL1  = %20.10f'%180.0,'CRVAL2  = %20.10f'%45.0]
+        for n in range(nframes):
+            spot=meteor_flux*np.exp(-((col-x[n])**2+(row-y[n])**2)/(2.0*meteor_sigma**2))
+            image=(rng.poisson(100.0,shape)+spot).astype(np.int16)
+            write_fits(os.path.join(fits2Ddir,'frame_%04d.fit'%n),image,pointing)
+    return my_event
+
+def environ(root):
+    """FRIPIPE_* environment variables pointing path_and_file to a synthetic tree."""
+    root=os.path.abspath(root).rstrip('/')+'/'
+    return {'FRIPIPE_DATA_DIR':root,
+            'FRIPIPE_FRI_STATION_FILE':root+'stations.txt',
+            'FRIPIPE_SEX_EXE':'/bin/sh'}
+
+def install_standins(root):
+    """Install stand-ins for the modules missing from this tree.
+
+    fripipe.conversion.name2code, fripipe.position2met and
+    fripipe.trajectory.compute_traj are replaced by simple functions working
+    on the synthetic tree, only if they can not be imported. So is spiceypy,
+    by furnsh and unload reading the variables of the text kernels, and
+    bodvrd returning those of the bodies of spice_bodies.
+
+    Parameters
+    ----------
+    root : string
+        Root of the synthetic tree.
+
+    Returns
+    -------
+    installed : list of string
+        Names of the modules replaced by a stand-in.
+
+    """
+    installed=[]
+
+    def _codes():
+        codes={}
+        with open(os.path.join(root,'stations.txt')) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    code,name=line.split()[:2]
+                    codes[name]=code
+        return codes
+
+    def _name2code(name):
+        return _codes().get(name,'')
+
+    def _code2name(code):
+        for name,stationcode in _codes().items():
+            if (stationcode==code):
+                return name
+        return ''
+
+    def _position2met(positionfile,fits2Ddir,met_file):
+        positions=np.loadtxt(positionfile,ndmin=2)
+        np.savetxt(met_file,positions,header='frame time x y')
+
+    def _compute_traj(eventname):
+        return eventname
+
+    # kernel pool of the spiceypy stand-in: kernel -> {variable: values}
+    pool={}
+
+    def _furnsh(kernel):
+        variables={}
+        with open(kernel) as f:
+            text=f.read()
+        for data in re.findall(r'\\begindata(.*?)(?:\\begintext|$)',text,re.S):
+            for name,values in re.findall(r'(\w+)\s*=\s*\(([^)]*)\)',data):
+                try:
+                    variables[name]=np.array([float(value) for value in values.split()])
+                except ValueError:
+                    variables[name]=values.split()
+        pool[kernel]=variables
+
+    def _unload(kernel):
+        pool.pop(kernel,None)
+
+    def _bodvrd(body,item,maxn):
+        name='BODY%d_%s'%(spice_bodies[body.upper()],item.upper())
+        for variables in pool.values():
+            if name in variables:
+                values=variables[name][:maxn]
+                return len(values),values
+        raise KeyError(prog+'no '+name+' in the loaded kernels')
+
+    standins={'fripipe.conversion':{'name2code':types.ModuleType('name2code'),
+                                    'code2name':types.ModuleType('code2name')},
+              'fripipe.position2met':{'position2met':_position2met},
+              'fripipe.trajectory':{'compute_traj':types.ModuleType('compute_traj')},
+              'spiceypy':{'furnsh':_furnsh,'unload':_unload,'bodvrd':_bodvrd}}
+    standins['fripipe.conversion']['name2code'].name2code=_name2code
+    standins['fripipe.conversion']['code2name'].code2name=_code2name
+    standins['fripipe.trajectory']['compute_traj'].compute_traj=_compute_traj
+    for modname,attrs in sorted(standins.items()):
+        try:
+            __import__(modname)
+            continue
+        except ImportError:
+            pass
+        module=types.ModuleType(modname)
+        for attr,value in attrs.items():
+            setattr(module,attr,value)
+        sys.modules[modname]=module
+        installed.append(modname)
+    return installed
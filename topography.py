@@ -0,0 +1,332 @@
+"""
+Author : FRIPON project
+Copyright : Observatoire de Paris, FRIPON
+Free license
+
+Purpose:
+ -Tile index of the digital elevation model (DEM) in topo_IGN_data_path
+ -vectorized ground altitude of arrays of latitudes and longitudes
+
+The DEM is a set of ESRI ASCII grid tiles (*.asc, as the IGN MNT). Their
+headers are read once and saved, with the modification times of the tiles,
+in a NumPy .npz index next to them (or in the user cache directory if the
+DEM directory is not writable); the index is rebuilt only when a tile is
+added, removed or modified. The raster of a tile is converted once to a
+.npy file, then memory-mapped; at most max_tiles rasters are kept open,
+the least recently used being closed first.
+The altitude is the bilinear interpolation of the four nearest grid nodes;
+the nodata nodes are left out and the weights of the other nodes
+renormalized, and a point whose four nodes are nodata gets the outside
+altitude, as a point outside of the tiles. An invalid tile, or tiles whose
+coordinates can not be converted, raise a topography_error.
+The coordinates of the tiles are those of crs (default: Lambert 93, as the
+IGN MNT), converted from latitude and longitude with pyproj; tiles whose
+coordinates are longitudes and latitudes do not need pyproj.
+
+"""
+import os
+import glob
+import collections
+import numpy as np
+from fripipe.initialize import path_and_file
+from fripipe import atomicfile
+
+prog="(topography.py) "
+
+# suffix of the DEM tiles
+tile_suffix='.asc'
+# name of the tile index file
+index_name='dem_index.npz'
+# fallback directory for the index and rasters, if the DEM directory is not writable
+user_cache_dir=os.path.expanduser('~/.fripipe/topography/')
+# coordinate reference system of the tiles
+default_crs='EPSG:2154'
+# maximum number of rasters kept open
+max_tiles=64
+# ESRI ASCII grid header keywords
+header_keys=['ncols','nrows','xllcorner','yllcorner','xllcenter','yllcenter',
+             'cellsize','nodata_value']
+
+class topography_error (Exception):
+    """A DEM tile can not be read, or its coordinates can not be converted."""
+    pass
+
+def read_header(tilefile):
+    """Read the header of an ESRI ASCII grid file.
+
+    Parameters
+    ----------
+    tilefile : string
+        Full path of the tile.
+
+    Returns
+    -------
+    header : dict
+        'ncols', 'nrows', 'xmin', 'ymin' (lower left corner of the grid),
+        'cellsize', 'nodata' and 'skip' (number of header lines).
+
+    Raises
+    ------
+    topography_error
+        If the header is incomplete.
+
+    """
+    values={}
+    with open(tilefile) as f:
+        for line in f:
+            words=line.split()
+            if len(words)!=2 or words[0].lower() not in header_keys:
+                break
+            values[words[0].lower()]=float(words[1])
+    try:
+        cellsize=values['cellsize']
+        if 'xllcorner' in values:
+            xmin=values['xllcorner']
+            ymin=values['yllcorner']
+        else:
+            xmin=values['xllcenter']-0.5*cellsize
+            ymin=values['yllcenter']-0.5*cellsize
+        return {'ncols':int(values['ncols']),'nrows':int(values['nrows']),
+                'xmin':xmin,'ymin':ymin,'cellsize':cellsize,
+                'nodata':values.get('nodata_value',np.nan),'skip':len(values)}
+    except KeyError as e:
+        raise topography_error(prog+"*** FATAL ERROR: invalid ESRI ASCII grid header in "+tilefile+": no "+str(e))
+
+def cache_dir(topodir):
+    """Directory of the index and of the rasters of a DEM directory."""
+    topodir=os.path.abspath(topodir)
+    if os.access(topodir,os.W_OK):
+        return topodir+'/'
+    return user_cache_dir+topodir.strip('/').replace('/','_')+'/'
+
+class demindex (object):
+    """Tile index of a DEM directory.
+
+    Parameters
+    ----------
+    topodir : string
+        DEM directory, searched recursively for the tiles.
+    crs : string
+        Coordinate reference system of the tiles (default: default_crs).
+        Ignored if the tiles are in longitude and latitude.
+    ntiles : integer
+        Maximum number of rasters kept open.
+
+    """
+    def __init__(self,topodir,crs=default_crs,ntiles=max_tiles):
+        self.topodir=topodir
+        self.crs=crs
+        self.ntiles=ntiles
+        self.cachedir=cache_dir(topodir)
+        self.rasters=collections.OrderedDict()
+        self.transformer=None
+        self.load()
+
+    def load(self):
+        """Load the tile index, rebuilding it if the tiles changed."""
+        files=sorted(glob.glob(os.path.join(self.topodir,'*'+tile_suffix))+
+                     glob.glob(os.path.join(self.topodir,'*','*'+tile_suffix)))
+        mtimes=np.array([os.path.getmtime(tilefile) for tilefile in files])
+        indexfile=self.cachedir+index_name
+        index=None
+        if os.path.isfile(indexfile):
+            try:
+                npz=np.load(indexfile)
+                if list(npz['files'].astype(str))==files and np.array_equal(npz['mtime'],mtimes):
+                    index=dict((key,npz[key]) for key in npz.files)
+                npz.close()
+            except (IOError,OSError,KeyError,ValueError):
+                index=None
+        if index is None:
+            headers=[read_header(tilefile) for tilefile in files]
+            index={'files':np.array(files,dtype=str),'mtime':mtimes}
+            for key in ('ncols','nrows','xmin','ymin','cellsize','nodata','skip'):
+                index[key]=np.array([header[key] for header in headers])
+            atomicfile.save_cache(indexfile,lambda out:np.savez(out,**index),prog)
+        self.files=list(index['files'].astype(str))
+        self.mtime=index['mtime']
+        self.ncols=index['ncols'].astype(int)
+        self.nrows=index['nrows'].astype(int)
+        self.cellsize=index['cellsize'].astype(float)
+        self.nodata=index['nodata'].astype(float)
+        self.skip=index['skip'].astype(int)
+        self.xmin=index['xmin'].astype(float)
+        self.ymin=index['ymin'].astype(float)
+        self.xmax=self.xmin+self.ncols*self.cellsize
+        self.ymax=self.ymin+self.nrows*self.cellsize
+        if (len(self.files)==0):
+            print prog+'*** WARNING: no DEM tile in '+self.topodir
+            self.geographic=True
+            self.buckets={}
+            self.bucket=1.0
+            return
+        self.geographic=bool(np.all(np.abs(self.xmin)<=360.0) and np.all(np.abs(self.ymax)<=90.0)
+                             and np.all(self.cellsize<1.0))
+        # the tiles are put in square buckets at least as large as a tile
+        self.bucket=max((self.xmax-self.xmin).max(),(self.ymax-self.ymin).max())
+        self.buckets={}
+        for i in range(len(self.files)):
+            for ix in range(int(np.floor(self.xmin[i]/self.bucket)),int(np.floor(self.xmax[i]/self.bucket))+1):
+                for iy in range(int(np.floor(self.ymin[i]/self.bucket)),int(np.floor(self.ymax[i]/self.bucket))+1):
+                    self.buckets.setdefault((ix,iy),[]).append(i)
+
+    def raster(self,i):
+        """Memory-mapped raster of a tile, converted to .npy if needed.
+
+        Parameters
+        ----------
+        i : integer
+            Number of the tile in the index.
+
+        Returns
+        -------
+        raster : numpy.memmap
+            (nrows,ncols) float32 altitudes, the first row being the
+            northernmost one; nodata values are NaN.
+
+        """
+        if i in self.rasters:
+            raster=self.rasters.pop(i)
+            self.rasters[i]=raster
+            return raster
+        tilefile=self.files[i]
+        npyfile=self.cachedir+os.path.relpath(tilefile,self.topodir).replace('/','_')+'.npy'
+        if (os.path.isfile(npyfile) and os.path.getmtime(npyfile)>=self.mtime[i]):
+            raster=np.load(npyfile,mmap_mode='r')
+        else:
+            raster=np.loadtxt(tilefile,skiprows=self.skip[i],dtype=np.float32)
+            raster=raster.reshape(self.nrows[i],self.ncols[i])
+            raster[raster==self.nodata[i]]=np.nan
+            if atomicfile.save_cache(npyfile,lambda out:np.save(out,raster),prog):
+                raster=np.load(npyfile,mmap_mode='r')
+        self.rasters[i]=raster
+        while len(self.rasters)>self.ntiles:
+            self.rasters.popitem(last=False)
+        return raster
+
+    def transform(self,lat,lon):
+        """Coordinates of the tiles of latitudes and longitudes [deg]."""
+        if self.geographic:
+            return lon,lat
+        if self.transformer is None:
+            try:
+                import pyproj
+            except ImportError:
+                raise topography_error(prog+"*** FATAL ERROR: pyproj is needed for the DEM tiles of "+self.topodir+" in "+self.crs)
+            try:
+                self.transformer=pyproj.Transformer.from_crs('EPSG:4326',self.crs,always_xy=True).transform
+            except AttributeError:
+                # pyproj < 2
+                self.transformer=pyproj.Proj(init=self.crs.lower())
+        return self.transformer(lon,lat)
+
+    def altitude(self,lat,lon,outside=0.0):
+        """Ground altitude of arrays of points.
+
+        Parameters
+        ----------
+        lat, lon : numpy.ndarray
+            Latitudes and longitudes [deg].
+        outside : float
+            Altitude of the points outside of the tiles, or on nodata [m].
+
+        Returns
+        -------
+        alt : numpy.ndarray
+            Ground altitude of the points [m].
+
+        """
+        lat=np.asarray(lat,dtype=float)
+        shape=lat.shape
+        lat=lat.ravel()
+        lon=np.asarray(lon,dtype=float).ravel()
+        alt=np.full(lat.shape,np.nan)
+        if (len(self.files)==0 or len(lat)==0):
+            return np.full(shape,outside)
+        x,y=self.transform(lat,lon)
+        x=np.asarray(x,dtype=float)
+        y=np.asarray(y,dtype=float)
+        # points grouped by bucket, then by tile
+        ix=np.floor(x/self.bucket).astype(np.int64)
+        iy=np.floor(y/self.bucket).astype(np.int64)
+        keys,inverse=np.unique(ix*(1<<32)+iy,return_inverse=True)
+        for k in range(len(keys)):
+            points=np.flatnonzero(inverse==k)
+            for i in self.buckets.get((ix[points[0]],iy[points[0]]),[]):
+                inside=((x[points]>=self.xmin[i])&(x[points]<=self.xmax[i])&
+                        (y[points]>=self.ymin[i])&(y[points]<=self.ymax[i]))
+                if not inside.any():
+                    continue
+                found=points[inside]
+                alt[found]=self.interpolate(i,x[found],y[found])
+                points=points[~inside]
+                if (len(points)==0):
+                    break
+        alt[np.isnan(alt)]=outside
+        return alt.reshape(shape)
+
+    def interpolate(self,i,x,y):
+        """Bilinear interpolation of the raster of a tile, without the nodata nodes."""
+        raster=self.raster(i)
+        nrows,ncols=raster.shape
+        # fractional column and row, the grid nodes being the cell centres;
+        # the half cell along the edges of the tile is extrapolated
+        col=np.clip((x-self.xmin[i])/self.cellsize[i]-0.5,-0.5,ncols-0.5)
+        row=np.clip((self.ymax[i]-y)/self.cellsize[i]-0.5,-0.5,nrows-0.5)
+        c0=np.clip(np.floor(col).astype(int),0,max(ncols-2,0))
+        r0=np.clip(np.floor(row).astype(int),0,max(nrows-2,0))
+        c1=np.minimum(c0+1,ncols-1)
+        r1=np.minimum(r0+1,nrows-1)
+        fc=col-c0
+        fr=row-r0
+        nodes=np.array([raster[r0,c0],raster[r0,c1],raster[r1,c0],raster[r1,c1]],dtype=float)
+        weights=np.array([(1.0-fr)*(1.0-fc),(1.0-fr)*fc,fr*(1.0-fc),fr*fc])
+        # the nodata nodes are left out, and the weights of the others renormalized
+        valid=~np.isnan(nodes)
+        weights=np.where(valid,weights,0.0)
+        total=weights.sum(axis=0)
+        alt=np.full(len(x),np.nan)
+        weighted=total>0.0
+        alt[weighted]=((np.where(valid,nodes,0.0)*weights).sum(axis=0)[weighted]/total[weighted])
+        # the valid nodes of a point on the edge of a nodata area may all have a
+        # zero weight: the altitude is that of the nearest valid node
+        nearest=valid.any(axis=0)&~weighted
+        if nearest.any():
+            distance=np.array([np.hypot(fr,fc),np.hypot(fr,1.0-fc),
+                               np.hypot(1.0-fr,fc),np.hypot(1.0-fr,1.0-fc)])
+            k=np.argmin(np.where(valid,distance,np.inf),axis=0)
+            alt[nearest]=nodes[k,np.arange(len(x))][nearest]
+        return alt
+
+# tile indexes of the process, by DEM directory
+_indexes={}
+
+def get_index(topodir=None,crs=default_crs):
+    """Get the tile index of a DEM directory, loaded once per process.
+
+    Parameters
+    ----------
+    topodir : string
+        DEM directory (default: path_and_file.topo_IGN_data_path).
+    crs : string
+        Coordinate reference system of the tiles.
+
+    Returns
+    -------
+    index : demindex
+        Tile index of the DEM directory.
+
+    """
+    if topodir is None:
+        topodir=path_and_file.topo_IGN_data_path
+    if topodir not in _indexes:
+        _indexes[topodir]=demindex(topodir,crs)
+    return _indexes[topodir]
+
+def ground_altitude(lat,lon):
+    """Ground altitude [m] of arrays of latitudes and longitudes [deg].
+
+    This is the ground of darkflight.integrate, from the IGN MNT.
+
+    """
+    return get_index().altitude(lat,lon)